@@ -0,0 +1,140 @@
+import hashlib
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import mrcfile
+
+from assemble_frames import NO_NOISE, frame_files, micrograph_dirs, write_mrc
+from mrc_io import read_frame
+
+
+def mtf(shape, a=0, b=0, c=1, alpha=0, beta=0):
+    """
+    Modulation transfer function of the detector on the half spectrum (`np.fft.rfft2` layout) of a frame,
+    MTF(k) = a / (1 + alpha k²) + b / (1 + beta k²) + c, with the spatial frequency k in units of the Nyquist frequency.
+    The parameters have the same names as the mtf parameters of the TEM-Simulator detector. The default is no blurring.
+    :param shape: shape of the frame
+    :return: 2D array with the shape of the half spectrum
+    """
+    ky = np.fft.fftfreq(shape[0])[:, None] * 2
+    kx = np.fft.rfftfreq(shape[1])[None, :] * 2
+    k2 = ky ** 2 + kx ** 2
+    return (a / (1 + alpha * k2) + b / (1 + beta * k2) + c).astype(np.float32)
+
+
+def detect(image, rng, scale=1, dqe=1, mtf_params=None, quantize=False):
+    """
+    Detector model for a noise free frame: Poisson shot noise, detective quantum efficiency and MTF.
+    A DQE below 1 is modeled as detection of a fraction `dqe` of the electrons, scaled back to the expected counts,
+    which keeps the mean and increases the noise.
+    :param image: noise free frame with the expected number of electrons per pixel (gain 1)
+    :param rng: numpy.random.Generator of the frame
+    :param scale: factor for the dose of the noise free frame, e.g. 0.5 for half the simulated dose
+    :param dqe: detective quantum efficiency between 0 and 1
+    :param mtf_params: dictionary with the parameters of `mtf`, None for no blurring
+    :param quantize: round to integer counts
+    :return: frame with noise as float32 array
+    """
+    expected = np.clip(image.astype(np.float64) * (scale * dqe), 0, None)
+    counts = rng.poisson(expected).astype(np.float32)
+    if dqe != 1:
+        counts /= dqe
+    if mtf_params:
+        counts = np.fft.irfft2(np.fft.rfft2(counts) * mtf(counts.shape, **mtf_params), s=counts.shape).astype(np.float32)
+    if quantize:
+        np.rint(counts, out=counts)
+    return counts
+
+
+def micrograph_key(micrograph_dir):
+    """
+    Spawn key of a micrograph for the random streams of its frames, derived from the name of the micrograph directory.
+    """
+    name = os.path.basename(os.path.normpath(micrograph_dir))
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], 'little')
+
+
+def frame_rng(root_seed, micrograph_dir, frame):
+    """
+    Independent random number generator of a frame, derived from the root seed and the micrograph name. The noise of
+    a frame does not depend on which micrograph directories are processed together or in which order.
+    """
+    return np.random.default_rng(np.random.SeedSequence(root_seed, spawn_key=(micrograph_key(micrograph_dir), frame)))
+
+
+def _add_noise(job):
+    input_file, output_file, root_seed, micrograph_dir, frame, kwargs = job
+    start = time.time()
+    image = read_frame(input_file, 0)
+    with mrcfile.open(input_file, permissive=True, header_only=True) as mrc:
+        voxel_size = mrc.voxel_size.copy()
+    noisy = detect(image, frame_rng(root_seed, micrograph_dir, frame), **kwargs)
+    write_mrc(output_file, noisy, voxel_size)
+    return output_file, time.time() - start
+
+
+def main(dirs, name, seed, scale=1, dqe=1, mtf_params=None, quantize=False, workers=1):
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0] >> 1)
+    print('Random seed:', seed)
+
+    kwargs = dict(scale=scale, dqe=dqe, mtf_params=mtf_params, quantize=quantize)
+    jobs = []
+    for micrograph_dir in dirs:
+        for frame, input_file in enumerate(frame_files(micrograph_dir, 'no_noise')):
+            output_file = input_file[:-len(NO_NOISE)] + '_{}.mrc'.format(name)
+            jobs.append((input_file, output_file, seed, micrograph_dir, frame, kwargs))
+
+    start = time.time()
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(_add_noise, jobs) if pool is not None else map(_add_noise, jobs)
+        for n, (output_file, elapsed) in enumerate(results, 1):
+            print('[{}/{}] {} ({:.2f} s)'.format(n, len(jobs), output_file, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('Added noise to {} frames in {:.1f} s'.format(len(jobs), time.time() - start))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Add shot noise to the noise free frames (frame_XX_no_noise.mrc) of a '
+                                                 'simulation, with optional detector DQE and MTF. Several noise variants, '
+                                                 'e.g. for different doses, can be created from the same simulation.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py, or a single micrograph directory')
+    parser.add_argument('--name', type=str, default='with_noise',
+                        help='Name of the output frames, frame_XX_<name>.mrc. Default = with_noise')
+    parser.add_argument('--dose', type=float, default=None,
+                        help='Total dose of the noisy frames in e/A². Requires --sim_dose. Default is the simulated dose')
+    parser.add_argument('--sim_dose', type=float, default=None,
+                        help='Total dose used for the simulation of the noise free frames in e/A² (--dose of '
+                             'gen_temsim_input_files.py)')
+    parser.add_argument('--dqe', type=float, default=1,
+                        help='Detective quantum efficiency of the detector. Default = 1')
+    parser.add_argument('--mtf', type=float, nargs=5, default=None, metavar=('A', 'B', 'C', 'ALPHA', 'BETA'),
+                        help='Parameters of the detector MTF, a / (1 + alpha k²) + b / (1 + beta k²) + c with k in units of '
+                             'Nyquist. Default is no MTF')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='Round the frames to integer counts')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Root random seed. The noise of every frame is drawn from its own random stream derived from '
+                             'it. Default is a random seed')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of frames processed in parallel. Default = 1')
+
+    args = parser.parse_args()
+
+    if (args.dose is None) != (args.sim_dose is None):
+        parser.error('--dose and --sim_dose have to be used together')
+    if not 0 < args.dqe <= 1:
+        parser.error('--dqe has to be between 0 and 1')
+    scale = 1 if args.dose is None else args.dose / args.sim_dose
+    mtf_params = None if args.mtf is None else dict(zip(['a', 'b', 'c', 'alpha', 'beta'], args.mtf))
+
+    main(micrograph_dirs(args.run_dir), args.name, args.seed, scale, args.dqe, mtf_params, args.quantize, args.workers)
@@ -0,0 +1,276 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from assemble_frames import micrograph_dirs, write_mrc
+from create_filtered_maps import dose_schedule
+from dose_weighted_sum import DoseWeights, frame_header, movie_frames, sum_spectra
+
+
+def cropped_shape(shape, factor):
+    """
+    Shape of an image after downsampling by `factor`, rounded down to even numbers.
+    """
+    return int(shape[0] // factor) // 2 * 2, int(shape[1] // factor) // 2 * 2
+
+
+def fourier_crop(ft, shape, factor):
+    """
+    Crop the half spectrum (`np.fft.rfft2` layout) of an image, which downsamples the image by `factor`
+    and removes all frequencies above the new Nyquist frequency.
+    :param ft: half spectrum, the last two axes are the frequency axes
+    :param shape: shape of the real image
+    :param factor: downsampling factor
+    :return: cropped half spectrum and the shape of the downsampled image
+    """
+    ny, nx = cropped_shape(shape, factor)
+    rows = np.r_[0:ny // 2, ft.shape[-2] - ny // 2:ft.shape[-2]]
+    return ft[..., rows, :nx // 2 + 1], (ny, nx)
+
+
+def phase_ramp(shape, shift, dtype=np.complex64):
+    """
+    Phase ramp that shifts an image by `shift` pixels when it is multiplied with its half spectrum.
+    :param shape: shape of the real image (ny, nx)
+    :param shift: (x, y) shift in pixels
+    :return: 2D array with the shape of the half spectrum
+    """
+    ky = np.fft.fftfreq(shape[0])
+    kx = np.fft.rfftfreq(shape[1])
+    ramp_y = np.exp(-2j * np.pi * ky * shift[1]).astype(dtype)
+    ramp_x = np.exp(-2j * np.pi * kx * shift[0]).astype(dtype)
+    return ramp_y[:, None] * ramp_x[None, :]
+
+
+def bfactor_weights(shape, pixel_size, bfactor):
+    """
+    Band limiting weights exp(-B k²/4) for the half spectrum of an image, with the zero frequency set to 0.
+    :param shape: shape of the real image
+    :param pixel_size: pixel size in A
+    :param bfactor: B-factor in A²
+    """
+    ky = np.fft.fftfreq(shape[0], pixel_size)[:, None]
+    kx = np.fft.rfftfreq(shape[1], pixel_size)[None, :]
+    weights = np.exp(-bfactor * (ky ** 2 + kx ** 2) / 4).astype(np.float32)
+    weights[0, 0] = 0
+    return weights
+
+
+def find_peak(cc, center, radius):
+    """
+    Position of the maximum of a cross correlation map within `radius` pixels around `center`, refined to sub-pixel
+    precision with a parabola through the neighbouring pixels. The map is periodic, shifts are measured from (0, 0).
+    :param cc: 2D cross correlation map
+    :param center: (x, y) center of the search area
+    :param radius: radius of the search area in pixels
+    :return: (x, y) position of the peak
+    """
+    ny, nx = cc.shape
+    r = int(np.ceil(radius))
+    cy, cx = int(round(center[1])), int(round(center[0]))
+    ys = np.arange(cy - r, cy + r + 1)
+    xs = np.arange(cx - r, cx + r + 1)
+    area = cc[np.ix_(ys % ny, xs % nx)]
+    iy, ix = np.unravel_index(np.argmax(area), area.shape)
+    y, x = ys[iy], xs[ix]
+
+    def offset(minus, peak, plus):
+        denominator = minus - 2 * peak + plus
+        return 0.5 * (minus - plus) / denominator if denominator < 0 else 0.
+
+    dy = offset(cc[(y - 1) % ny, x % nx], cc[y % ny, x % nx], cc[(y + 1) % ny, x % nx])
+    dx = offset(cc[y % ny, (x - 1) % nx], cc[y % ny, x % nx], cc[y % ny, (x + 1) % nx])
+    return x + dx, y + dy
+
+
+def _align_level(spectra, shape, drift, weights, radius, n_iter, workers, executor, tolerance=0.01):
+    """
+    Iteratively align the frame spectra of one resolution level against a running reference. The reference of a
+    frame is the sum of all other frames, shifted by their current drift estimate.
+    :param drift: (n, 2) array with the current drift estimate in pixels of this level, updated in place
+    :param tolerance: stop iterating when no frame moved more than this number of pixels
+    """
+    n = len(spectra)
+    for _ in range(n_iter):
+        total = np.zeros(spectra.shape[1:], dtype=np.complex128)
+        for i in range(n):
+            total += spectra[i] * phase_ramp(shape, -drift[i])
+        total = total.astype(np.complex64)
+
+        def correlate(i):
+            reference = total - spectra[i] * phase_ramp(shape, -drift[i])
+            cc = np.fft.irfft2(spectra[i] * np.conj(reference) * weights, s=shape)
+            return find_peak(cc, drift[i], radius)
+
+        previous = drift.copy()
+        # the cross correlations are computed in batches of `workers` frames
+        for start in range(0, n, workers):
+            frames = range(start, min(n, start + workers))
+            for i, peak in zip(frames, executor.map(correlate, frames)):
+                drift[i] = peak
+        if np.abs(drift - previous).max() < tolerance:
+            break
+
+
+def align(frames, shape, pixel_size, binning=2, coarse_binning=8, max_shift=40, bfactor=500, n_iter=3, workers=1):
+    """
+    Estimate the drift of every frame of a movie with cross correlations of Fourier cropped frames.
+    The frames are aligned first on a coarse level (downsampled by `coarse_binning`) and then refined on a finer level
+    (downsampled by `binning`) with sub-pixel peak positions.
+    :param frames: iterable of 2D arrays in the order of the frames
+    :param shape: shape of a frame
+    :param pixel_size: pixel size in A
+    :param binning: downsampling factor of the refinement
+    :param coarse_binning: downsampling factor of the coarse alignment
+    :param max_shift: maximal drift between a frame and the reference in pixels
+    :param bfactor: B-factor in A² for band limiting the cross correlations
+    :param n_iter: number of iterations on every level
+    :param workers: number of frames processed in parallel
+    :return: (n, 2) array with the (x, y) drift of every frame in pixels, relative to the average position
+    """
+    def crop(frame):
+        ft = np.fft.rfft2(frame.astype(np.float32))
+        return np.array(fourier_crop(ft, shape, binning)[0])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # frames are transformed in batches of `workers` frames, only the cropped spectra are kept in memory
+        spectra, batch = [], []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) == workers:
+                spectra += executor.map(crop, batch)
+                batch = []
+        spectra = np.stack(spectra + list(executor.map(crop, batch)))
+        fine_shape = cropped_shape(shape, binning)
+
+        factor = coarse_binning / binning
+        coarse, coarse_shape = fourier_crop(spectra, fine_shape, factor)
+        coarse = np.ascontiguousarray(coarse)
+        drift = np.zeros((len(spectra), 2))
+        _align_level(coarse, coarse_shape, drift, bfactor_weights(coarse_shape, pixel_size * coarse_binning, bfactor),
+                     max_shift / coarse_binning, n_iter, workers, executor)
+        del coarse
+
+        drift *= factor
+        _align_level(spectra, fine_shape, drift, bfactor_weights(fine_shape, pixel_size * binning, bfactor),
+                     factor + 1, n_iter, workers, executor)
+
+    drift *= binning
+    return drift - drift.mean(axis=0)
+
+
+def read_drift(path, pixel_size):
+    """
+    Read the simulated drift of `gen_temsim_input_files.py`.
+    :param path: drift.txt with the (x, y) position of every frame in nm
+    :param pixel_size: pixel size of the image in A
+    :return: (n, 2) array with the drift in pixels
+    """
+    return np.atleast_2d(np.loadtxt(path)) * 10 / pixel_size
+
+
+def alignment_error(drift, true_drift, reference=None):
+    """
+    Error of the estimated drift, after both trajectories were moved to the same position at the reference frame.
+    :param drift: estimated (n, 2) drift in pixels
+    :param true_drift: simulated (n, 2) drift in pixels
+    :param reference: reference frame, default is the middle frame (as in MotionCor2)
+    :return: (n, 2) error and the root mean square distance in pixels
+    """
+    reference = len(drift) // 2 if reference is None else reference
+    error = (drift - drift[reference]) - (true_drift - true_drift[reference])
+    return error, np.sqrt(np.mean(np.sum(error ** 2, axis=1)))
+
+
+def aligned_sum(frames, drift, shape, weights=None, workers=1):
+    """
+    Average of the frames after correcting their drift, optionally dose weighted.
+    :param frames: iterable of 2D arrays in the order of the frames
+    :param drift: (n, 2) drift of every frame in pixels
+    :param shape: shape of a frame
+    :param weights: `DoseWeights` or None
+    """
+    def correct(n, ft):
+        ft *= phase_ramp(shape, -drift[n])
+        if weights is not None:
+            ft *= weights(n)
+        return ft
+
+    return sum_spectra(frames, correct, workers)[1]
+
+
+def main(dirs, pixel_size, dose, binning, coarse_binning, max_shift, bfactor, output_name, stack_name, image,
+         workers=1):
+    weights = None
+    errors = []
+    for micrograph_dir in dirs:
+        start = time.time()
+        n_frames, header_file, frames = movie_frames(micrograph_dir, stack_name, image)
+        shape, apix = frame_header(header_file, pixel_size)
+
+        drift = align(frames(), shape, apix, binning, coarse_binning, max_shift, bfactor, workers=workers)
+        elapsed = time.time() - start
+
+        columns = [np.arange(n_frames), drift[:, 0], drift[:, 1]]
+        header = 'frame\tx\ty'
+        drift_file = os.path.join(micrograph_dir, 'drift.txt')
+        if os.path.isfile(drift_file):
+            error, rmsd = alignment_error(drift, read_drift(drift_file, apix))
+            errors.append(rmsd)
+            columns += [error[:, 0], error[:, 1]]
+            header += '\terror_x\terror_y'
+            print('{}: {} frames aligned in {:.2f} s, RMSD to drift.txt {:.3f} px'.format(
+                micrograph_dir, n_frames, elapsed, rmsd))
+        else:
+            print('{}: {} frames aligned in {:.2f} s'.format(micrograph_dir, n_frames, elapsed))
+        np.savetxt(os.path.join(micrograph_dir, 'alignment.txt'), np.column_stack(columns), fmt='%.4f',
+                   delimiter='\t', header=header)
+
+        if dose is not None and (weights is None or (weights.shape, weights.pixel_size, len(weights.doses)) !=
+                                 (shape, apix, n_frames)):
+            weights = DoseWeights(shape, apix, dose_schedule(dose, n_frames))
+        write_mrc(os.path.join(micrograph_dir, output_name), aligned_sum(frames(), drift, shape, weights, workers), apix)
+
+    if errors:
+        print('Mean RMSD of {} micrographs: {:.3f} px'.format(len(errors), np.mean(errors)))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Align the frames of every micrograph by cross correlation, compare the '
+                                                 'drift with the simulated drift (drift.txt) and write the aligned average.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py, or a single micrograph directory')
+    parser.add_argument('--apix', type=float, default=None,
+                        help='Pixel size in A. Default is the pixel size in the header of the frames')
+    parser.add_argument('--dose', type=float, default=None,
+                        help='Total electron dose of a micrograph in e/A². If given, the aligned average is dose weighted')
+    parser.add_argument('--bin', type=float, default=2,
+                        help='Downsampling factor of the refinement. Default = 2')
+    parser.add_argument('--coarse_bin', type=float, default=8,
+                        help='Downsampling factor of the coarse alignment. Default = 8')
+    parser.add_argument('--max_shift', type=float, default=40,
+                        help='Maximal drift of a frame in pixels. Default = 40')
+    parser.add_argument('--bfactor', type=float, default=500,
+                        help='B-factor in A² used to band limit the cross correlations. Default = 500')
+    parser.add_argument('--o', type=str, default='average_aligned.mrc',
+                        help='File name of the aligned average in every micrograph directory. Default = average_aligned.mrc')
+    parser.add_argument('--stack', type=str, default='stack.mrcs',
+                        help='Frame stack written by assemble_frames.py. If it does not exist, the single frames are read. '
+                             'Default = stack.mrcs')
+    parser.add_argument('--image', type=str, default='with_noise',
+                        help='Frames to use if there is no frame stack: with_noise, no_noise or the name given to '
+                             'add_noise.py (frame_XX_<image>.mrc). Default = with_noise')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of frames processed in parallel. Default = 4')
+
+    args = parser.parse_args()
+
+    try:
+        main(micrograph_dirs(args.run_dir, args.stack), args.apix, args.dose, args.bin, args.coarse_bin, args.max_shift,
+             args.bfactor, args.o, args.stack, args.image, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,241 @@
+import glob
+import os
+import re
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import mrcfile
+
+from job_manifest import load_manifest, manifest_input_files
+from mrc_io import read_frame, is_complete
+from run_simulations import expected_outputs
+
+NO_NOISE = '_no_noise.mrc'
+
+
+def frame_files(micrograph_dir, image='with_noise'):
+    """
+    Simulated frames of a micrograph, in the order of the frames. The paths are read from the `input_frame_XX.txt`
+    files (or the job manifest of the run), if the directory contains input files, otherwise the directory is searched
+    for `frame_XX_<image>.mrc` files.
+    :param micrograph_dir: micrograph directory written by `gen_temsim_input_files.py`
+    :param image: 'with_noise', 'no_noise' or the name of frames written by `add_noise.py`
+    :return: list of paths to mrc files
+    """
+    suffix = '_{}.mrc'.format(image)
+    input_files = sorted(glob.glob(os.path.join(micrograph_dir, 'input_frame_*.txt'))) or \
+        manifest_input_files(micrograph_dir)
+    if input_files:
+        frames = []
+        for input_file in input_files:
+            # frames with noise added by add_noise.py are named after the noise free frame
+            frames += [o[:-len(NO_NOISE)] + suffix for o in expected_outputs(input_file) if o.endswith(NO_NOISE)]
+        return frames
+    return sorted(glob.glob(os.path.join(micrograph_dir, 'frame_*' + suffix)))
+
+
+def micrograph_dirs(run_dir, stack_name='stack.mrcs'):
+    """
+    Micrograph directories of a run. If `run_dir` is a micrograph directory itself, only this directory is returned.
+    """
+    if glob.glob(os.path.join(run_dir, 'input_*frame_*.txt')) or os.path.isfile(os.path.join(run_dir, stack_name)) \
+            or manifest_input_files(run_dir) or manifest_input_files(run_dir, 'keyframe'):
+        return [run_dir]
+    manifest = load_manifest(run_dir)
+    if manifest is not None:
+        return [manifest.micrograph_dir(m) for m in manifest.micrographs]
+    # micrographs of the approximate mode only have keyframe input files
+    return sorted(set(os.path.dirname(p) for p in glob.glob(os.path.join(run_dir, '*', 'input_*frame_00.txt'))))
+
+
+def parse_window(text):
+    """
+    Parse a frame window 'first:last', e.g. '2:0' to skip the first two frames.
+    :return: tuple with the number of frames skipped at the start and at the end
+    """
+    match = re.fullmatch(r'(\d+)(?::(\d+))?', text)
+    if match is None:
+        raise ValueError('invalid frame window: {}, use FIRST:LAST'.format(text))
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+def average_name(window):
+    """
+    File name of the average of a frame window, e.g. `average.mrc`, `average_throw2.mrc` or `average_throw2_1.mrc`.
+    """
+    first, last = window
+    if first == 0 and last == 0:
+        return 'average.mrc'
+    if last == 0:
+        return 'average_throw{}.mrc'.format(first)
+    return 'average_throw{}_{}.mrc'.format(first, last)
+
+
+class FrameStack:
+    """
+    Frame stack (.mrcs) that is written frame by frame into a memory-mapped file. For every requested frame window
+    a running float64 sum is kept, so the averages are available without reading the stack again.
+    Frames can be added in any order.
+    """
+
+    def __init__(self, path, n_frames, shape, windows=((0, 0),), voxel_size=None):
+        """
+        :param path: output stack
+        :param n_frames: number of frames
+        :param shape: shape of a single frame (ny, nx)
+        :param windows: list of (first, last) tuples with the number of frames to skip at the start and end
+        :param voxel_size: pixel size in A, written to the header
+        """
+        self.n_frames = n_frames
+        self.windows = [tuple(w) for w in windows]
+        for first, last in self.windows:
+            if first + last >= n_frames:
+                raise ValueError('frame window {}:{} leaves no frames of {}'.format(first, last, n_frames))
+        self.sums = {w: np.zeros(shape, dtype=np.float64) for w in self.windows}
+        self.added = np.zeros(n_frames, dtype=bool)
+        self.mrc = mrcfile.new_mmap(path, shape=(n_frames,) + tuple(shape), mrc_mode=2, overwrite=True)
+        self.mrc.set_image_stack()
+        if voxel_size is not None:
+            self.mrc.voxel_size = voxel_size
+
+    def add(self, n, frame):
+        """
+        Write frame number `n` to the stack and add it to the sums of the windows it belongs to.
+        """
+        if self.added[n]:
+            raise ValueError('frame {} was already added'.format(n))
+        self.mrc.data[n] = frame
+        for (first, last), total in self.sums.items():
+            if first <= n < self.n_frames - last:
+                total += frame
+        self.added[n] = True
+
+    def average(self, window=(0, 0)):
+        first, last = window
+        if not self.added[first:self.n_frames - last].all():
+            raise ValueError('not all frames of window {}:{} were added'.format(first, last))
+        return (self.sums[tuple(window)] / (self.n_frames - first - last)).astype(np.float32)
+
+    def close(self):
+        self.mrc.update_header_stats()
+        self.mrc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_mrc(path, data, voxel_size=None):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(data)
+        if voxel_size is not None:
+            mrc.voxel_size = voxel_size
+
+
+def assemble(micrograph_dir, windows=((0, 0),), image='with_noise', stack_name='stack.mrcs', wait=0, poll=10):
+    """
+    Write the frame stack and the averages of a micrograph. Frames are added as soon as they are complete, so
+    the stack can be assembled while the simulations are still running.
+    :param micrograph_dir: micrograph directory written by `gen_temsim_input_files.py`
+    :param windows: list of (first, last) frame windows to average
+    :param image: 'with_noise' or 'no_noise'
+    :param stack_name: file name of the stack in the micrograph directory
+    :param wait: maximal time in seconds to wait for missing frames
+    :param poll: time in seconds between checks for missing frames
+    :return: micrograph directory and the time needed
+    """
+    start = time.time()
+    frames = frame_files(micrograph_dir, image)
+    if not frames:
+        raise FileNotFoundError('no frames found in {}'.format(micrograph_dir))
+
+    stack = None
+    missing = list(range(len(frames)))
+    try:
+        while missing:
+            for n in [n for n in missing if is_complete(frames[n])]:
+                frame = read_frame(frames[n], 0)
+                if stack is None:
+                    with mrcfile.open(frames[n], permissive=True, header_only=True) as mrc:
+                        voxel_size = mrc.voxel_size.copy()
+                    stack = FrameStack(os.path.join(micrograph_dir, stack_name), len(frames), frame.shape, windows,
+                                       voxel_size)
+                stack.add(n, frame)
+                missing.remove(n)
+            if missing:
+                if time.time() - start >= wait:
+                    raise FileNotFoundError('{} of {} frames missing in {}, e.g. {}'.format(
+                        len(missing), len(frames), micrograph_dir, frames[missing[0]]))
+                time.sleep(poll)
+
+        for window in stack.windows:
+            write_mrc(os.path.join(micrograph_dir, average_name(window)), stack.average(window), voxel_size)
+    finally:
+        if stack is not None:
+            stack.close()
+    return micrograph_dir, time.time() - start
+
+
+def _assemble(job):
+    micrograph_dir, kwargs = job
+    try:
+        return assemble(micrograph_dir, **kwargs) + (None,)
+    except (OSError, ValueError) as e:
+        return micrograph_dir, 0, str(e)
+
+
+def main(micrograph_dirs, windows, image, stack_name, wait, poll, workers=1):
+    jobs = [(d, dict(windows=windows, image=image, stack_name=stack_name, wait=wait, poll=poll))
+            for d in micrograph_dirs]
+    failed = 0
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(_assemble, jobs) if pool is not None else map(_assemble, jobs)
+        for n, (micrograph_dir, elapsed, error) in enumerate(results, 1):
+            if error is None:
+                print('[{}/{}] {} ({:.2f} s)'.format(n, len(jobs), micrograph_dir, elapsed))
+            else:
+                failed += 1
+                print('[{}/{}] {} failed: {}'.format(n, len(jobs), micrograph_dir, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Assemble the simulated frames of every micrograph into a frame stack '
+                                                 '(stack.mrcs) and write averages of the frames.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py, or a single micrograph directory')
+    parser.add_argument('--average', type=str, nargs='+', default=['0:0'],
+                        help='Frame windows to average, FIRST:LAST skips the first FIRST and the last LAST frames. '
+                             'E.g. --average 0:0 2:0 writes average.mrc and average_throw2.mrc. Default = 0:0')
+    parser.add_argument('--image', type=str, default='with_noise',
+                        help='Frames to assemble: with_noise, no_noise or the name given to add_noise.py '
+                             '(frame_XX_<image>.mrc). Default = with_noise')
+    parser.add_argument('--stack', type=str, default='stack.mrcs',
+                        help='File name of the frame stack in every micrograph directory. Default = stack.mrcs')
+    parser.add_argument('--wait', type=float, default=0,
+                        help='Wait up to this number of seconds for frames that are not simulated yet. Default = 0')
+    parser.add_argument('--poll', type=float, default=10,
+                        help='Time in seconds between checks for missing frames. Default = 10')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of micrographs processed in parallel. Default = 1')
+
+    args = parser.parse_args()
+
+    dirs = micrograph_dirs(args.run_dir, args.stack)
+    try:
+        windows = [parse_window(w) for w in args.average]
+    except ValueError as e:
+        parser.error(str(e))
+    sys.exit(1 if main(dirs, windows, args.image, args.stack, args.wait, args.poll, args.workers) else 0)
@@ -1,6 +1,11 @@
 import numpy as np
 import mrcfile
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+from exposure import critical_exposure, damage_filter
+from instrument import span
 
 
 def frequencies(array):
@@ -11,21 +16,96 @@ def frequencies(array):
     meshgrids = np.meshgrid(*[np.fft.fftfreq(i) for i in array.shape], indexing='ij')
     return np.sqrt(np.sum([i**2 for i in meshgrids], axis=0))
 
-def damage_filter(k, N):
+def rfft_frequencies(shape, dtype=np.float64):
+    """
+    Creates a frequency map for the half spectrum returned by `np.fft.rfftn` of a real array with the given shape.
+    The frequency units are in spacial frequency units. (i.e. nyquist = 0.5)
+    """
+    axes = [np.fft.fftfreq(n).astype(dtype) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1]).astype(dtype)]
+    squared = np.zeros(tuple(len(a) for a in axes), dtype=dtype)
+    for grid in np.ix_(*axes):
+        squared += grid ** 2
+    return np.sqrt(squared, out=squared)
+
+def dose_schedule(dose, n_frames):
+    """
+    Cumulative electron exposure at the start of every frame, the first frame has no exposure.
+    :param dose: total dose in e/A²
+    :param n_frames: number of frames
+    :return: array with the cumulative dose of every frame in e/A²
+    """
+    dose_per_frame = dose / n_frames
+    return np.append(0, np.cumsum(np.repeat(dose_per_frame, n_frames-1)))
+
+def exposure_term(shape, voxel_size, dtype=np.float32):
+    """
+    Dose independent part of the damage filter on the half spectrum of a map, -1 / (2 * Ne(k)).
+    It is computed once, the frequency mask for a cumulative dose N is then `np.exp(N * term)`.
+    :param shape: shape of the real map
+    :param voxel_size: voxel size in A
+    :return: array with the shape of the half spectrum
+    """
+    freq_A = rfft_frequencies(shape, dtype)
+    freq_A /= voxel_size
+    with np.errstate(divide='ignore'):
+        # the zero frequency has an infinite critical exposure and is never attenuated
+        term = -0.5 / critical_exposure(freq_A)
+    return term.astype(dtype, copy=False)
+
+def prepare_map(map_in, factor, padding=10, dtype=np.float32):
+    """
+    Read the map, set the background to 0, pad it and compute its half spectrum.
+    :param map_in: input density map (.mrc)
+    :param factor: reduce the intensity of the scattering potential by this factor
+    :param padding: number of voxels added around the map
+    :return: half spectrum of the padded map, shape of the padded map and background potential
     """
-    Dose dependent frequency filter.
-    Grant, Timothy and Grigorieff, Nikolaus: Measuring the optimal exposure for single particle cryo-EM using a 2.6 Å reconstruction of rotavirus VP6
-    :param k: spacial frequency in 1/A
+    with span('read_map', path=map_in):
+        with mrcfile.open(map_in, permissive=True) as mrc:
+            background_potential = mrc.data.min()
+            # set background values to 0
+            ary = mrc.data.astype(dtype) - background_potential
+    # apply padding to not cot through filtered result
+    padded_map = np.pad(ary, padding, 'constant', constant_values=0)
+    del ary
+    # lower the scattering potential to match the particle intensity in real images
+    padded_map /= factor
+    # fourier transform the image to apply damage filter
+    complex_dtype = np.result_type(dtype, np.complex64)
+    with span('fft', shape=padded_map.shape):
+        ft_padded_map = np.fft.rfftn(padded_map).astype(complex_dtype, copy=False)
+    return ft_padded_map, padded_map.shape, background_potential
+
+def filter_map(ft_map, term, N, shape):
+    """
+    Apply the damage filter for the cumulative dose N on the half spectrum of a map.
+    :param ft_map: half spectrum of the map, see `prepare_map`
+    :param term: dose independent part of the filter, see `exposure_term`
     :param N: cumulative electron exposure in e/A²
-    :return: attenuated frequency
+    :param shape: shape of the real map
+    :return: filtered map in real space
     """
-    return np.exp(-N / (2 * (0.245 * np.power(k, -1.665) + 2.81)))
+    # create frequency mask
+    frequency_mask = np.exp(term * term.dtype.type(N))
+    # attenuate the fourier frequencies of the map
+    return np.fft.irfftn(ft_map * frequency_mask, s=shape, axes=range(len(shape)))
+
+def write_filtered_map(ft_map, term, N, shape, background_potential, output_map_name):
+    with span('filter', dose=float(N)):
+        filtered_map = filter_map(ft_map, term, N, shape)
+    # add back the background potential to the map
+    filtered_map += background_potential
+
+    with span('write_map', path=output_map_name):
+        with mrcfile.new(output_map_name, overwrite=True) as new_mrc:
+            new_mrc.set_data(filtered_map.astype(np.float32))
+            new_mrc.flush()
+    return output_map_name
 
-def main(map_in, output_dir, voxel_size, dose, n_frames, factor):
+def main(map_in, output_dir, voxel_size, dose, n_frames, factor, workers=1, double=False):
 
     # determine the electron dose at which we have to filter
-    dose_per_frame = dose / n_frames
-    dose_array = np.append(0, np.cumsum(np.repeat(dose_per_frame, n_frames-1)))
+    dose_array = dose_schedule(dose, n_frames)
 
     print('Input map:', map_in)
     print('Output folder:', os.path.abspath(output_dir))
@@ -38,35 +118,24 @@ def main(map_in, output_dir, voxel_size, dose, n_frames, factor):
 
     os.makedirs(output_dir, exist_ok=True)
 
-    # open map an fourier transform it
-    mrc = mrcfile.open(map_in, permissive=True)
-    background_potential = mrc.data.min()
-    # set background values to 0
-    ary = mrc.data - background_potential
-    # apply padding to not cot through filtered result
-    padded_map = np.pad(ary, 10, 'constant', constant_values=0)
-    # lower the scattering potential to match the particle intensity in real images
-    padded_map /= factor
-    # fourier transform the image to apply damage filter
-    ft_padded_map = np.fft.fftn(padded_map)
-    # get frequencies in unit 1/A to create the filter
-    freq = frequencies(padded_map)
-    freq_A = freq / voxel_size
+    with span('create_filtered_maps', maps=len(dose_array), workers=workers):
+        dtype = np.float64 if double else np.float32
+        with span('prepare_map'):
+            ft_padded_map, shape, background_potential = prepare_map(map_in, factor, dtype=dtype)
+        # the frequency dependent part of the filter is the same for all doses
+        with span('exposure_term'):
+            term = exposure_term(shape, voxel_size, dtype)
 
+        def task(N):
+            output_map_name = os.path.join(output_dir, "filt_{:5.3f}.mrc".format(N))
+            write_filtered_map(ft_padded_map, term, N, shape, background_potential, output_map_name)
+            return N
 
-    for N in dose_array:
-        output_map_name = os.path.join(output_dir, "filt_{:5.3f}.mrc".format(N))
-        # create frequency mask
-        frequency_mask = damage_filter(freq_A, N)
-        # attenuate the fourier frequencies of the map
-        filtered_map = np.real(np.fft.ifftn(ft_padded_map * frequency_mask))
-        # add back the background potential to the map
-        filtered_map += background_potential
-
-        with mrcfile.new(output_map_name, overwrite=True) as new_mrc:
-            new_mrc.set_data(filtered_map.astype(np.float32))
-            new_mrc.flush()
-        print("Created damage filtered map with a cumulative dose of {:5.3f} e/A²".format(N))
+        # the inverse transforms run concurrently, at most `workers` filtered maps are in memory at the same time
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(dose_array), workers):
+                for N in executor.map(task, dose_array[i:i + workers]):
+                    print("Created damage filtered map with a cumulative dose of {:5.3f} e/A²".format(N))
 
 
 if __name__ == '__main__':
@@ -88,11 +157,22 @@ if __name__ == '__main__':
                         help='Reduce the intensity of the scattering potential by this factor')
 
 
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of filtered maps that are computed concurrently. Default = 1')
+    parser.add_argument('--double', action='store_true', default=False,
+                        help='Compute the filtered maps in double precision. Default is single precision')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Write the time, peak memory and bytes read/written of every stage as json lines to this '
+                             'file (see instrument.py). Default is $TEMSIM_TRACE or no trace')
+
     args = parser.parse_args()
+    instrument.enable(args.trace)
 
     main(map_in=args.input_map,
          output_dir=args.output_dir,
          voxel_size=args.voxelsize,
          dose=args.dose,
          n_frames=args.nf,
-         factor=args.factor)
+         factor=args.factor,
+         workers=args.workers,
+         double=args.double)
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import mrcfile
+
+from add_noise import detect, frame_rng
+from align_frames import phase_ramp, read_drift
+from assemble_frames import micrograph_dirs, write_mrc
+from create_filtered_maps import rfft_frequencies
+from exposure import damage_filter
+from gen_temsim_input_files import KEYFRAMES_FILE
+from mrc_io import is_complete, read_frame
+
+KEYFRAME = 'keyframe_{:02d}_no_noise.mrc'
+FRAME = 'frame_{:02d}_{}.mrc'
+
+
+def derive_frame(keyframe_ft, frequencies, dose, shape, drift=None):
+    """
+    Approximate a noise free frame from the noise free image of a keyframe with a lower dose. The additional radiation
+    damage is applied with the damage filter on the 2D spectrum of the image and the drift as a Fourier shift of the
+    whole frame. Both are approximations: the damage filter acts on the scattering potential, not on the image, and
+    the Fourier shift is periodic at the frame borders.
+    :param keyframe_ft: half spectrum of the keyframe (`np.fft.rfft2`)
+    :param frequencies: spatial frequencies of the half spectrum in 1/A
+    :param dose: dose difference between the frame and the keyframe in e/A²
+    :param shape: shape of the frame
+    :param drift: (x, y) position of the frame in pixels, None for no drift
+    :return: noise free frame as float32 array
+    """
+    with np.errstate(divide='ignore'):
+        ft = keyframe_ft * damage_filter(frequencies, dose).astype(np.float32)
+    if drift is not None:
+        ft *= phase_ramp(shape, drift)
+    return np.fft.irfft2(ft, s=shape).astype(np.float32)
+
+
+def compare(derived, exact):
+    """
+    Error of a derived frame relative to the contrast of the exact frame and the correlation of both frames.
+    """
+    exact = exact.astype(np.float64)
+    derived = derived.astype(np.float64)
+    contrast = exact - exact.mean()
+    rel_error = np.sqrt(np.mean((derived - exact) ** 2) / np.mean(contrast ** 2))
+    correlation = np.corrcoef(derived.ravel(), exact.ravel())[0, 1]
+    return rel_error, correlation
+
+
+def derive_micrograph(micrograph_dir, root_seed, name='with_noise', noise=True):
+    """
+    Derive all frames of a micrograph of the approximate mode from its keyframes. Every frame is derived from the
+    last keyframe before it. Noise free frames are written to `frame_XX_no_noise.mrc`, frames with shot noise to
+    `frame_XX_<name>.mrc`. If the exact noise free frames were simulated for validation, they are kept, compared with
+    the derived frames and used for the frames with noise, so both outputs of a frame come from the same image. Exact
+    frames that are missing or incomplete are reported as missing and replaced by the derived frames.
+    :return: list of dictionaries with the validation results of every frame
+    """
+    with open(os.path.join(micrograph_dir, KEYFRAMES_FILE)) as f:
+        settings = json.load(f)
+    keyframes = settings['keyframes']
+    doses = settings['doses']
+    pixel_size = settings['pixel_size']
+
+    spectra = {}
+    for k in keyframes:
+        image = read_frame(os.path.join(micrograph_dir, KEYFRAME.format(k)), 0)
+        spectra[k] = np.fft.rfft2(image.astype(np.float32))
+    shape = image.shape
+    with mrcfile.open(os.path.join(micrograph_dir, KEYFRAME.format(keyframes[0])), permissive=True,
+                      header_only=True) as mrc:
+        voxel_size = mrc.voxel_size.copy()
+    frequencies = rfft_frequencies(shape, np.float32) / np.float32(pixel_size)  # 1/A
+    drift = read_drift(os.path.join(micrograph_dir, 'drift.txt'), pixel_size) if settings['drift'] else None
+
+    results = []
+    for n in range(settings['n_frames']):
+        k = max(i for i in keyframes if i <= n)
+        frame = derive_frame(spectra[k], frequencies, doses[n] - doses[k], shape, None if drift is None else drift[n])
+
+        no_noise = os.path.join(micrograph_dir, FRAME.format(n, 'no_noise'))
+        exact = None
+        if settings.get('exact', os.path.isfile(os.path.join(micrograph_dir, 'input_frame_{:02d}.txt'.format(n)))):
+            # exact frame simulated for validation
+            rel_error, correlation = np.nan, np.nan
+            if is_complete(no_noise):
+                exact = read_frame(no_noise, 0)
+                rel_error, correlation = compare(frame, exact)
+            results.append({'micrograph': os.path.basename(micrograph_dir), 'frame': n, 'keyframe': k,
+                            'dose': doses[n] - doses[k], 'rel_error': rel_error, 'correlation': correlation,
+                            'missing': exact is None})
+        if exact is None:
+            write_mrc(no_noise, frame, voxel_size)
+        else:
+            frame = exact
+        if noise:
+            write_mrc(os.path.join(micrograph_dir, FRAME.format(n, name)),
+                      detect(frame, frame_rng(root_seed, micrograph_dir, n)), voxel_size)
+    return results
+
+
+def _derive(job):
+    micrograph_dir, root_seed, name, noise = job
+    start = time.time()
+    return micrograph_dir, derive_micrograph(micrograph_dir, root_seed, name, noise), \
+        time.time() - start
+
+
+def main(dirs, seed, name='with_noise', noise=True, report=None, workers=1):
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0] >> 1)
+    print('Random seed:', seed)
+
+    jobs = [(d, seed, name, noise) for d in dirs if os.path.isfile(os.path.join(d, KEYFRAMES_FILE))]
+    results = []
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        derived = pool.imap_unordered(_derive, jobs) if pool is not None else map(_derive, jobs)
+        for n, (micrograph_dir, validation, elapsed) in enumerate(derived, 1):
+            results += validation
+            print('[{}/{}] {} ({:.2f} s)'.format(n, len(jobs), micrograph_dir, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if results:
+        validation = pd.DataFrame(results).sort_values(['micrograph', 'frame'])
+        compared = validation[~validation['missing']]
+        print('Validation against {} exact frames of {} micrographs:'.format(len(compared),
+                                                                            compared['micrograph'].nunique()))
+        if not compared.empty:
+            print('    relative error: mean {:.4f}, max {:.4f}'.format(compared['rel_error'].mean(),
+                                                                      compared['rel_error'].max()))
+            print('    correlation:    mean {:.4f}, min {:.4f}'.format(compared['correlation'].mean(),
+                                                                      compared['correlation'].min()))
+        if validation['missing'].any():
+            print('    {} exact frames are missing or incomplete'.format(int(validation['missing'].sum())))
+        if report is not None:
+            validation.to_csv(report, index=False)
+            print('Validation of every frame written to', report)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Derive the frames of the approximate mode of gen_temsim_input_files.py '
+                                                 '(--keyframes) from the simulated keyframes: additional radiation damage '
+                                                 'with the damage filter in 2D, drift as Fourier shift and shot noise. '
+                                                 'Derived frames of micrographs that were simulated exactly (--validate) '
+                                                 'are compared with the exact frames.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py, or a single micrograph directory')
+    parser.add_argument('--name', type=str, default='with_noise',
+                        help='Name of the frames with shot noise, frame_XX_<name>.mrc. Default = with_noise')
+    parser.add_argument('--no_noise', action='store_true', default=False,
+                        help='Only derive the noise free frames, e.g. to add noise later with add_noise.py')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Root random seed of the shot noise. Default is a random seed')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Csv file for the validation of every exact frame. Default = validation.csv in the run directory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of micrographs processed in parallel. Default = 1')
+
+    args = parser.parse_args()
+
+    report = args.report if args.report is not None else os.path.join(args.run_dir, 'validation.csv')
+    main(micrograph_dirs(args.run_dir), args.seed, args.name, not args.no_noise, report, args.workers)
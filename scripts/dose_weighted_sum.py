@@ -0,0 +1,186 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mrcfile
+
+from assemble_frames import frame_files, micrograph_dirs, write_mrc
+from create_filtered_maps import dose_schedule, rfft_frequencies
+from exposure import damage_filter
+from mrc_io import iter_frames, read_frame
+
+
+class DoseWeights:
+    """
+    Dose weights of the frames of a movie on the half spectrum of a frame (`np.fft.rfft2` layout).
+    The weight of a frame is the damage filter (`exposure.damage_filter`) at its cumulative dose. The weights are
+    normalized for every frequency, so that the sum of the squared weights of all frames is the number of frames. The
+    zero frequency is not attenuated, so the mean of the weighted sum is the mean of the plain average.
+    Only the spatial frequencies and the normalization are stored, the weights of a frame are computed when needed.
+    """
+
+    def __init__(self, shape, pixel_size, doses):
+        """
+        :param shape: shape of a frame (ny, nx)
+        :param pixel_size: pixel size in A
+        :param doses: cumulative dose of every frame in e/A², see `dose_schedule`
+        """
+        self.shape = tuple(shape)
+        self.pixel_size = pixel_size
+        self.doses = np.asarray(doses, dtype=np.float64)
+        self.frequencies = rfft_frequencies(shape, np.float32) / np.float32(pixel_size)  # 1/A
+        squared = np.zeros(self.frequencies.shape, dtype=np.float64)
+        for n in range(len(self.doses)):
+            squared += self._filter(n) ** 2
+        self.norm = np.sqrt(len(self.doses) / squared).astype(np.float32)
+
+    def _filter(self, n):
+        with np.errstate(divide='ignore'):
+            # the zero frequency has an infinite critical exposure and is never attenuated
+            return damage_filter(self.frequencies, np.float32(self.doses[n])).astype(np.float32, copy=False)
+
+    def __call__(self, n):
+        """
+        Normalized weights of frame n.
+        """
+        weights = self._filter(n)
+        weights *= self.norm
+        return weights
+
+
+def sum_spectra(frames, transform, workers=1):
+    """
+    Average of the frames of a movie after a transformation in Fourier space. Frames are Fourier transformed in
+    batches of `workers` frames on a thread pool and the transformed spectra are summed up, so only a few frames are
+    in memory at the same time.
+    :param frames: iterable of 2D arrays in the order of the frames, e.g. `iter_frames`
+    :param transform: function (frame number, half spectrum) -> half spectrum, may modify the spectrum in place
+    :param workers: number of frames transformed in parallel
+    :return: number of frames and the average as float32 array
+    """
+    total = None
+    shape = None
+    n_frames = 0
+
+    def spectrum(job):
+        n, frame = job
+        return transform(n, np.fft.rfft2(frame.astype(np.float32)))
+
+    def add(batch, total):
+        for ft in executor.map(spectrum, batch):
+            total = ft.astype(np.complex128) if total is None else np.add(total, ft, out=total)
+        return total
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for n, frame in enumerate(frames):
+            shape = frame.shape
+            batch.append((n, frame))
+            n_frames += 1
+            if len(batch) == workers:
+                total = add(batch, total)
+                batch = []
+        total = add(batch, total)
+
+    if total is None:
+        raise ValueError('no frames')
+    total /= n_frames
+    return n_frames, np.fft.irfft2(total, s=shape).astype(np.float32)
+
+
+def dose_weighted_sum(frames, weights, workers=1):
+    """
+    Dose weighted average of the frames of a movie, see `sum_spectra`.
+    :param frames: iterable of 2D arrays in the order of the frames, e.g. `iter_frames`
+    :param weights: `DoseWeights` for the frames
+    :param workers: number of frames transformed in parallel
+    :return: dose weighted average as float32 array
+    """
+    def weight(n, ft):
+        ft *= weights(n)
+        return ft
+
+    n_frames, average = sum_spectra(frames, weight, workers)
+    if n_frames != len(weights.doses):
+        raise ValueError('{} frames, but the dose schedule has {} frames'.format(n_frames, len(weights.doses)))
+    return average
+
+
+def movie_frames(micrograph_dir, stack_name='stack.mrcs', image='with_noise'):
+    """
+    Source of the frames of a micrograph: the frame stack if it exists, otherwise the single frame files.
+    :return: number of frames, path to a file with the pixel size and a function that returns an iterator over the frames
+    """
+    stack = os.path.join(micrograph_dir, stack_name)
+    if os.path.isfile(stack):
+        with mrcfile.mmap(stack, mode='r', permissive=True) as mrc:
+            n = 1 if mrc.data.ndim == 2 else mrc.data.shape[0]
+        return n, stack, lambda: iter_frames(stack)
+    files = frame_files(micrograph_dir, image)
+    if not files:
+        raise FileNotFoundError('no frames found in {}'.format(micrograph_dir))
+    return len(files), files[0], lambda: (read_frame(f, 0) for f in files)
+
+
+def frame_header(path, pixel_size=None):
+    """
+    Shape and pixel size of the frames of a movie.
+    :param path: frame stack or frame
+    :param pixel_size: pixel size in A, default is the pixel size in the header
+    :return: shape of a frame (ny, nx) and the pixel size in A
+    """
+    with mrcfile.open(path, permissive=True, header_only=True) as mrc:
+        shape = (int(mrc.header.ny), int(mrc.header.nx))
+        if pixel_size is None:
+            pixel_size = float(mrc.voxel_size.x)
+    if pixel_size <= 0:
+        raise ValueError('no pixel size in the header of {}, use --apix'.format(path))
+    return shape, pixel_size
+
+
+def main(micrograph_dirs, dose, pixel_size, output_name, stack_name, image, workers=1):
+    weights = None
+    for micrograph_dir in micrograph_dirs:
+        start = time.time()
+        n_frames, header_file, frames = movie_frames(micrograph_dir, stack_name, image)
+        shape, apix = frame_header(header_file, pixel_size)
+
+        # the weights are the same for all micrographs of a run
+        if weights is None or (weights.shape, weights.pixel_size, len(weights.doses)) != (shape, apix, n_frames):
+            weights = DoseWeights(shape, apix, dose_schedule(dose, n_frames))
+
+        average = dose_weighted_sum(frames(), weights, workers)
+        output = os.path.join(micrograph_dir, output_name)
+        write_mrc(output, average, apix)
+        print('{} ({} frames, {:.2f} s)'.format(output, n_frames, time.time() - start))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Dose weighted average of the frames of every micrograph. Every frame is '
+                                                 'weighted in Fourier space with the damage filter at its cumulative dose.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py, or a single micrograph directory')
+    parser.add_argument('--dose', type=float, required=True,
+                        help='Total electron dose of a micrograph in e/A², the same as for gen_temsim_input_files.py')
+    parser.add_argument('--apix', type=float, default=None,
+                        help='Pixel size in A. Default is the pixel size in the header of the frames')
+    parser.add_argument('--o', type=str, default='average_dw.mrc',
+                        help='File name of the output micrograph in every micrograph directory. Default = average_dw.mrc')
+    parser.add_argument('--stack', type=str, default='stack.mrcs',
+                        help='Frame stack written by assemble_frames.py. If it does not exist, the single frames are read. '
+                             'Default = stack.mrcs')
+    parser.add_argument('--image', type=str, default='with_noise',
+                        help='Frames to use if there is no frame stack: with_noise, no_noise or the name given to '
+                             'add_noise.py (frame_XX_<image>.mrc). Default = with_noise')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of frames that are Fourier transformed in parallel. Default = 4')
+
+    args = parser.parse_args()
+
+    try:
+        main(micrograph_dirs(args.run_dir, args.stack), args.dose, args.apix, args.o, args.stack, args.image, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,151 @@
+import inspect
+import math
+import os
+from string import Template
+
+import numpy as np
+
+error_file_template = Template("""1  5
+#            rho             alpha             tau           x         y
+             0               0                 0             ${x}      ${y}
+""")
+
+
+def exponential_drift(rng, n_micrographs, n_frames, max_drift_dist=1, decay_dist_variance=-0.1,
+                      max_angle_variance=math.pi / 4, decay_angle_variance=-0.4):
+    """
+    Beam induced movement: the drift distance between frames exponentially drops off, the drift angle is dependent on
+    the previous drift angle and the angular variation also drops off exponentially.
+    :param max_drift_dist: maximal drift between the first two frames in nm
+    :return: array (n_micrographs, n_frames, 2) with the x and y position of the frame centers in nm
+    """
+    steps = np.arange(n_frames - 1)
+    angle_variance = np.exp(decay_angle_variance * steps) * max_angle_variance
+    initial_angle = rng.random(n_micrographs) * math.pi * 2
+    angles = initial_angle[:, None] + np.cumsum(rng.uniform(-1, 1, (n_micrographs, n_frames - 1)) * angle_variance,
+                                                axis=1)
+    distances = rng.random((n_micrographs, n_frames - 1)) * np.exp(decay_dist_variance * steps) * max_drift_dist
+    return _positions(np.stack([np.cos(angles) * distances, np.sin(angles) * distances], axis=-1))
+
+
+def linear_drift(rng, n_micrographs, n_frames, max_speed=0.5, jitter=0.05):
+    """
+    Constant stage drift in a random direction with random jitter of every frame.
+    :param max_speed: maximal drift speed in nm per frame
+    :param jitter: standard deviation of the jitter in nm
+    :return: array (n_micrographs, n_frames, 2) with the x and y position of the frame centers in nm
+    """
+    angle = rng.random(n_micrographs) * math.pi * 2
+    speed = rng.random(n_micrographs) * max_speed
+    velocity = np.stack([np.cos(angle) * speed, np.sin(angle) * speed], axis=-1)
+    positions = np.arange(n_frames)[None, :, None] * velocity[:, None, :]
+    positions += rng.normal(0, jitter, positions.shape)
+    return positions - positions[:, :1]
+
+
+def settling_drift(rng, n_micrographs, n_frames, max_drift_dist=3, time_constant=3, jitter=0.02):
+    """
+    Stage settling after a movement: the stage moves in a random direction and slows down exponentially.
+    :param max_drift_dist: maximal total drift in nm
+    :param time_constant: number of frames after which the remaining drift dropped to 1/e
+    :param jitter: standard deviation of the jitter in nm
+    :return: array (n_micrographs, n_frames, 2) with the x and y position of the frame centers in nm
+    """
+    angle = rng.random(n_micrographs) * math.pi * 2
+    distance = rng.random(n_micrographs) * max_drift_dist
+    direction = np.stack([np.cos(angle) * distance, np.sin(angle) * distance], axis=-1)
+    settled = 1 - np.exp(-np.arange(n_frames) / time_constant)
+    positions = settled[None, :, None] * direction[:, None, :]
+    positions += rng.normal(0, jitter, positions.shape)
+    return positions - positions[:, :1]
+
+
+def _positions(steps):
+    # the first frame is at the origin
+    positions = np.zeros((steps.shape[0], steps.shape[1] + 1, 2))
+    np.cumsum(steps, axis=1, out=positions[:, 1:])
+    return positions
+
+
+DRIFT_MODELS = {
+    'exponential': exponential_drift,
+    'linear': linear_drift,
+    'settling': settling_drift,
+}
+
+
+def drift_parameters(model):
+    """
+    Names of the parameters of a drift model.
+    """
+    if model not in DRIFT_MODELS:
+        raise ValueError('unknown drift model {}, use one of {}'.format(model, ', '.join(DRIFT_MODELS)))
+    return list(inspect.signature(DRIFT_MODELS[model]).parameters)[3:]
+
+
+def _check_parameters(model, names):
+    valid = drift_parameters(model)
+    unknown = [n for n in names if n not in valid]
+    if unknown:
+        raise ValueError('unknown parameter {} of the {} drift model, use {}'.format(', '.join(unknown), model,
+                                                                                     ', '.join(valid)))
+
+
+def generate_drift(model, n_micrographs, n_frames, rng=None, **params):
+    """
+    Drift trajectories of many micrographs at once.
+    :param model: name of the drift model, see `DRIFT_MODELS`
+    :param rng: numpy.random.Generator, default is a new unseeded generator
+    :param params: parameters of the drift model
+    :return: array (n_micrographs, n_frames, 2) with the x and y position of the frame centers in nm
+    """
+    _check_parameters(model, params)
+    if rng is None:
+        rng = np.random.default_rng()
+    return DRIFT_MODELS[model](rng, n_micrographs, n_frames, **params)
+
+
+def parse_drift_params(params, model='exponential'):
+    """
+    Parse drift model parameters given as NAME=VALUE strings.
+    :param model: drift model, the names are checked against its parameters
+    """
+    parsed = {}
+    for param in params or []:
+        name, _, value = param.partition('=')
+        try:
+            parsed[name] = float(value)
+        except ValueError:
+            raise ValueError('invalid drift parameter {}, use NAME=VALUE'.format(param))
+    _check_parameters(model, parsed)
+    return parsed
+
+
+def write_drift(output_dir, trajectory, error_files=True):
+    """
+    Write the drift of a micrograph: `drift.txt` with the positions of all frames and a TEM-Simulator geometry error
+    file `error_frame_XX.txt` for every frame.
+    :param output_dir: micrograph directory
+    :param trajectory: array (n_frames, 2) with the x and y position of the frame centers in nm
+    :param error_files: write the error files, otherwise only `drift.txt`
+    """
+    positions = np.asarray(trajectory).tolist()
+    with open(os.path.join(output_dir, "drift.txt"), "w") as f:
+        f.write("\n".join(["{}\t{}".format(x, y) for x, y in positions]))
+    if not error_files:
+        return
+    for n, (x, y) in enumerate(positions):
+        with open(os.path.join(output_dir, "error_frame_{}.txt".format(str(n).zfill(2))), "w") as f:
+            f.write(error_file_template.substitute(x=x, y=y))
+
+
+def write_drift_files(output_dirs, trajectories, error_files=True):
+    """
+    Write the drift files of many micrographs.
+    :param output_dirs: list of micrograph directories
+    :param trajectories: array (n_micrographs, n_frames, 2), see `generate_drift`
+    :param error_files: write the error files of every frame, otherwise only `drift.txt`
+    """
+    for output_dir, trajectory in zip(output_dirs, trajectories):
+        os.makedirs(output_dir, exist_ok=True)
+        write_drift(output_dir, trajectory, error_files)
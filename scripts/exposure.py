@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def critical_exposure(k):
+    """
+    Critical exposure (e/A²) at which the signal of spacial frequency k is attenuated.
+    Grant, Timothy and Grigorieff, Nikolaus: Measuring the optimal exposure for single particle cryo-EM using a 2.6 Å reconstruction of rotavirus VP6
+    :param k: spacial frequency in 1/A
+    :return: critical exposure in e/A²
+    """
+    return 0.245 * np.power(k, -1.665) + 2.81
+
+def damage_filter(k, N):
+    """
+    Dose dependent frequency filter.
+    Grant, Timothy and Grigorieff, Nikolaus: Measuring the optimal exposure for single particle cryo-EM using a 2.6 Å reconstruction of rotavirus VP6
+    :param k: spacial frequency in 1/A
+    :param N: cumulative electron exposure in e/A²
+    :return: attenuated frequency
+    """
+    return np.exp(-N / (2 * critical_exposure(k)))
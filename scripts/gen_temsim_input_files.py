@@ -1,15 +1,18 @@
 import os
 from string import Template
 import pandas as pd
-import random
 import numpy as np
 import math
 import pickle
+import json
+from concurrent.futures import ProcessPoolExecutor
 
-error_file_template = Template("""1  5
-#            rho             alpha             tau           x         y
-             0               0                 0             ${x}      ${y}
-""")
+from create_filtered_maps import dose_schedule
+from drift import generate_drift, parse_drift_params, write_drift_files, DRIFT_MODELS
+import instrument
+from instrument import span
+from map_store import FilteredMapStore
+from star import read_star, StarWriter
 
 temsim_input_template = Template("""
 === simulation ===
@@ -54,37 +57,23 @@ defocus_nominal                             = ${defocus}
 phase_shift                                 = ${phase_shift}
 phase_plate_spot = 0.050000
 
-=== detector ===
-
-det_pix_x 									= ${det_pix_x}
-det_pix_y 									= ${det_pix_y}
-padding = 50
-pixel_size                                  = ${det_pixel_size}
-gain = 1
-use_quantization = no
-dqe = 1
-mtf_a = 0
-mtf_b = 0
-mtf_c = 1
-mtf_alpha = 0
-mtf_beta = 0
-image_file_out                              = ${output_no_noise}
+""")
 
-=== detector ===
+detector_template = Template("""=== detector ===
 
 det_pix_x 									= ${det_pix_x}
 det_pix_y 									= ${det_pix_y}
 padding = 50
 pixel_size                                  = ${det_pixel_size}
 gain = 1
-use_quantization = yes
+use_quantization = ${use_quantization}
 dqe = 1
 mtf_a = 0
 mtf_b = 0
 mtf_c = 1
 mtf_alpha = 0
 mtf_beta = 0
-image_file_out                              = ${output_with_noise}
+image_file_out                              = ${image_file_out}
 
 """)
 
@@ -108,75 +97,82 @@ coord_file_in                               = ${coordinates}
 
 
 def gen_geometry_errors(n_frames, max_drift_dist=1, decay_dist_variance=-0.1, max_angle_variance=math.pi / 4,
-                        decay_angle_variance=-0.4) -> list:
+                        decay_angle_variance=-0.4, rng=None) -> list:
     """
     simulates the new x and y position of the frame center
-    as an effect of beam induced movement
-    the drift distance exponentially drops off
-    the drift angle is dependent on the previous drift angle
-    and the angular variation also drops off exponentially
+    as an effect of beam induced movement, see `drift.exponential_drift`
     :param max_drift_dist: in nm
+    :param rng: numpy.random.Generator, default is a new unseeded generator
     :return: [ (x1,y1), (x2,y2), ... ]
     """
-    x = [0]
-    y = [0]
-    deg = [random.random() * math.pi * 2]  # initial drift angle
-
-    for i in range(n_frames - 1):
-        last_deg = deg[-1]
-        last_x_pos = x[-1]
-        last_y_pos = y[-1]
-        deg_var = math.exp(decay_angle_variance * i) * max_angle_variance
-        new_deg = random.uniform(last_deg - deg_var, last_deg + deg_var)
-        rand_dist = random.random() * math.exp(decay_dist_variance * i) * max_drift_dist
-        new_x_pos = math.cos(new_deg) * rand_dist + last_x_pos
-        new_y_pos = math.sin(new_deg) * rand_dist + last_y_pos
-        x.append(new_x_pos)
-        y.append(new_y_pos)
-        deg.append(new_deg)
-
-    return list(zip(x, y))
-
-
-def relion_star_file_to_DataFrame(path):
-    cnt = 0
-    df_columns = []
-
-    with open(path) as star_file:
-        for line in star_file:
-            stripped_line = line.strip()
-            if stripped_line.startswith("data_") or stripped_line.startswith("loop_") or stripped_line == "":
-                cnt += 1
-            elif stripped_line.startswith("_"):
-                df_columns.append(stripped_line.split()[0])
-                cnt += 1
-            else:
-                break
-        star_file.close()
-
-    return pd.read_csv(path, skiprows=cnt, delim_whitespace=True, names=df_columns)
-
+    trajectory = generate_drift('exponential', 1, n_frames, rng, max_drift_dist=max_drift_dist,
+                                decay_dist_variance=decay_dist_variance, max_angle_variance=max_angle_variance,
+                                decay_angle_variance=decay_angle_variance)[0]
+    return [tuple(p) for p in trajectory.tolist()]
 
-def pandas_DataFrame_to_relion_star_file(df, out_star):
-    with open(out_star, 'w') as f:
-        f.write('data_\nloop_\n')
-        rln_cols = []
-        for col in df.columns:
-            if col.startswith('_rln'):
-                f.write(col + '\n')
-                rln_cols.append(col)
-        df[rln_cols].to_csv(f, header=False, index=False, sep='\t')
 
-
-def write_temsim_coordinates(df, file_out):
+def group_micrographs(ptcls, det_pix_x, det_pix_y):
+    """
+    Split the particles into micrographs in a single grouping pass.
+    :param ptcls: DataFrame of the particles star file
+    :param det_pix_x, det_pix_y: detector size in pixels
+    :return: DataFrame with the parameters of every micrograph (defocus in µm, phase shift, magnification, detector
+             pixel size and image pixel size in A/pix), in order of appearance in the star file;
+             DataFrame with the TEM-Simulator coordinates (nm) and angles of all particles;
+             dictionary with the row positions of the particles of every micrograph
+    """
+    columns = ['_rlnDefocusU', '_rlnDefocusV', '_rlnMagnification', '_rlnDetectorPixelSize']
+    if '_rlnPhaseShift' in ptcls.columns:
+        columns.append('_rlnPhaseShift')
+
+    grouped = ptcls.groupby('_rlnMicrographName', sort=False, observed=True)
+    varying = grouped[columns].nunique().max()
+    varying = varying[varying > 1]
+    if len(varying):
+        raise ValueError('Values of {} differ between particles of the same micrograph'.format(list(varying.index)))
+
+    first = grouped[columns].first()
+    micrographs = pd.DataFrame(index=first.index)
+    micrographs['defocus'] = (first['_rlnDefocusU'] + first['_rlnDefocusV']) / 2e4  # µm
+    micrographs['phase_shift'] = first['_rlnPhaseShift'] if '_rlnPhaseShift' in columns else 0
+    micrographs['magnification'] = first['_rlnMagnification']
+    micrographs['det_pixel_size'] = first['_rlnDetectorPixelSize']
+    micrographs['pixel_size_image'] = first['_rlnDetectorPixelSize'] / first['_rlnMagnification'] * 10000  # A/pix
+
+    # coordinates in the TEM-Simulator coordinate system (nm, origin in the center of the detector)
+    pixel_size_image = ptcls['_rlnDetectorPixelSize'] / ptcls['_rlnMagnification'] * 10000  # A/pix
+    coordinates = pd.DataFrame(index=ptcls.index)
+    coordinates['x'] = (ptcls['_rlnCoordinateX'] - det_pix_x // 2) * pixel_size_image / 10
+    coordinates['y'] = (ptcls['_rlnCoordinateY'] - det_pix_y // 2) * pixel_size_image / 10
+    coordinates['z'] = 0
+    coordinates['psi'] = -ptcls['_rlnAnglePsi'].astype(float)
+    coordinates['theta'] = -ptcls['_rlnAngleTilt'].astype(float)
+    coordinates['phi'] = -ptcls['_rlnAngleRot'].astype(float)
+
+    return micrographs, coordinates, grouped.indices
+
+
+def temsim_coordinates(df):
+    """
+    Content of a TEM-Simulator coordinates file.
+    """
     header_template = Template(
         "${ROWS}  6\n"
         "#            x             y             z           phi         theta           psi\n"
     )
+    rows = df[['x', 'y', 'z', 'phi', 'theta', 'psi']]
+    return header_template.substitute(ROWS=len(df)) + rows.to_csv(header=False, sep='\t', index=False)
+
+
+def write_temsim_coordinates(df, file_out):
     with open(file_out, "w") as f:
-        f.write(header_template.substitute(ROWS=len(df)))
-        rows = df[['x', 'y', 'z', 'phi', 'theta', 'psi']]
-        rows.to_csv(f, header=False, sep='\t', index=False)
+        f.write(temsim_coordinates(df))
+
+
+# coordinates of the structural noise
+SINGLE_COORDINATE = ("1  6\n"
+                     "#            x             y             z           phi         theta           psi\n"
+                     "        0.0000       0.0000        0.0000              0           0               0\n")
 
 def save_random_state(filename):
     random_state = np.random.get_state()
@@ -186,15 +182,273 @@ def load_random_state(filename):
     random_state = pickle.load( open( filename , "rb" ) )
     np.random.set_state(random_state)
 
+SEED_BITS = 31  # random seeds of TEM-Simulator are signed 32 bit integers
+
+
+def _permute_seed(k):
+    """
+    Bijective mixing of integers in [0, 2**SEED_BITS). Different inputs always give different seeds.
+    """
+    mask = (1 << SEED_BITS) - 1
+    k = (k * 0x2C1B3C6D + 0x297A2D39) & mask
+    k ^= k >> 16
+    k = (k * 0x5BD1E995) & mask
+    k ^= k >> 13
+    return k
+
+
+def frame_seed(root_seed, micrograph_index, n_frames, frame):
+    """
+    Random seed for the shot noise of a frame. The seeds of all frames of all micrographs of a run are distinct,
+    as long as there are less than 2**31 frames.
+    """
+    offset = np.random.SeedSequence(root_seed).generate_state(1)[0]
+    return _permute_seed((int(offset) + micrograph_index * n_frames + frame) & ((1 << SEED_BITS) - 1))
+
+
+def validation_seed(root_seed, micrograph_index, n_frames, frame):
+    """
+    Random seed of an exact frame simulated for validation in the approximate mode. The validation frames use the
+    seeds below those of the micrographs in `frame_seed`, so they are distinct from the seeds of all keyframes and
+    their noise is independent.
+    """
+    return frame_seed(root_seed, -1 - micrograph_index, n_frames, frame)
+
+
+def micrograph_rng(root_seed, micrograph_index):
+    """
+    Independent random number generator of a micrograph, derived from the root seed.
+    """
+    return np.random.default_rng(np.random.SeedSequence(root_seed, spawn_key=(micrograph_index,)))
+
+
+DRIFT_STREAM = 1 << 32  # spawn key of the drift generators, outside of the range of micrograph indices
+
+
+def drift_rng(root_seed, micrograph_index):
+    """
+    Random number generator for the drift of a micrograph, derived from the root seed. The drift of a micrograph does
+    not depend on the number of micrographs of the run.
+    """
+    return np.random.default_rng(np.random.SeedSequence(root_seed, spawn_key=(DRIFT_STREAM, micrograph_index)))
+
+
+KEYFRAMES_FILE = 'keyframes.json'
+# job manifest of a run, see job_manifest.py
+JOBS_FILE = 'jobs.jsonl'
+
+
+def keyframe_indices(n_frames, n_keyframes):
+    """
+    Frames that are simulated in the approximate mode, evenly spaced and starting with the first frame.
+    """
+    return sorted(set(int(i) for i in np.linspace(0, n_frames, max(1, n_keyframes), endpoint=False).round()))
+
+
+_stores = {}
+
+
+def _filtered_map_store(store_dir, max_bytes, run_dir):
+    # one store per process, so maps requested for several micrographs are looked up only once
+    if (store_dir, run_dir) not in _stores:
+        _stores[store_dir, run_dir] = FilteredMapStore(store_dir, max_bytes=max_bytes, run_dir=run_dir)
+    return _stores[store_dir, run_dir]
+
+
+def render_input(shared, micrograph, simulation, output_dir, coordinates_file, error_file=None,
+                 coords_struct_file=None):
+    """
+    Content of the TEM-Simulator input file of one simulation of a micrograph.
+    :param shared: settings shared by all micrographs of the run (dose per frame, detector size, voxel size and
+                   structural noise map)
+    :param micrograph: parameters of the micrograph, see `write_micrograph_inputs`
+    :param simulation: parameters of the simulation (frame, name, rand_seed, map, drift, noise_free)
+    :param output_dir: directory of the simulated images and the log file
+    :param coordinates_file: TEM-Simulator coordinates of the particles
+    :param error_file: geometry error file with the drift of the frame, only used for simulations with drift
+    :param coords_struct_file: coordinates of the structural noise, only used with structural noise
+    :return: content of the input file
+    """
+    n, name = simulation['frame'], simulation['name']
+    content_input = temsim_input_template.substitute(
+        log_file=os.path.join(output_dir, "simulation_{}_{:02d}.log".format(name, n)),
+        rand_seed=simulation['rand_seed'],
+        defocus=micrograph['defocus'],
+        phase_shift=micrograph['phase_shift'],
+        magnification=micrograph['magnification'],
+        dose_per_frame=shared['dose_per_frame'] * 100,  # e/nm²
+        geom_errors='file' if simulation['drift'] else 'none',
+        error_file_in=error_file if simulation['drift'] else 'none'
+    )
+    detector = dict(det_pix_x=shared['det_pix_x'], det_pix_y=shared['det_pix_y'],
+                    det_pixel_size=micrograph['det_pixel_size'])
+    content_input += detector_template.substitute(
+        use_quantization='no', image_file_out=os.path.join(output_dir, "{}_{:02d}_no_noise.mrc".format(name, n)),
+        **detector)
+    # without the second detector, shot noise is added afterwards to the noise free frames (see add_noise.py)
+    if not simulation['noise_free']:
+        content_input += detector_template.substitute(
+            use_quantization='yes', image_file_out=os.path.join(output_dir, "{}_{:02d}_with_noise.mrc".format(name, n)),
+            **detector)
+
+    content_input += particle_input_template.substitute(
+        map_file_re_in=simulation['map'],
+        coordinates=coordinates_file,
+        voxel_size=shared['voxelsize'] / 10,  # nm
+        randomize_particle='no',
+        rand_seed_particle=0,  # has no effect
+        name='proteasome'
+    )
+    if shared['struct'] is not None:
+        content_input += particle_input_template.substitute(
+            map_file_re_in=shared['struct'],
+            coordinates=coords_struct_file,
+            voxel_size=0.1,
+            randomize_particle='yes',
+            rand_seed_particle=micrograph['rand_seed_particle'],
+            name='struct'
+        )
+    return content_input
+
+
+def shared_settings(settings):
+    """
+    Settings of a run that are needed to render the input files of every micrograph.
+    """
+    # Decrease dose per frame because of loss of electrons through scattering by the phase plate
+    dose_per_frame = settings['dose_per_frame'] * 0.9 if settings['has_phase_plate'] else settings['dose_per_frame']
+    return {'dose_per_frame': dose_per_frame, 'det_pix_x': settings['det_pix_x'], 'det_pix_y': settings['det_pix_y'],
+            'voxelsize': settings['voxelsize'], 'struct': settings['struct']}
+
+
+def _native(value):
+    # numpy scalars of the star file as python numbers, for the job manifest
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def write_micrograph_inputs(job):
+    """
+    Write the TEM-Simulator input files of one micrograph. All random numbers come from the random number generator
+    of the micrograph, so the output does not depend on the order in which micrographs are processed.
+    With `settings['manifest']`, no input files are written, the input files are rendered from the returned record
+    of the job manifest just before the simulation (see job_manifest.py).
+    :param job: tuple (settings, micrograph index, micrograph name, micrograph parameters, particles DataFrame,
+                coordinates DataFrame, first particle id, drift trajectory in nm or None)
+    :return: particles DataFrame for the output star file and the record of the micrograph for the job manifest
+    """
+    settings, index, micrograph, params, micrograph_df, df, first_particle_id, errors = job
+    n_frames = settings['n_frames']
+    BASE_DIR = settings['base_dir']
+    rng = micrograph_rng(settings['root_seed'], index)
+
+    basename = os.path.splitext(os.path.basename(micrograph))[0]
+    OUTPUT_DIR = os.path.join(BASE_DIR, basename)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # change the micrograph name to match the future location of the simulated micrographs
+    micrograph_df = micrograph_df.copy()
+    micrograph_df['_rlnMicrographName'] = os.path.join(BASE_DIR, basename + '.mrc')
+    micrograph_df['_rlnParticleId'] = range(first_particle_id, first_particle_id + len(micrograph_df))
+
+    pixel_size_image = params['pixel_size_image']  # A/pix
+
+    # the drift files of all micrographs were written by `main`
+    if errors is not None:
+        fmref = n_frames // 2  # reference frame for motioncor is by default the middle frame
+        error_x, error_y = errors[fmref]  # nm
+        micrograph_df['_rlnOriginX'] = - error_x * 10 / pixel_size_image
+        micrograph_df['_rlnOriginY'] = - error_y * 10 / pixel_size_image
+
+    record = {
+        'index': index,
+        'name': basename,
+        'defocus': _native(params['defocus']),  # µm
+        'phase_shift': _native(params['phase_shift']),
+        'magnification': _native(params['magnification']),
+        'det_pixel_size': _native(params['det_pixel_size']),
+        'rand_seed_particle': int(rng.integers(1 << SEED_BITS)),
+        'coordinates': temsim_coordinates(df),
+        'drift': None if errors is None else np.asarray(errors).tolist(),
+    }
+
+    # simulations as (frame, name, with drift, noise free)
+    keyframes = settings['keyframes']
+    if keyframes is None:
+        simulations = [(n, 'frame', errors is not None, settings['noise_free']) for n in range(n_frames)]
+    else:
+        # approximate mode: only noise free keyframes without drift are simulated, the frames are derived from them
+        # with derive_frames.py. For the first micrographs the exact frames are simulated as well, for validation.
+        simulations = [(n, 'keyframe', False, True) for n in keyframes]
+        if index < settings['validate']:
+            simulations += [(n, 'frame', errors is not None, True) for n in range(n_frames)]
+        with open(os.path.join(OUTPUT_DIR, KEYFRAMES_FILE), 'w') as f:
+            json.dump({'n_frames': n_frames, 'doses': [float(d) for d in settings['dose_array']],
+                       'keyframes': keyframes, 'pixel_size': float(pixel_size_image), 'drift': errors is not None,
+                       'exact': index < settings['validate']}, f, indent=1)
+
+    record['simulations'] = []
+    with span('filtered_maps', micrograph=index, simulations=len(simulations)):
+        for n, name, with_drift, noise_free in simulations:
+            # check if particle component exists
+            dose_n = settings['dose_array'][n]
+            if settings['input_map'] is not None:
+                store = _filtered_map_store(settings['store_dir'], settings['store_max_bytes'], BASE_DIR)
+                filtered_map_file = store.get(settings['input_map'], settings['voxelsize'], settings['factor'], dose_n)
+            else:
+                filtered_map_file = os.path.join(os.path.abspath(settings['filtered_maps_dir']),
+                                                 "filt_{:5.3f}.mrc".format(dose_n))
+                if not os.path.isfile(filtered_map_file):
+                    raise FileNotFoundError('Filtered map "{}" does not exist. Create it with create_filtered_maps.py '
+                                            'or use --map to generate filtered maps on demand.'
+                                            .format(filtered_map_file))
+            if keyframes is not None and name == 'frame':
+                seed = validation_seed(settings['root_seed'], index, n_frames, n)
+            else:
+                seed = frame_seed(settings['root_seed'], index, n_frames, n)
+            record['simulations'].append({'frame': n, 'name': name, 'rand_seed': seed,
+                                          'map': filtered_map_file, 'drift': with_drift, 'noise_free': noise_free})
+
+    if settings['manifest']:
+        return micrograph_df, record
+
+    # write input files
+    with span('write_inputs', micrograph=index):
+        shared = shared_settings(settings)
+        coordinates_file = os.path.join(OUTPUT_DIR, "coordinates.txt")
+        with open(coordinates_file, "w") as f:
+            f.write(record['coordinates'])
+        coords_struct_file = None
+        if settings['struct'] is not None:
+            coords_struct_file = os.path.join(OUTPUT_DIR, "single_coordinate.txt")
+            with open(coords_struct_file, 'w') as f:
+                f.write(SINGLE_COORDINATE)
+
+        for simulation in record['simulations']:
+            n, name = simulation['frame'], simulation['name']
+            input_file = os.path.join(OUTPUT_DIR, "input_{}_{}.txt".format(name, str(n).zfill(2)))
+            error_file = os.path.join(OUTPUT_DIR, "error_frame_{}.txt".format(str(n).zfill(2)))
+            with open(input_file, "w") as f:
+                f.write(render_input(shared, record, simulation, OUTPUT_DIR, coordinates_file, error_file,
+                                     coords_struct_file))
+
+    return micrograph_df, None
+
+
 def main(outp_dir, angles_star, n_frames,
          simulate_drift, dose, voxelsize,
-         struct, filtered_maps_dir, max, rand):
+         struct, filtered_maps_dir, max, rand,
+         input_map=None, factor=1, store_dir=None, store_size=None,
+         seed=None, workers=1, drift_model='exponential', drift_params=None, noise_free=False,
+         n_keyframes=None, validate=0, manifest=False):
 
     if rand is not None:
         if os.path.isfile(rand):
             load_random_state(rand)
         else:
             save_random_state(rand)
+    if seed is None:
+        # the root seed is taken from the (saved) numpy random state
+        seed = int(np.random.randint(2 ** 31))
 
     star_file = angles_star
     BASE_DIR = outp_dir
@@ -210,143 +464,104 @@ def main(outp_dir, angles_star, n_frames,
     print('Angles star file:', star_file)
     print('Number of frames:', n_frames)
     print('Dose per frame:', dose_per_frame)
-    print('Simulate drift:', simulate_drift)
+    print('Simulate drift:', '{} ({})'.format(drift_model, drift_params or 'default parameters') if simulate_drift else False)
     print('Structural noise:', True if struct is not None else False)
+    print('Random seed:', seed)
+    if n_keyframes is not None:
+        print('Approximate mode: {} keyframes, exact frames for {} micrographs'.format(n_keyframes, validate))
+    if input_map is not None:
+        print('Input map:', input_map)
+        print('Filtered map store:', os.path.abspath(store_dir))
+    if manifest:
+        print('Job manifest:', os.path.join(BASE_DIR, JOBS_FILE))
 
     if input('Do you wish to proceed with these values?\n') in ('y', 'yes'):
         print('Continuing...')
-
-        # read content of the input star file
-        ptcls_star_content = relion_star_file_to_DataFrame(star_file)
-        # create an empty DataFrame to store coordinated of particles and details of the simulated micrographs
-        output_particles_df = pd.DataFrame()
-
-
-        dose_array = np.append(np.array(0), np.cumsum(np.repeat(dose_per_frame, n_frames - 1)))
-
-        if max < 0:
-            micrograph_names = ptcls_star_content['_rlnMicrographName'].unique()
-        else:
-            micrograph_names = ptcls_star_content['_rlnMicrographName'].unique()[:max]
-        for micrograph in micrograph_names:
-            basename = os.path.splitext(os.path.basename(micrograph))[0]
-            OUTPUT_DIR = os.path.join(BASE_DIR, basename)
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-            # select all rows and columns with this micrograph name
-            micrograph_df = ptcls_star_content.loc[ptcls_star_content['_rlnMicrographName'] == micrograph].copy()
-            # change the micrograph name to match the future location of the simulated micrographs
-            micrograph_df['_rlnMicrographName'] = os.path.join(BASE_DIR, basename + '.mrc')
-            micrograph_df['_rlnParticleId'] = range(len(output_particles_df), len(output_particles_df) + len(micrograph_df))
-
-
-            # read defocus value from star file
-            defocus = ( float(micrograph_df['_rlnDefocusU'].unique()) + float(micrograph_df['_rlnDefocusV'].unique()) ) / 2e4  # µm
-            # read phase shift from star file.
-            # Decrease dose per frame because of loss of electrons through scattering by the phase plate
-            if '_rlnPhaseShift' in micrograph_df.columns:
-                phase_shift = float(micrograph_df['_rlnPhaseShift'].unique())
-                dose_per_frame *= 0.9
-            else:
-                phase_shift = 0
-            # read detector parameters from star file
-            magnification = float(micrograph_df['_rlnMagnification'].unique())
-            det_pixel_size = float(micrograph_df['_rlnDetectorPixelSize'].unique())
-            pixel_size_image = det_pixel_size / magnification * 10000  # A/pix
+        with span('gen_temsim_input_files', n_frames=n_frames, workers=workers):
+            # read content of the input star file
+            with span('read_star', path=star_file):
+                ptcls_star_content = read_star(star_file)
+
+            output_star_file = os.path.join(BASE_DIR, 'particles.star')
+            # as long as a file with this name exists, ask for a new file name
+            while os.path.isfile(output_star_file):
+                new_name = input('A file with the name "{}" already exists in the output folder. '
+                                 'Enter a new name:\n'.format(os.path.basename(output_star_file)))
+                output_star_file = os.path.join(BASE_DIR, new_name)
+            os.makedirs(BASE_DIR, exist_ok=True)
+
+            settings = {
+                'base_dir': BASE_DIR,
+                'n_frames': n_frames,
+                'dose_per_frame': dose_per_frame,
+                'dose_array': dose_schedule(dose, n_frames),
+                'has_phase_plate': '_rlnPhaseShift' in ptcls_star_content.columns,
+                'det_pix_x': det_pix_x,
+                'det_pix_y': det_pix_y,
+                'simulate_drift': simulate_drift,
+                'struct': struct,
+                'voxelsize': voxelsize,
+                'filtered_maps_dir': filtered_maps_dir,
+                # filtered maps are generated on demand
+                'input_map': input_map,
+                'factor': factor,
+                'store_dir': store_dir,
+                'store_max_bytes': None if store_size is None else int(store_size * 1e9),
+                'root_seed': seed,
+                'noise_free': noise_free,
+                'keyframes': None if n_keyframes is None else keyframe_indices(n_frames, n_keyframes),
+                'validate': validate,
+                'manifest': manifest,
+            }
+
+            # group the particles by micrograph and convert the coordinates of all particles at once
+            with span('group_micrographs', particles=len(ptcls_star_content)):
+                micrographs, coordinates, rows = group_micrographs(ptcls_star_content, det_pix_x, det_pix_y)
+            if max >= 0:
+                micrographs = micrographs.iloc[:max]
+            # particle ids are assigned in order of the micrographs
+            sizes = [len(rows[micrograph]) for micrograph in micrographs.index]
+            first_particle_ids = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
 
             if simulate_drift:
-                errors = gen_geometry_errors(n_frames)
-                with open(os.path.join(OUTPUT_DIR, "drift.txt"), "w") as f:
-                    f.write("\n".join(["{}\t{}".format(x, y) for x, y in errors]))
+                with span('drift', micrographs=len(micrographs)):
+                    # every micrograph has its own random stream, its drift does not depend on --max
+                    drift = np.array([generate_drift(drift_model, 1, n_frames, drift_rng(seed, index),
+                                                     **(drift_params or {}))[0] for index in range(len(micrographs))])
+                    # with a job manifest, the error files are rendered together with the input files
+                    write_drift_files([os.path.join(BASE_DIR, os.path.splitext(os.path.basename(m))[0])
+                                       for m in micrographs.index], drift, error_files=not manifest)
             else:
-                errors = None
-
-            df = pd.DataFrame()
-            df['x'] = (micrograph_df['_rlnCoordinateX'] - det_pix_x // 2) * pixel_size_image / 10
-            df['y'] = (micrograph_df['_rlnCoordinateY'] - det_pix_y // 2) * pixel_size_image / 10
-            df['z'] = 0
-            df['psi']   = -micrograph_df['_rlnAnglePsi'].astype(float)
-            df['theta'] = -micrograph_df['_rlnAngleTilt'].astype(float)
-            df['phi']   = -micrograph_df['_rlnAngleRot'].astype(float)
-
-            if simulate_drift:
-                fmref = n_frames // 2  # reference frame for motioncor is by default the middle frame
-                error_x, error_y = errors[fmref]  # nm
-                micrograph_df['_rlnOriginX'] = - error_x * 10 / pixel_size_image
-                micrograph_df['_rlnOriginY'] = - error_y * 10 / pixel_size_image
-
-            output_particles_df = output_particles_df.append(micrograph_df)
-
-            coordinates_file = os.path.join(OUTPUT_DIR, "coordinates.txt")
-            write_temsim_coordinates(df, coordinates_file)
-
-            # write input files
-            for n in range(n_frames):
-                input_file = os.path.join(OUTPUT_DIR, "input_frame_{}.txt".format(str(n).zfill(2)))
-                error_file = os.path.join(OUTPUT_DIR, "error_frame_{}.txt".format(str(n).zfill(2)))
-
-                content_input = temsim_input_template.substitute(
-                    log_file=os.path.join(OUTPUT_DIR, "simulation_frame_{:02d}.log".format(n)),
-                    rand_seed=np.random.randint(10000),
-                    output_no_noise=os.path.join(OUTPUT_DIR, "frame_{:02d}_no_noise.mrc".format(n)),
-                    output_with_noise=os.path.join(OUTPUT_DIR, "frame_{:02d}_with_noise.mrc".format(n)),
-                    defocus=defocus,
-                    phase_shift=phase_shift,
-                    magnification=magnification,
-                    det_pixel_size=det_pixel_size,
-                    det_pix_x=det_pix_x,
-                    det_pix_y=det_pix_y,
-                    dose_per_frame=dose_per_frame * 100,  # e/nm²
-                    geom_errors='none' if errors is None else 'file',
-                    error_file_in='none' if errors is None else error_file
-                )
-
-                # check if particle component exists
-                filtered_map_file = os.path.join(os.path.abspath(filtered_maps_dir),
-                                                 "filt_{:5.3f}.mrc".format(dose_array[n]))
-                assert os.path.isfile(filtered_map_file)
-                particle_input = particle_input_template.substitute(
-                    map_file_re_in=filtered_map_file,
-                    coordinates=coordinates_file,
-                    voxel_size=voxelsize / 10,  # nm
-                    randomize_particle='no',
-                    rand_seed_particle=0,  # has no effect
-                    name='proteasome'
-                )
-
-                with open(input_file, "w") as f:
-                    f.write(content_input)
-                    f.write(particle_input)
-                    if struct is not None:
-
-                        coords_struct_file = os.path.join(OUTPUT_DIR, "single_coordinate.txt")
-
-                        with open(coords_struct_file,'w') as coords_struct:
-                            coords_struct.write("1  6\n")
-                            coords_struct.write("#            x             y             z           phi         theta           psi\n")
-                            coords_struct.write("        0.0000       0.0000        0.0000              0           0               0\n")
-
-                        struct_input = particle_input_template.substitute(
-                            map_file_re_in=struct,
-                            coordinates=coords_struct_file,
-                            voxel_size=0.1,
-                            randomize_particle='yes',
-                            rand_seed_particle=abs(hash(micrograph)),
-                            name='struct'
-                        )
-                        f.write(struct_input)
-
-                if simulate_drift:
-                    with open(error_file, "w") as f:
-                        f.write(error_file_template.substitute(x=errors[n][0], y=errors[n][1]))
-
-        output_star_file = os.path.join(BASE_DIR, 'particles.star')
-        # as long as a file with this name exists, ask for a new file name
-        while os.path.isfile(output_star_file):
-            new_name = input('A file with the name "{}" already exists in the output folder. '
-                             'Enter a new name:\n'.format(os.path.basename(output_star_file)))
-            output_star_file = os.path.join(BASE_DIR, new_name)
-        pandas_DataFrame_to_relion_star_file(output_particles_df, output_star_file)
+                drift = [None] * len(micrographs)
+
+            jobs = ((settings, index, micrograph, params,
+                     ptcls_star_content.iloc[rows[micrograph]], coordinates.iloc[rows[micrograph]],
+                     int(first_particle_ids[index]), drift[index])
+                    for index, (micrograph, params) in enumerate(micrographs.iterrows()))
+
+            # the coordinates of particles and details of the simulated micrographs are written one micrograph at a time
+            manifest_file = open(os.path.join(BASE_DIR, JOBS_FILE), 'w') if manifest else None
+            try:
+                if manifest_file is not None:
+                    json.dump({'settings': dict(shared_settings(settings), n_frames=n_frames)}, manifest_file)
+                    manifest_file.write('\n')
+                with span('micrographs', micrographs=len(micrographs), workers=workers), \
+                        StarWriter(output_star_file) as output_particles:
+                    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+                    try:
+                        results = executor.map(write_micrograph_inputs, jobs, chunksize=4) if executor is not None \
+                            else map(write_micrograph_inputs, jobs)
+                        for micrograph_df, record in results:
+                            output_particles.write(micrograph_df)
+                            if manifest_file is not None:
+                                json.dump({'micrograph': record}, manifest_file)
+                                manifest_file.write('\n')
+                    finally:
+                        if executor is not None:
+                            executor.shutdown()
+            finally:
+                if manifest_file is not None:
+                    manifest_file.close()
 
 
 
@@ -373,15 +588,57 @@ if __name__ == '__main__':
                         help='Maximum number of micrographs to create input files for. Use a negative value to simulate all micrographs. Default = 1')
     parser.add_argument('--drift', action='store_true', default=False,
                         help='Use this option to simulate drift as movement of the whole frame. Default is no drift')
+    parser.add_argument('--drift_model', type=str, choices=sorted(DRIFT_MODELS), default='exponential',
+                        help='Model of the drift: exponential (beam induced movement that drops off exponentially), '
+                             'linear (constant drift with jitter) or settling (stage settling). Default = exponential')
+    parser.add_argument('--drift_param', type=str, nargs='+', default=None,
+                        help='Parameters of the drift model as NAME=VALUE, e.g. max_drift_dist=2 (see drift.py)')
     parser.add_argument("--struct", type=str, default=None,
                         help='MRC file that will be used as structural noise')
+    parser.add_argument('--noise_free', action='store_true', default=False,
+                        help='Only simulate the noise free frames (frame_XX_no_noise.mrc). Shot noise can be added '
+                             'afterwards with add_noise.py, for any number of doses. Default is to simulate both')
+    parser.add_argument('--keyframes', type=int, default=None,
+                        help='Approximate mode: only simulate this number of noise free keyframes per micrograph, e.g. 1 '
+                             'for a single simulation at zero dose. The frames are derived from the keyframes with '
+                             'derive_frames.py. Default is to simulate every frame')
+    parser.add_argument('--validate', type=int, default=0,
+                        help='In the approximate mode, also simulate the exact noise free frames of this number of '
+                             'micrographs, to validate the derived frames. Default = 0')
+    parser.add_argument('--manifest', action='store_true', default=False,
+                        help='Write a single job manifest (jobs.jsonl) instead of the input, coordinate and error files '
+                             'of every frame. The input files are rendered to a temporary directory just before the '
+                             'simulation by run_simulations.py and work_queue.py')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Write the time, peak memory and bytes read/written of every stage as json lines to this '
+                             'file (see instrument.py). Default is $TEMSIM_TRACE or no trace')
+    parser.add_argument('--map', type=str, default=None,
+                        help='Input density map (.mrc). If specified, damage filtered maps are taken from the filtered map store '
+                             'and generated on demand, instead of reading them from --fmaps')
+    parser.add_argument('--factor', type=float, default=1,
+                        help='Reduce the intensity of the scattering potential of --map by this factor. Default = 1')
+    parser.add_argument('--store', type=str, default='filtered_map_store',
+                        help='Directory of the filtered map store used with --map. Default = filtered_map_store')
+    parser.add_argument('--store_size', type=float, default=None,
+                        help='Maximum size of the filtered map store in GB. Least recently used maps are removed. Default = no limit')
     parser.add_argument('--voxelsize', type=float, default=1.0,
                         help='Voxel size of the input particle map in Angstrom. Default = 1')
     parser.add_argument('--rand', type=str, default=None,
                         help='Input/Output random state file. If file already exists, the random seed for numpy is set. '
                              'If file does not exist, it is created and the random state of the simulation is saved.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Root random seed. The random seeds of all frames, the structural noise and the drift are '
+                             'derived from it. Default is a seed drawn from the numpy random state (see --rand)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes that write the input files. The output does not depend on '
+                             'the number of workers. Default = 1')
 
     args = parser.parse_args()
+    instrument.enable(args.trace)
+    try:
+        drift_params = parse_drift_params(args.drift_param, args.drift_model)
+    except ValueError as e:
+        parser.error(str(e))
 
     main(
         outp_dir=args.o,
@@ -393,6 +650,18 @@ if __name__ == '__main__':
         filtered_maps_dir=args.fmaps,
         voxelsize=args.voxelsize,
         max=args.max,
-        rand = args.rand
+        rand = args.rand,
+        input_map=args.map,
+        factor=args.factor,
+        store_dir=args.store,
+        store_size=args.store_size,
+        seed=args.seed,
+        workers=args.workers,
+        drift_model=args.drift_model,
+        drift_params=drift_params,
+        noise_free=args.noise_free,
+        n_keyframes=args.keyframes,
+        validate=args.validate,
+        manifest=args.manifest
     )
 
@@ -0,0 +1,212 @@
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# file for the trace of all processes of a run, set by `enable` and inherited by worker processes
+ENV = 'TEMSIM_TRACE'
+
+
+class _NullSpan:
+    """
+    Span that does nothing, returned while instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _peak_rss():
+    # peak resident set size of the process in bytes (ru_maxrss is in kB on Linux, in bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _io_bytes():
+    # bytes read and written by the process with system calls, including reads from the page cache.
+    # Memory-mapped files are not counted.
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Tracer:
+    """
+    Writes timing spans as json lines to a file. All processes append to the same file, every line is one finished
+    span with its name, parent span, wall and cpu time, peak RSS of the process and the bytes read and written by
+    the process while the span was open. Spans are nested per thread; spans opened in other threads are children
+    of the outermost span of the process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.root = None
+        self._file = None
+        self._pid = None
+
+    def _write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if self._pid != os.getpid():
+                # worker processes open their own file handle after a fork
+                self._file = sys.stderr if self.path == '-' else open(self.path, 'a', buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line)
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+
+class Span:
+    """
+    A timed stage, use it as context manager. Additional fields, e.g. sizes, can be added with `add`.
+    """
+
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def add(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        tracer = self.tracer
+        self.pid = os.getpid()
+        stack = tracer._stack()
+        if stack and stack[-1].pid != self.pid:
+            # spans of the parent process, inherited by a fork
+            del stack[:]
+        if tracer.root is not None and tracer.root.pid != self.pid:
+            tracer.root = None
+        parent = stack[-1] if stack else tracer.root
+        self.id = '{}-{}'.format(self.pid, next(tracer.ids))
+        self.parent = None if parent is None else parent.id
+        self.depth = 0 if parent is None else parent.depth + 1
+        if tracer.root is None:
+            tracer.root = self
+        stack.append(self)
+        self.read, self.written = _io_bytes()
+        self.cpu = time.process_time()
+        self.start = time.time()
+        self.perf = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.perf
+        cpu = time.process_time() - self.cpu
+        read, written = _io_bytes()
+        stack = self.tracer._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if self.tracer.root is self:
+            self.tracer.root = None
+        record = {'span': self.name, 'id': self.id, 'parent': self.parent, 'depth': self.depth, 'pid': self.pid,
+                  'thread': threading.current_thread().name, 'start': self.start, 'wall': wall, 'cpu': cpu,
+                  'peak_rss': _peak_rss(),
+                  'read_bytes': None if read is None else read - self.read,
+                  'write_bytes': None if written is None else written - self.written}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.fields)
+        self.tracer._write(record)
+        return False
+
+
+_tracer = None
+
+
+def enable(path=None):
+    """
+    Enable the instrumentation. Worker processes started afterwards write to the same trace file.
+    :param path: trace file (json lines) or '-' for stderr, default is $TEMSIM_TRACE
+    """
+    global _tracer
+    path = path or os.environ.get(ENV)
+    if not path:
+        return
+    os.environ[ENV] = path
+    _tracer = Tracer(path)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **fields):
+    """
+    Timing span of a stage, used as context manager:
+
+        with span('fft', shape=data.shape):
+            ...
+
+    While the instrumentation is disabled, a shared span that does nothing is returned.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, fields)
+
+
+def summary(path):
+    """
+    Total time, cpu time, peak RSS and bytes read and written of every stage of a trace file.
+    :return: DataFrame with one row per span name, sorted by the total wall time
+    """
+    import pandas as pd
+
+    with open(path) as f:
+        spans = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    grouped = spans.groupby('span')
+    table = pd.DataFrame({'count': grouped.size(), 'wall': grouped['wall'].sum(), 'cpu': grouped['cpu'].sum(),
+                          'mean_wall': grouped['wall'].mean(), 'peak_rss_mb': grouped['peak_rss'].max() / 2 ** 20,
+                          'read_mb': grouped['read_bytes'].sum() / 2 ** 20,
+                          'write_mb': grouped['write_bytes'].sum() / 2 ** 20,
+                          'depth': grouped['depth'].min()})
+    return table.sort_values('wall', ascending=False)
+
+
+# instrumentation enabled with the environment variable, also in worker processes
+if os.environ.get(ENV):
+    enable()
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Summarize the stages of a trace file written with --trace or '
+                                                 '$TEMSIM_TRACE: number of spans, total wall and cpu time, peak RSS '
+                                                 'and MB read and written per stage.')
+    parser.add_argument('trace', type=str,
+                        help='Trace file (json lines)')
+    args = parser.parse_args()
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None,
+                           'display.float_format', '{:.3f}'.format):
+        print(summary(args.trace))
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from drift import error_file_template
+from gen_temsim_input_files import JOBS_FILE, SINGLE_COORDINATE, render_input
+
+_manifests = {}  # path -> (mtime, manifest)
+
+
+class JobManifest:
+    """
+    Jobs of a run of `gen_temsim_input_files.py --manifest`.
+
+    The manifest `jobs.jsonl` has one json object per line: the settings shared by all micrographs in the first line,
+    followed by one line per micrograph with its parameters, particle coordinates, drift and simulations. Every
+    simulation is a job, identified by the path of the input file it would have in a run without manifest,
+    `<run_dir>/<micrograph>/input_frame_XX.txt`. The input files are only rendered just before the simulation, see
+    `rendered_input`.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.micrographs = []
+        self.jobs = {}  # input file -> (micrograph, simulation)
+        self.input_files = {}  # (micrograph directory, simulation name) -> sorted input files
+        with open(os.path.join(run_dir, JOBS_FILE)) as f:
+            self.settings = json.loads(f.readline())['settings']
+            for line in f:
+                micrograph = json.loads(line)['micrograph']
+                self.micrographs.append(micrograph)
+                for simulation in micrograph['simulations']:
+                    input_file = self.input_file(micrograph, simulation)
+                    self.jobs[input_file] = (micrograph, simulation)
+                    self.input_files.setdefault((self.micrograph_dir(micrograph), simulation['name']),
+                                                []).append(input_file)
+        for input_files in self.input_files.values():
+            input_files.sort()
+
+    def micrograph_dir(self, micrograph):
+        return os.path.join(self.run_dir, micrograph['name'])
+
+    def input_file(self, micrograph, simulation):
+        return os.path.join(self.micrograph_dir(micrograph),
+                            'input_{}_{:02d}.txt'.format(simulation['name'], simulation['frame']))
+
+    def outputs(self, input_file):
+        """
+        Output files of a simulation, as `image_file_out` of the rendered input file.
+        """
+        micrograph, simulation = self.jobs[input_file]
+        images = ['no_noise'] if simulation['noise_free'] else ['no_noise', 'with_noise']
+        return [os.path.join(self.micrograph_dir(micrograph),
+                             '{}_{:02d}_{}.mrc'.format(simulation['name'], simulation['frame'], image))
+                for image in images]
+
+    def render(self, input_file, directory):
+        """
+        Write the input file of a simulation and its coordinate and error files to a directory.
+        :return: path to the rendered input file
+        """
+        micrograph, simulation = self.jobs[input_file]
+        coordinates_file = os.path.join(directory, 'coordinates.txt')
+        with open(coordinates_file, 'w') as f:
+            f.write(micrograph['coordinates'])
+        error_file = None
+        if simulation['drift']:
+            x, y = micrograph['drift'][simulation['frame']]
+            error_file = os.path.join(directory, 'error_frame_{:02d}.txt'.format(simulation['frame']))
+            with open(error_file, 'w') as f:
+                f.write(error_file_template.substitute(x=x, y=y))
+        coords_struct_file = None
+        if self.settings['struct'] is not None:
+            coords_struct_file = os.path.join(directory, 'single_coordinate.txt')
+            with open(coords_struct_file, 'w') as f:
+                f.write(SINGLE_COORDINATE)
+
+        rendered = os.path.join(directory, os.path.basename(input_file))
+        with open(rendered, 'w') as f:
+            f.write(render_input(self.settings, micrograph, simulation, self.micrograph_dir(micrograph),
+                                 coordinates_file, error_file, coords_struct_file))
+        return rendered
+
+
+def load_manifest(run_dir):
+    """
+    Job manifest of a run, or None if the run has no manifest. Manifests are read once per process and read again
+    when they change.
+    """
+    path = os.path.join(run_dir, JOBS_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if path not in _manifests or _manifests[path][0] != mtime:
+        _manifests[path] = (mtime, JobManifest(run_dir))
+    return _manifests[path][1]
+
+
+def manifest_of(input_file):
+    """
+    Job manifest that contains the job of an input file that was not written, or None.
+    """
+    manifest = load_manifest(os.path.dirname(os.path.dirname(input_file)))
+    if manifest is None or input_file not in manifest.jobs:
+        return None
+    return manifest
+
+
+def manifest_input_files(micrograph_dir, name='frame'):
+    """
+    Input files of the simulations of a micrograph of a run with job manifest, in the order of the frames.
+    :param name: 'frame' or 'keyframe'
+    :return: list of input file paths, empty if the run has no manifest
+    """
+    run_dir, micrograph = os.path.split(os.path.normpath(micrograph_dir))
+    manifest = load_manifest(run_dir)
+    if manifest is None:
+        return []
+    return list(manifest.input_files.get((os.path.join(run_dir, micrograph), name), []))
+
+
+@contextmanager
+def rendered_input(input_file):
+    """
+    Path to the input file of a job. Jobs of a job manifest are rendered into a temporary directory (see `tempfile`,
+    e.g. node local with $TMPDIR) that is removed when the context is left.
+    """
+    if os.path.isfile(input_file):
+        yield input_file
+        return
+    manifest = manifest_of(input_file)
+    if manifest is None:
+        raise FileNotFoundError('input file {} does not exist and is not in a job manifest'.format(input_file))
+    directory = tempfile.mkdtemp(prefix='temsim_')
+    try:
+        yield manifest.render(input_file, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
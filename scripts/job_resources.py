@@ -0,0 +1,211 @@
+import glob
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import mrcfile
+
+RESOURCES_FILE = 'resources.jsonl'
+COLUMNS = ['job', 'attempt', 'host', 'start', 'wall', 'user_cpu', 'system_cpu', 'max_rss', 'returncode',
+           'output_bytes', 'particles', 'det_pix_x', 'det_pix_y', 'map_voxels', 'map_bytes']
+# parameters of the cost models and the measured resources
+FEATURES = ['particles', 'pixels', 'map_voxels']
+TARGETS = ['wall', 'cpu', 'max_rss']
+
+
+def _kill_on(cancel, pid, finished):
+    while not finished.is_set():
+        if cancel.wait(0.5):
+            # the process is not reaped before `finished` is set, so the pid still belongs to it
+            os.kill(pid, signal.SIGKILL)
+            return
+
+
+def launch(args, tail=2000, cancel=None):
+    """
+    Run a process and measure its resource usage with `os.wait4`.
+    :param args: command line
+    :param tail: number of bytes of the output that are kept
+    :param cancel: threading.Event, the process is killed when it is set
+    :return: return code, the end of the output (stdout and stderr) and a dictionary with the wall time, user and
+             system cpu time in seconds and the peak memory (max_rss) in bytes of the process. On Linux the peak
+             memory is at least the memory of the calling process at the launch, because the kernel keeps the high
+             water mark across the exec of the child, so launch simulations from a small process
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    finished = threading.Event()
+    watcher = None
+    if cancel is not None:
+        watcher = threading.Thread(target=_kill_on, args=(cancel, process.pid, finished), daemon=True)
+        watcher.start()
+    output = b''
+    try:
+        for chunk in iter(lambda: process.stdout.read(1 << 16), b''):
+            output = (output + chunk)[-tail:]
+    finally:
+        process.stdout.close()
+        finished.set()
+        if watcher is not None:
+            watcher.join()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    # the process was waited for, tell Popen about it
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, output.decode(errors='replace'), {
+        'wall': wall, 'user_cpu': usage.ru_utime, 'system_cpu': usage.ru_stime,
+        # ru_maxrss is in kB on Linux, in bytes on macOS
+        'max_rss': usage.ru_maxrss * (1 if os.uname().sysname == 'Darwin' else 1024)}
+
+
+def _parameter(content, name):
+    match = re.search(r'^\s*{}\s*=\s*(\S+)'.format(name), content, flags=re.MULTILINE)
+    return None if match is None else match.group(1)
+
+
+def job_parameters(input_file):
+    """
+    Parameters of a simulation that determine its cost: number of particles, detector size and size of the particle
+    map, read from the input file and the files it refers to. Missing values are None.
+    """
+    with open(input_file) as f:
+        content = f.read()
+    parameters = {'particles': None, 'det_pix_x': None, 'det_pix_y': None, 'map_voxels': None, 'map_bytes': None}
+    for name in ('det_pix_x', 'det_pix_y'):
+        value = _parameter(content, name)
+        parameters[name] = None if value is None else int(value)
+    try:
+        # the first line of the coordinates file is the number of particles (the first particle set)
+        with open(_parameter(content, 'coord_file_in')) as f:
+            parameters['particles'] = int(f.readline().split()[0])
+    except (TypeError, OSError, ValueError, IndexError):
+        pass
+    map_file = _parameter(content, 'map_file_re_in')
+    try:
+        with mrcfile.open(map_file, permissive=True, header_only=True) as mrc:
+            header = mrc.header
+            parameters['map_voxels'] = int(header.nx) * int(header.ny) * int(header.nz)
+        parameters['map_bytes'] = os.path.getsize(map_file)
+    except (TypeError, OSError, ValueError):
+        pass
+    return parameters
+
+
+def record_job(input_file, rendered, attempt, returncode, usage, outputs):
+    """
+    Add the resource usage of a simulation to `resources.jsonl` in its micrograph directory. Every attempt of a
+    simulation is one json line. The file is only appended to, with one write per line (O_APPEND), so workers on
+    several nodes can record jobs of the same micrograph, also on NFS.
+    :param input_file: input file of the job, its directory is the micrograph directory
+    :param rendered: input file the simulator was run with (different from `input_file` for job manifests)
+    :param attempt: number of the attempt, starting at 1
+    :param usage: resource usage, see `launch`
+    :param outputs: output files of the simulation
+    """
+    record = dict(usage, job=os.path.basename(input_file), attempt=attempt, host=socket.gethostname(),
+                  start=time.time() - usage['wall'], returncode=returncode,
+                  output_bytes=sum(os.path.getsize(o) for o in outputs if os.path.isfile(o)))
+    record.update(job_parameters(rendered))
+    line = (json.dumps({c: record.get(c) for c in COLUMNS}) + '\n').encode()
+    fd = os.open(os.path.join(os.path.dirname(input_file), RESOURCES_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_resources(run_dir):
+    """
+    Resource usage of all simulations of a run.
+    :return: DataFrame with the columns `COLUMNS` and micrograph, cpu (user + system) and pixels
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(run_dir, '*', RESOURCES_FILE))):
+        micrograph = os.path.basename(os.path.dirname(path))
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(dict(json.loads(line), micrograph=micrograph))
+                except ValueError:
+                    # line of a worker that died while writing it
+                    continue
+    if not records:
+        return pd.DataFrame(columns=['micrograph'] + COLUMNS + ['cpu', 'pixels'])
+    resources = pd.DataFrame(records, columns=['micrograph'] + COLUMNS)
+    resources['cpu'] = resources['user_cpu'] + resources['system_cpu']
+    resources['pixels'] = resources['det_pix_x'] * resources['det_pix_y']
+    return resources
+
+
+def fit_cost_model(resources, target, features=FEATURES):
+    """
+    Least squares fit of a linear cost model, target = c0 + c1 * feature1 + c2 * feature2 + ...
+    Features without variation in the data are left out, their effect is part of the constant.
+    :return: dictionary with the coefficients (key 'const' for c0), R² and the number of jobs used
+    """
+    data = resources[[target] + list(features)].dropna().astype(np.float64)
+    used = [f for f in features if data[f].nunique() > 1]
+    design = np.column_stack([np.ones(len(data))] + [data[f].to_numpy() for f in used])
+    y = data[target].to_numpy()
+    if len(data) <= len(used):
+        return {'jobs': len(data), 'r2': np.nan}
+    coefficients, _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    residual = y - design @ coefficients
+    total = np.sum((y - y.mean()) ** 2)
+    model = dict(zip(['const'] + used, coefficients))
+    model['r2'] = 1 - np.sum(residual ** 2) / total if total > 0 else np.nan
+    model['jobs'] = len(data)
+    return model
+
+
+def main(run_dirs, output=None):
+    resources = pd.concat([read_resources(d).assign(run=d) for d in run_dirs], ignore_index=True)
+    # the cost models are fitted to the successful attempts
+    done = resources[resources['returncode'] == 0]
+    print('{} attempts of {} jobs, {} failed'.format(len(resources), resources.groupby(['run', 'micrograph', 'job'])
+                                                     .ngroups, int((resources['returncode'] != 0).sum())))
+    if done.empty:
+        return
+    print('Wall time: mean {:.1f} s, max {:.1f} s, total {:.2f} h'.format(done['wall'].mean(), done['wall'].max(),
+                                                                         done['wall'].sum() / 3600))
+    print('CPU time: mean {:.1f} s, total {:.2f} h'.format(done['cpu'].mean(), done['cpu'].sum() / 3600))
+    print('Peak memory: mean {:.2f} GB, max {:.2f} GB'.format(done['max_rss'].mean() / 1e9, done['max_rss'].max() / 1e9))
+    print('Output: {:.2f} GB'.format(done['output_bytes'].sum() / 1e9))
+
+    models = []
+    for target in TARGETS:
+        model = fit_cost_model(done, target)
+        terms = ' + '.join('{:.4g} * {}'.format(v, k) for k, v in model.items() if k not in ('const', 'r2', 'jobs'))
+        print('{} = {:.4g}{} (R² = {:.3f}, {} jobs)'.format(target, model.get('const', np.nan),
+                                                          ' + ' + terms if terms else '', model['r2'], model['jobs']))
+        models.append(dict(model, target=target))
+
+    if output is not None:
+        pd.DataFrame(models).to_csv(output, index=False)
+        print('Cost models written to', output)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Summarize the resource usage of the simulations recorded by '
+                                                 'run_simulations.py and work_queue.py (resources.jsonl in every micrograph '
+                                                 'directory) and fit linear cost models of the wall time, cpu time and '
+                                                 'peak memory as function of the number of particles, the number of '
+                                                 'detector pixels and the number of voxels of the particle map.')
+    parser.add_argument('run_dirs', type=str, nargs='+',
+                        help='Output directories of gen_temsim_input_files.py')
+    parser.add_argument('--o', type=str, default=None,
+                        help='Write the coefficients of the cost models to this csv file')
+
+    args = parser.parse_args()
+
+    main(args.run_dirs, args.o)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from create_filtered_maps import prepare_map, exposure_term, write_filtered_map
+
+PINS_DIR = 'pins'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    SHA-256 hash of the content of a file.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class FilteredMapStore:
+    """
+    Content addressed store of damage filtered maps.
+
+    Maps are keyed by the hash of the input map, the voxel size, the intensity factor and the cumulative dose.
+    Missing maps are generated on demand with the damage filter of `create_filtered_maps.py`. Concurrent requests for
+    the same map (also from other processes) are deduplicated with lock files, and the least recently used maps are
+    removed when the store grows beyond `max_bytes`.
+
+    Maps requested for a run are pinned in `pins/<run>.jsonl` of the store, because their paths are written into the
+    input files of the run. Pinned maps are not removed, by any process, until all simulations of the run are done
+    or the run directory is deleted. The store can exceed `max_bytes` if the pinned maps do not fit.
+    """
+
+    def __init__(self, root, max_bytes=None, lock_timeout=3600, run_dir=None):
+        """
+        :param run_dir: output directory of the run that uses the maps, for pinning them. Without run directory, maps
+                        are only protected from removal by this store instance
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.run_dir = None if run_dir is None else os.path.abspath(run_dir)
+        os.makedirs(os.path.join(self.root, PINS_DIR), exist_ok=True)
+        self._hashes = {}  # (path, size, mtime) -> hash of the input map
+        self._paths = {}  # key -> path of filtered map, for maps requested by this store, they are not evicted
+        self._prepared = (None, None)  # (hash, voxel size, factor) -> prepared spectrum of the last map
+
+    def _map_hash(self, map_in):
+        st = os.stat(map_in)
+        stat_key = (os.path.realpath(map_in), st.st_size, st.st_mtime_ns)
+        if stat_key not in self._hashes:
+            self._hashes[stat_key] = file_hash(map_in)
+        return self._hashes[stat_key]
+
+    def key(self, map_in, voxel_size, factor, dose):
+        """
+        Key of a filtered map. Doses are rounded to 1e-6 e/A², so different ways of computing the dose schedule
+        lead to the same key.
+        """
+        description = '{}:{!r}:{!r}:{:.6f}'.format(self._map_hash(map_in), float(voxel_size), float(factor),
+                                                    float(dose))
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.mrc')
+
+    def get(self, map_in, voxel_size, factor, dose):
+        """
+        Path of the damage filtered map. The map is generated if it is not in the store yet.
+        :param map_in: input density map (.mrc)
+        :param voxel_size: voxel size of the map in A
+        :param factor: reduce the intensity of the scattering potential by this factor
+        :param dose: cumulative electron exposure in e/A²
+        :return: absolute path to the filtered map
+        """
+        key = self.key(map_in, voxel_size, factor, dose)
+        # the map may have been evicted by another process, then it is generated again
+        if key in self._paths and os.path.isfile(self._paths[key]):
+            return self._paths[key]
+
+        path = self.path(key)
+        # pinned before it is generated, so other processes do not remove it in between
+        self._pin(path)
+        lock = path + '.lock'
+        while not os.path.isfile(path):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # another process generates this map, wait for it or take over a stale lock
+                try:
+                    if time.time() - os.stat(lock).st_mtime > self.lock_timeout:
+                        os.remove(lock)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.5)
+                continue
+            os.close(fd)
+            try:
+                if not os.path.isfile(path):
+                    self._generate(map_in, voxel_size, factor, dose, path)
+                    print("Created damage filtered map with a cumulative dose of {:5.3f} e/A²".format(dose))
+            finally:
+                os.remove(lock)
+            self._evict(keep=path)
+
+        # mark the map as recently used
+        os.utime(path)
+        self._paths[key] = path
+        return path
+
+    def _pin(self, path):
+        if self.run_dir is None or path in self._paths.values():
+            return
+        line = (json.dumps({'run_dir': self.run_dir, 'map': path}) + '\n').encode()
+        fd = os.open(pin_file(self.root, self.run_dir), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _generate(self, map_in, voxel_size, factor, dose, path):
+        prepared_key = (self._map_hash(map_in), float(voxel_size), float(factor))
+        if self._prepared[0] != prepared_key:
+            self._prepared = (None, None)  # free the previous spectrum first
+            ft_map, shape, background_potential = prepare_map(map_in, factor)
+            term = exposure_term(shape, voxel_size, np.float32)
+            self._prepared = (prepared_key, (ft_map, term, shape, background_potential))
+        ft_map, term, shape, background_potential = self._prepared[1]
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        write_filtered_map(ft_map, term, dose, shape, background_potential, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        pinned = set(self._paths.values()) | pinned_maps(self.root)
+        pinned.add(keep)
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.mrc') and entry.path not in pinned:
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(e[1] for e in entries) + sum(os.path.getsize(p) for p in pinned if os.path.isfile(p))
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def pin_file(root, run_dir):
+    """
+    File with the maps of a filtered map store that are pinned by a run.
+    """
+    name = hashlib.sha256(os.path.abspath(run_dir).encode()).hexdigest()[:16]
+    return os.path.join(root, PINS_DIR, name + '.jsonl')
+
+
+def _run_finished(run_dir):
+    # imported here, run_simulations depends on this module through gen_temsim_input_files
+    from run_simulations import find_jobs, is_done
+
+    if not os.path.isdir(run_dir):
+        return True
+    jobs = find_jobs(run_dir)
+    # a run without jobs is still being written
+    return bool(jobs) and all(is_done(j) for j in jobs)
+
+
+def pinned_maps(root):
+    """
+    Maps of a filtered map store that are pinned by runs with simulations that are not done. The pins of finished
+    runs are removed.
+    """
+    pinned = set()
+    for entry in os.scandir(os.path.join(root, PINS_DIR)):
+        if not entry.name.endswith('.jsonl'):
+            continue
+        try:
+            with open(entry.path) as f:
+                pins = [json.loads(line) for line in f if line.endswith('\n')]
+        except FileNotFoundError:
+            continue
+        if not pins:
+            continue
+        if _run_finished(pins[0]['run_dir']):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            continue
+        pinned.update(p['map'] for p in pins)
+    return pinned
@@ -0,0 +1,191 @@
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# lines with the shift of a frame, e.g. `...... Frame (  1) shift:    -1.2345      2.3456`
+SHIFT_LINE = re.compile(r'^\.\.\.\.\.\. Frame [^\n]*?([-+]?\d*\.\d+)[^\n]*?([-+]?\d*\.\d+)', re.MULTILINE)
+# suffixes MotionCor2 appends to the micrograph name
+LOG_SUFFIX = re.compile(r'(0?-Patch-Full|0?-Full|0?-Patch-Patch|0?-Patch-Frame)?\.log$')
+
+
+def parse_motioncor_log(text):
+    """
+    Frame shifts from the content of a MotionCor log file.
+    :param text: content of the log file
+    :return: (n, 2) float array with the x and y shift of every frame in pixels
+    """
+    shifts = SHIFT_LINE.findall(text)
+    return np.array(shifts, dtype=np.float64).reshape(-1, 2)
+
+
+def read_motioncor_log(motioncor_log):
+    """
+    Frame shifts from a MotionCor log file.
+    :param motioncor_log: path to motioncor log file
+    :return: (n, 2) float array with the x and y shift of every frame in pixels
+    """
+    with open(motioncor_log) as f:
+        return parse_motioncor_log(f.read())
+
+
+def micrograph_name(motioncor_log):
+    """
+    Name of the micrograph of a MotionCor log file, i.e. the file name without the suffixes added by MotionCor.
+    """
+    return LOG_SUFFIX.sub('', os.path.basename(motioncor_log))
+
+
+def find_logs(log_dir, pattern='*.log'):
+    """
+    All log files in a directory tree.
+    """
+    return sorted(glob.glob(os.path.join(log_dir, '**', pattern), recursive=True))
+
+
+def read_motioncor_logs(logs, workers=1, chunksize=64):
+    """
+    Read the frame shifts of many MotionCor log files into a single table.
+    :param logs: list of paths to log files
+    :param workers: number of worker processes
+    :return: DataFrame with the columns micrograph, log, frame, x, y (shifts in pixels)
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shifts = list(executor.map(read_motioncor_log, logs, chunksize=chunksize))
+    else:
+        shifts = [read_motioncor_log(log) for log in logs]
+
+    counts = np.array([len(s) for s in shifts], dtype=np.intp)
+    values = np.concatenate(shifts) if shifts else np.empty((0, 2))
+    return pd.DataFrame({
+        'micrograph': pd.Categorical(np.repeat([micrograph_name(log) for log in logs], counts)),
+        'log': pd.Categorical(np.repeat(logs, counts)),
+        'frame': np.concatenate([np.arange(n) for n in counts]) if len(counts) else np.empty(0, dtype=np.intp),
+        'x': values[:, 0],
+        'y': values[:, 1],
+    })
+
+
+def read_simulated_drift(run_dir, pixel_size):
+    """
+    Simulated drift (`drift.txt`) of all micrographs of a run of `gen_temsim_input_files.py`.
+    :param run_dir: output directory of `gen_temsim_input_files.py`
+    :param pixel_size: pixel size of the images in A
+    :return: DataFrame with the columns micrograph, frame, true_x, true_y (in pixels)
+    """
+    tables = []
+    for drift_file in sorted(glob.glob(os.path.join(run_dir, '*', 'drift.txt'))):
+        drift = np.atleast_2d(np.loadtxt(drift_file)) * 10 / pixel_size  # nm -> px
+        tables.append(pd.DataFrame({'micrograph': os.path.basename(os.path.dirname(drift_file)),
+                                    'frame': np.arange(len(drift)), 'true_x': drift[:, 0], 'true_y': drift[:, 1]}))
+    if not tables:
+        return pd.DataFrame(columns=['micrograph', 'frame', 'true_x', 'true_y'])
+    return pd.concat(tables, ignore_index=True)
+
+
+def match_micrographs(names, simulated):
+    """
+    Map micrograph names of log files to the simulated micrographs. A log belongs to the simulated micrograph
+    whose name is contained in the name of the log between underscores, e.g. `20S_001_Mar28_14.59.32_stack` belongs to
+    `20S_001_Mar28_14.59.32`. The longest match is used. The parts of the log name are looked up in a set, so the
+    time does not grow with the number of simulated micrographs.
+    """
+    simulated = set(simulated)
+    matches = {}
+    for name in names:
+        parts = name.split('_')
+        candidates = ('_'.join(parts[i:i + n]) for n in range(len(parts), 0, -1) for i in range(len(parts) - n + 1))
+        matches[name] = next((c for c in candidates if c in simulated), None)
+    return matches
+
+
+def drift_accuracy(shifts, drift, invert=False, reference=None):
+    """
+    Compare the frame shifts estimated by MotionCor with the simulated drift. Both trajectories are moved to the same
+    position at the reference frame before the comparison.
+    :param shifts: table of `read_motioncor_logs`
+    :param drift: table of `read_simulated_drift`
+    :param invert: invert the sign of the MotionCor shifts
+    :param reference: reference frame, default is the middle frame of every micrograph (as in MotionCor2)
+    :return: table with the error of every frame and table with the RMSD of every micrograph
+    """
+    shifts = shifts.copy()
+    names = match_micrographs(shifts['micrograph'].unique(), drift['micrograph'].unique())
+    shifts['micrograph'] = shifts['micrograph'].astype(str).map(names)
+    frames = shifts.merge(drift.astype({'micrograph': str}), on=['micrograph', 'frame'], how='inner')
+
+    sign = -1 if invert else 1
+    grouped = frames.groupby('log', observed=True)
+    n_frames = grouped['frame'].transform('size')
+    ref = (n_frames // 2) if reference is None else pd.Series(reference, index=frames.index)
+    is_ref = frames['frame'] == ref
+    for axis in 'xy':
+        estimated = sign * frames[axis]
+        true = frames['true_' + axis]
+        ref_estimated = estimated.where(is_ref).groupby(frames['log'], observed=True).transform('max')
+        ref_true = true.where(is_ref).groupby(frames['log'], observed=True).transform('max')
+        frames['error_' + axis] = (estimated - ref_estimated) - (true - ref_true)
+    frames['error'] = np.hypot(frames['error_x'], frames['error_y'])
+
+    squared = (frames['error'] ** 2).groupby([frames['micrograph'], frames['log']], observed=True)
+    per_micrograph = pd.DataFrame({'frames': squared.size(), 'rmsd': np.sqrt(squared.mean()),
+                                   'max_error': frames['error'].groupby([frames['micrograph'], frames['log']],
+                                                                        observed=True).max()}).reset_index()
+    return frames, per_micrograph
+
+
+def summary(per_micrograph):
+    """
+    RMSD statistics over the micrographs of a run.
+    """
+    rmsd = per_micrograph['rmsd']
+    return {'micrographs': len(rmsd), 'mean_rmsd': rmsd.mean(), 'median_rmsd': rmsd.median(),
+            'max_rmsd': rmsd.max()}
+
+
+def main(runs, pixel_size, pattern, invert, output, workers=1):
+    results = []
+    for run in runs:
+        run_dir, _, log_dir = run.partition(':')
+        logs = find_logs(log_dir or run_dir, pattern)
+        shifts = read_motioncor_logs(logs, workers)
+        drift = read_simulated_drift(run_dir, pixel_size)
+        frames, per_micrograph = drift_accuracy(shifts, drift, invert)
+        per_micrograph.insert(0, 'run', run_dir)
+        results.append(per_micrograph)
+
+        stats = summary(per_micrograph)
+        print('{}: {} logs, {} micrographs matched, RMSD mean {:.3f} px, median {:.3f} px, max {:.3f} px'.format(
+            run_dir, len(logs), stats['micrographs'], stats['mean_rmsd'], stats['median_rmsd'], stats['max_rmsd']))
+
+    if output is not None and results:
+        pd.concat(results, ignore_index=True).to_csv(output, index=False)
+        print('RMSD of every micrograph written to', output)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Read the frame shifts of MotionCor log files and compare them with the '
+                                                 'simulated drift (drift.txt) of gen_temsim_input_files.py.')
+    parser.add_argument('runs', type=str, nargs='+',
+                        help='Output directories of gen_temsim_input_files.py. Use RUN_DIR:LOG_DIR if the MotionCor logs '
+                             'are not in the run directory')
+    parser.add_argument('--apix', type=float, required=True,
+                        help='Pixel size of the movies in A, to convert the simulated drift (nm) to pixels')
+    parser.add_argument('--pattern', type=str, default='*.log',
+                        help='File name pattern of the log files. Default = *.log')
+    parser.add_argument('--invert', action='store_true', default=False,
+                        help='Invert the sign of the MotionCor shifts before comparing them with the simulated drift')
+    parser.add_argument('--o', type=str, default=None,
+                        help='Write the RMSD of every micrograph to this csv file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes that read the log files. Default = 1')
+
+    args = parser.parse_args()
+
+    main(args.runs, args.apix, args.pattern, args.invert, args.o, args.workers)
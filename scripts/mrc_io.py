@@ -0,0 +1,102 @@
+##############################################################################################################
+# Disables `Unrecognized machine stamp` warning for reading mrc files
+
+import warnings
+
+warnings.simplefilter("ignore")
+
+##############################################################################################################
+
+import os
+
+import numpy as np
+import mrcfile
+import mrcfile.utils
+
+
+def open_mmap(path):
+    """
+    Open an mrc file read-only and memory-mapped. Only the parts of the data that are accessed are read from disk.
+    Use it as context manager, the data is only valid as long as the file is open.
+    :param path: path to mrc/mrcs file
+    :return: mrcfile.mrcmemmap.MrcMemmap
+    """
+    return mrcfile.mmap(path, mode='r', permissive=True)
+
+
+def n_frames(path):
+    """
+    Number of frames (sections) in an mrc file. Single images count as one frame.
+    """
+    with open_mmap(path) as mrc:
+        return 1 if mrc.data.ndim == 2 else mrc.data.shape[0]
+
+
+def _frame(data, n):
+    if data.ndim == 2:
+        if n != 0:
+            raise IndexError('frame {} out of range for a single image'.format(n))
+        return data
+    return data[n]
+
+
+def read_region(path, y0, y1, x0, x1, frame=0):
+    """
+    Read a rectangular region of an image. Only the rows of the region are read from disk.
+    The region is clipped at the image borders.
+    :param path: path to mrc/mrcs file
+    :param y0, y1: first and last (exclusive) row
+    :param x0, x1: first and last (exclusive) column
+    :param frame: frame number for stacks
+    :return: numpy array with a copy of the region
+    """
+    with open_mmap(path) as mrc:
+        image = _frame(mrc.data, frame)
+        ny, nx = image.shape
+        return np.array(image[max(0, int(y0)):min(ny, int(y1)), max(0, int(x0)):min(nx, int(x1))])
+
+
+def read_frame(path, n):
+    """
+    Read a single frame of an mrc stack into memory.
+    :param path: path to mrc/mrcs file
+    :param n: frame number, starting at 0
+    :return: 2D numpy array
+    """
+    with open_mmap(path) as mrc:
+        return np.array(_frame(mrc.data, n))
+
+
+def iter_frames(path, start=0, stop=None):
+    """
+    Lazily iterate over the frames of an mrc stack. Only one frame at a time is read into memory.
+    :param path: path to mrc/mrcs file
+    :param start: first frame
+    :param stop: last frame (exclusive), default is the end of the stack
+    :return: generator of 2D numpy arrays
+    """
+    with open_mmap(path) as mrc:
+        data = mrc.data
+        n = 1 if data.ndim == 2 else data.shape[0]
+        for i in range(start, n if stop is None else min(stop, n)):
+            yield np.array(_frame(data, i))
+
+
+def is_complete(path):
+    """
+    Check that an mrc file exists and contains all the data announced in its header, e.g. to detect files that were
+    only partially written by a process that died.
+    :param path: path to mrc/mrcs file
+    :return: True or False
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        with mrcfile.open(path, permissive=True, header_only=True) as mrc:
+            header = mrc.header
+            dtype = mrcfile.utils.data_dtype_from_header(header)
+            n_voxels = int(header.nx) * int(header.ny) * int(header.nz)
+            expected = header.nbytes + int(header.nsymbt) + n_voxels * dtype.itemsize
+    except (OSError, ValueError):
+        return False
+    return n_voxels > 0 and os.path.getsize(path) >= expected
@@ -7,164 +7,306 @@ warnings.simplefilter("ignore")
 
 ##############################################################################################################
 
-import pandas as pd
 import numpy as np
-import mrcfile
 import matplotlib.pyplot as plt
 import os
+import sqlite3
+import time
+from functools import lru_cache
+from multiprocessing import Pool
 
+import instrument
+from instrument import span
+from mrc_io import open_mmap
 
-def spinavej(x):
-    '''
-    source: https://github.com/s-sajid-ali/FRC
-    '''
-    shape = np.shape(x)
-    dim = np.size(shape)
-    '''
-    Depending on the dimension of the image 2D/3D, create an array of integers 
-    which increase with distance from the center of the array
-    '''
-    if dim == 2:
-        nr, nc = shape
-        nrdc = np.floor(nr / 2) + 1
-        ncdc = np.floor(nc / 2) + 1
-        r = np.arange(nr) - nrdc + 1
-        c = np.arange(nc) - ncdc + 1
-        [R, C] = np.meshgrid(r, c)
-        index = np.round(np.sqrt(R ** 2 + C ** 2)) + 1
-
-    elif dim == 3:
-        nr, nc, nz = shape
-        nrdc = np.floor(nr / 2) + 1
-        ncdc = np.floor(nc / 2) + 1
-        nzdc = np.floor(nz / 2) + 1
-        r = np.arange(nr) - nrdc + 1
-        c = np.arange(nc) - ncdc + 1
-        z = np.arange(nz) - nzdc + 1
-        [R, C, Z] = np.meshgrid(r, c, z)
-        index = np.round(np.sqrt(R ** 2 + C ** 2 + Z ** 2)) + 1
-    else:
-        print('input is neither a 2d or 3d array')
-    '''
-    The index array has integers from 1 to maxindex arranged according to distance
-    from the center
-    '''
-    maxindex = np.max(index)
-    output = np.zeros(int(maxindex), dtype=complex)
-
-    '''
-    In the next step the output is generated. The output is an array of length
-    maxindex. The elements in this array corresponds to the sum of all the elements
-    in the original array corresponding to the integer position of the output array 
-    divided by the number of elements in the index array with the same value as the
-    integer position. 
-
-    Depening on the size of the input array, use either the pixel or index method.
-    By-pixel method for large arrays and by-index method for smaller ones.
-    '''
-    if nr >= 512:
-        print('performed by pixel method')
-        sumf = np.zeros(int(maxindex), dtype=complex)
-        count = np.zeros(int(maxindex), dtype=complex)
-        for ri in range(nr):
-            for ci in range(nc):
-                sumf[int(index[ri, ci]) - 1] = sumf[int(index[ri, ci]) - 1] + x[ri, ci]
-                count[int(index[ri, ci]) - 1] = count[int(index[ri, ci]) - 1] + 1
-        output = sumf / count
-        return output
-    else:
-        print('performed by index method')
-        indices = []
-        for i in np.arange(int(maxindex)):
-            indices.append(np.where(index == i + 1))
-            output[i] = sum(x[indices[i]]) / len(indices[i][0])
-        return output
-
-
-def get_origin_of_patches(shape, patch_size=(512, 512)):
+
+@lru_cache(maxsize=16)
+def radial_index(shape):
+    """
+    Integer distance of every element from the center of an array with the given shape (2D or 3D).
+    The center is the same as the one of `np.fft.fftshift`. Results are cached, so repeated calls for
+    arrays of the same shape reuse the index.
+    :param shape: tuple with the array shape
+    :return: flattened radius index and the number of elements for every radius
+    """
+    if len(shape) not in (2, 3):
+        raise ValueError('input is neither a 2d or 3d array')
+    grids = np.ogrid[tuple(slice(-(n // 2), n - n // 2) for n in shape)]
+    index = np.round(np.sqrt(sum(g.astype(np.float64) ** 2 for g in grids))).astype(np.intp).ravel()
+    counts = np.bincount(index)
+    index.flags.writeable = False
+    return index, counts
+
+
+def radial_average(x):
+    """
+    Radial (2D) or spherical (3D) average of a centered array, e.g. a power spectrum after `np.fft.fftshift`.
+    :param x: 2D or 3D numpy array
+    :return: real valued array with the average for every integer radius, starting at the center
+    """
+    index, counts = radial_index(np.shape(x))
+    sums = np.bincount(index, weights=np.real(x).ravel(), minlength=len(counts))
+    return sums / counts
+
+
+@lru_cache(maxsize=16)
+def rfft_radial_index(shape):
+    """
+    Radius index for the half spectrum returned by `np.fft.rfft2` of a real 2D array with the given shape.
+    Columns that stand for two mirrored frequencies of the full spectrum get a weight of 2, so averages are the
+    same as the ones of `radial_average` applied to the full, centered spectrum.
+    :param shape: tuple with the shape of the real input array
+    :return: flattened radius index, weights and the (weighted) number of elements for every radius
+    """
+    ny, nx = shape
+    ky = np.fft.fftfreq(ny, 1 / ny)[:, None]
+    kx = np.fft.rfftfreq(nx, 1 / nx)[None, :]
+    index = np.round(np.sqrt(ky ** 2 + kx ** 2)).astype(np.intp)
+    weights = np.ones(index.shape)
+    weights[:, 1:(nx - 1) // 2 + 1] = 2
+    index, weights = index.ravel(), weights.ravel()
+    counts = np.bincount(index, weights=weights)
+    index.flags.writeable = False
+    weights.flags.writeable = False
+    return index, weights, counts
+
+
+def rfft_radial_average(ps, shape):
+    """
+    Radial average of a half spectrum (`np.fft.rfft2` layout, not shifted).
+    :param ps: 2D numpy array, e.g. the output of `PS`
+    :param shape: tuple with the shape of the real array the half spectrum was computed from
+    :return: array with the average for every integer radius, starting at the zero frequency
+    """
+    index, weights, counts = rfft_radial_index(tuple(shape))
+    sums = np.bincount(index, weights=weights * np.ravel(ps), minlength=len(counts))
+    return sums / counts
+
+
+def get_origin_of_patches(shape, patch_size=(512, 512), overlap=0):
     """
     Divide an image into multiple patches of specified patch size tuple
     :param shape: tuple with image size in pixels
     :param patch_size: tuple patch size in pixels
+    :param overlap: fraction of the patch size by which neighbouring patches overlap (e.g. 0.5)
     :return: list of the origins for the patches
     """
-    width, height = shape
-    x, y = patch_size
-
-    nx = width // x  # number of patches in x direction
-    ny = height // y  # number of patches in y direction
-    center = [width // 2, height // 2]  # center of the image
-
-    origin_x = center[0] - nx * x // 2
-    origin_y = center[1] - ny * y // 2
+    (origin_x, origin_y), (nx, ny), (step_x, step_y) = _patch_grid(shape, patch_size, overlap)
 
     origins = []
     for i in range(nx):
         for j in range(ny):
-            origin = (origin_x + x * i, origin_y + y * j)
+            origin = (origin_x + step_x * i, origin_y + step_y * j)
             origins.append(origin)
 
     return origins
 
 
-def PS(path, patch_size=None):
-    data = mrcfile.open(path, permissive=True).data
-    mean = data.mean()
-    image = data.copy() / mean
-
-    if patch_size is None:
-        image = image[:min(image.shape), :min(image.shape)]  # crop to square image
-        ft = np.fft.fft2(image)
-        ps = np.abs(ft) ** 2
-    else:
-        ps = np.zeros(patch_size)
-        origins = get_origin_of_patches(image.shape, patch_size)
-        for origin in origins:
-            patch = image[origin[0]:origin[0] + patch_size[0], origin[1]:origin[1] + patch_size[1]]
-            ft = np.fft.fft2(patch)
-            ps += np.abs(ft) ** 2
+def _patch_grid(shape, patch_size, overlap):
+    width, height = shape
+    x, y = patch_size
+    if not 0 <= overlap < 1:
+        raise ValueError('overlap has to be in the interval [0, 1)')
+
+    step_x = max(1, int(round(x * (1 - overlap))))
+    step_y = max(1, int(round(y * (1 - overlap))))
+    nx = max(0, (width - x) // step_x + 1)  # number of patches in x direction
+    ny = max(0, (height - y) // step_y + 1)  # number of patches in y direction
+    center = [width // 2, height // 2]  # center of the image
+
+    # the grid of patches is centered in the image
+    origin_x = center[0] - ((nx - 1) * step_x + x) // 2 if nx else 0
+    origin_y = center[1] - ((ny - 1) * step_y + y) // 2 if ny else 0
+    return (origin_x, origin_y), (nx, ny), (step_x, step_y)
+
+
+def patch_view(image, patch_size=(512, 512), overlap=0):
+    """
+    Read-only strided view of all patches of an image, no data is copied.
+    :param image: 2D numpy array
+    :param patch_size: tuple patch size in pixels
+    :param overlap: fraction of the patch size by which neighbouring patches overlap
+    :return: 4D array with shape (nx, ny, patch_size[0], patch_size[1])
+    """
+    (origin_x, origin_y), (nx, ny), (step_x, step_y) = _patch_grid(image.shape, patch_size, overlap)
+    s0, s1 = image.strides
+    return np.lib.stride_tricks.as_strided(image[origin_x:, origin_y:],
+                                           shape=(nx, ny) + tuple(patch_size),
+                                           strides=(step_x * s0, step_y * s1, s0, s1),
+                                           writeable=False)
+
+
+def PS(path, patch_size=None, overlap=0):
+    """
+    Power spectrum of a micrograph normalized by its mean value, as half spectrum (`np.fft.rfft2` layout).
+    The micrograph is memory-mapped instead of being read into memory at once.
+    With a patch size, the power spectra of all patches are summed up. Patches are transformed in batches of one
+    row of patches with a single real FFT and the result is accumulated in single precision. The mean is taken over
+    the transformed pixels (the cropped image or the patches), so only the pixels that are used are read. Pixels in
+    the overlap of patches count once per patch, like in the summed power spectrum.
+    :param path: path to the mrc file
+    :param patch_size: tuple patch size in pixels or None to use the whole (square cropped) image
+    :param overlap: fraction of the patch size by which neighbouring patches overlap (e.g. 0.5 for Welch's method)
+    :return: 2D float32 array
+    """
+    with open_mmap(path) as mrc:
+        data = mrc.data
+
+        if patch_size is None:
+            n = min(data.shape)
+            image = data[:n, :n].astype(np.float32)  # crop to square image
+            mean = image.mean(dtype=np.float64)
+            ps = _power(np.fft.rfft2(image))
+        else:
+            ps = np.zeros((patch_size[0], patch_size[1] // 2 + 1), dtype=np.float32)
+            total = 0.0
+            count = 0
+            # only the rows of the current row of patches are read from disk
+            for row in patch_view(data, patch_size, overlap):
+                patches = row.astype(np.float32)
+                total += patches.sum(dtype=np.float64)
+                count += patches.size
+                ft = np.fft.rfft2(patches, axes=(-2, -1))
+                ps += _power(ft).sum(axis=0, dtype=np.float32)
+            if count == 0:
+                raise ValueError('image {} with shape {} is smaller than the patch size {}'.format(
+                    path, data.shape, tuple(patch_size)))
+            mean = total / count
+    # the image is normalized by its mean, which scales the power spectrum by 1 / mean²
+    ps /= np.float32(mean ** 2)
     return ps
 
 
-def radp(path, **kwargs):
-    ps = PS(path, **kwargs)
+def _power(ft):
+    return (ft.real ** 2 + ft.imag ** 2).astype(np.float32, copy=False)
+
+
+def radp(path, patch_size=None, overlap=0):
+    with span('power_spectrum', path=path, patch=patch_size):
+        ps = PS(path, patch_size=patch_size, overlap=overlap)
+    shape = patch_size if patch_size is not None else (ps.shape[0], ps.shape[0])
     x = np.linspace(0, 0.5, ps.shape[0] // 2)
-    rad_avg = spinavej(np.fft.fftshift(ps))
-    y = np.real(rad_avg[:len(x)])
+    with span('radial_average'):
+        rad_avg = rfft_radial_average(ps, shape)
+    y = rad_avg[:len(x)]
     return x, y
 
 
-def main(images, labels, patch_size, output_csv):
+def _profile(job):
+    im, patch_size, overlap = job
+    start = time.time()
+    with span('profile', path=im):
+        if patch_size < 0:
+            x, y = radp(im)
+        else:
+            x, y = radp(im, patch_size=(patch_size, patch_size), overlap=overlap)
+    return im, x, y, time.time() - start
+
+
+def compute_profiles(images, patch_size, overlap=0, workers=1):
+    """
+    Compute the radial profiles of many micrographs, distributed over a pool of worker processes.
+    :param images: list of paths to mrc files
+    :param patch_size: patch size in pixels, negative values to not use patches
+    :param overlap: fraction of the patch size by which neighbouring patches overlap
+    :param workers: number of worker processes
+    :return: dictionary with the (x, y) profile for every image
+    """
+    jobs = [(im, patch_size, overlap) for im in images]
+    profiles = {}
+    start = time.time()
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(_profile, jobs) if pool is not None else map(_profile, jobs)
+        for n, (im, x, y, elapsed) in enumerate(results, 1):
+            profiles[im] = (x, y)
+            print('[{}/{}] {} ({:.2f} s)'.format(n, len(jobs), im, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    if jobs:
+        print('Computed {} radial profiles in {:.1f} s ({:.2f} s per micrograph, {} workers)'.format(
+            len(jobs), elapsed, elapsed / len(jobs), workers))
+    return profiles
+
+
+class ProfileStore:
+    """
+    Binary store of radial profiles in an SQLite database. Every entry holds the profile as compact float32 arrays
+    and is keyed by the path of the micrograph and the parameters of the power spectrum (patch size, overlap).
+    The size and modification time of the micrograph are stored with the entry, so profiles of files that changed
+    are recognized as stale and computed again. Lookups use the primary key index and do not load other entries.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS profiles ('
+                                'path TEXT, patch INTEGER, overlap REAL, size INTEGER, mtime_ns INTEGER, '
+                                'x BLOB, y BLOB, PRIMARY KEY (path, patch, overlap))')
+
+    @staticmethod
+    def _key(image, patch_size, overlap):
+        return os.path.realpath(image), int(patch_size), float(overlap) if patch_size >= 0 else 0.0
+
+    @staticmethod
+    def _stat(image):
+        st = os.stat(image)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, image, patch_size, overlap=0):
+        """
+        :return: (x, y) profile or None if there is no valid entry for the image
+        """
+        row = self.connection.execute('SELECT size, mtime_ns, x, y FROM profiles '
+                                      'WHERE path = ? AND patch = ? AND overlap = ?',
+                                      self._key(image, patch_size, overlap)).fetchone()
+        if row is None or tuple(row[:2]) != self._stat(image):
+            return None
+        return np.frombuffer(row[2], dtype=np.float32), np.frombuffer(row[3], dtype=np.float32)
+
+    def put_many(self, profiles, patch_size, overlap=0):
+        """
+        Add or replace profiles in a single transaction.
+        :param profiles: dictionary with the (x, y) profile for every image
+        """
+        rows = [self._key(im, patch_size, overlap) + self._stat(im) +
+                (np.asarray(x, dtype=np.float32).tobytes(), np.asarray(y, dtype=np.float32).tobytes())
+                for im, (x, y) in profiles.items()]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def main(images, labels, patch_size, store_file, overlap=0, workers=1):
     fig, ax = plt.subplots()
 
+    store = ProfileStore(store_file)
+    profiles = {}
     missing = []
-
-    if os.path.isfile(output_csv):
-        df = pd.read_csv(output_csv, delim_whitespace=True)
+    with span('store_lookup', images=len(images)):
         for im in images:
-            if im + 'x' not in df.columns:
+            profile = store.get(im, patch_size, overlap)
+            if profile is None:
                 missing.append(im)
-    else:
-        missing.extend(images)
-        df = pd.DataFrame()
+            else:
+                profiles[im] = profile
+
+    if missing:
+        with span('compute_profiles', images=len(missing), workers=workers):
+            new_profiles = compute_profiles(missing, patch_size, overlap, workers)
+        with span('store_write', images=len(new_profiles)):
+            store.put_many(new_profiles, patch_size, overlap)
+        profiles.update(new_profiles)
+    store.close()
 
-    for im in missing:
-        data = {}
-        if patch_size < 0:
-            x, y = radp(im)
-        else:
-            x, y = radp(im, patch_size=(patch_size, patch_size))
-        data[im + 'x'] = x
-        data[im + 'y'] = y
-        data = pd.DataFrame(data)
-        df = pd.concat([df, data], axis=1)
-        # df = df.append(data)
-        df.to_csv(output_csv, index=False, sep='\t')
-
-    df = pd.read_csv(output_csv, delim_whitespace=True)
     for n, im in enumerate(images):
-        x = df[im + 'x']
-        y = df[im + 'y']
+        x, y = profiles[im]
         ax.semilogy(x, y, label=im if labels is None else labels[n])
 
     ax.legend()
@@ -183,12 +325,21 @@ if __name__ == '__main__':
                         help='Labels for the output plot.')
     parser.add_argument('--patch', type=int, default=512,
                         help='Patch size for computing the power spectrum. Use negative values to not use patches.')
-    parser.add_argument('--csv', type=str, default="profiles.csv",
-                        help='Name of the csv file containing the results. If file already exists, it is read, so radial profiles do not need to be calculated twice.')
+    parser.add_argument('--overlap', type=float, default=0,
+                        help='Fraction of the patch size by which neighbouring patches overlap, e.g. 0.5. Default = 0')
+    parser.add_argument('--store', type=str, default="profiles.db",
+                        help='Profile store containing the results. If the file already exists, it is used, so radial profiles do not need to be calculated twice. '
+                             'Profiles of micrographs that changed since they were stored are calculated again.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for computing the radial profiles. Default = 1')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Write the time, peak memory and bytes read/written of every stage as json lines to this '
+                             'file (see instrument.py). Default is $TEMSIM_TRACE or no trace')
     args = parser.parse_args()
+    instrument.enable(args.trace)
 
     files = set()
     for pattern in args.micrographs:
         files.update(glob(pattern))
 
-    main(files, args.labels, args.patch, args.csv)
+    main(files, args.labels, args.patch, args.store, args.overlap, args.workers)
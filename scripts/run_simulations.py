@@ -0,0 +1,224 @@
+import glob
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from job_manifest import load_manifest, manifest_of, rendered_input
+from job_resources import launch, record_job
+from mrc_io import is_complete
+from simulation_cache import SimulationCache
+
+MANIFEST = 'simulation_manifest.json'
+
+
+def find_jobs(run_dir):
+    """
+    Find the TEM-Simulator input files written by `gen_temsim_input_files.py`.
+    :param run_dir: output directory of `gen_temsim_input_files.py`
+    :return: sorted list of paths to `input_frame_XX.txt` (and `input_keyframe_XX.txt`) files. For runs with a job
+             manifest, the paths of the input files that are rendered before the simulation
+    """
+    jobs = set(glob.glob(os.path.join(run_dir, '*', 'input_*frame_*.txt')))
+    manifest = load_manifest(run_dir)
+    if manifest is not None:
+        jobs.update(manifest.jobs)
+    return sorted(jobs)
+
+
+def expected_outputs(input_file):
+    """
+    Output files of a simulation, read from the `image_file_out` parameters of the input file.
+    """
+    if not os.path.isfile(input_file):
+        manifest = manifest_of(input_file)
+        if manifest is not None:
+            return manifest.outputs(input_file)
+    with open(input_file) as f:
+        return re.findall(r'^\s*image_file_out\s*=\s*(\S+)', f.read(), flags=re.MULTILINE)
+
+
+def is_done(input_file):
+    """
+    A simulation is done if all its output files exist and are complete.
+    """
+    outputs = expected_outputs(input_file)
+    return bool(outputs) and all(is_complete(o) for o in outputs)
+
+
+def default_workers(mem_per_job):
+    """
+    Number of simulations that can run at the same time, limited by the number of cores and the physical memory.
+    :param mem_per_job: expected memory usage of one simulation in GB
+    """
+    cores = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return cores
+    return max(1, min(cores, int(memory // (mem_per_job * 1e9))))
+
+
+def run_simulation(exe, input_file, cancel=None):
+    """
+    Run TEM-Simulator once.
+    :param exe: path to the TEM-Simulator executable
+    :param input_file: path to the input file
+    :param cancel: threading.Event, the simulator is killed when it is set
+    :return: return code, the end of the output of the simulator and its resource usage (see `job_resources.launch`)
+    """
+    return launch([exe, input_file], cancel=cancel)
+
+
+def run_job(exe, input_file, retries=2, cache=None, cancel=None):
+    """
+    Run the simulation of one frame and retry if it fails. A simulation fails if the simulator returns an error
+    or if any of the output files is missing or incomplete.
+    :param cache: `SimulationCache` to look up the result before and store it after the simulation, or None
+    :param cancel: threading.Event to stop the job, e.g. when a work queue claim was lost. The status of a stopped
+                   job is 'cancelled'
+    :return: dictionary with the status of the job
+    """
+    status = {'status': 'failed', 'attempts': 0, 'start': time.time()}
+    # input files of a job manifest only exist while the job runs
+    with rendered_input(input_file) as rendered:
+        if cache is not None and cache.fetch(rendered) and is_done(rendered):
+            status.update(status='done', cached=True, end=time.time())
+            status['elapsed'] = status['end'] - status['start']
+            return status
+        for attempt in range(1 + retries):
+            if cancel is not None and cancel.is_set():
+                status['status'] = 'cancelled'
+                break
+            # remove partially written outputs of a previous attempt
+            for output in expected_outputs(rendered):
+                if os.path.isfile(output):
+                    os.remove(output)
+            status['attempts'] = attempt + 1
+            try:
+                returncode, output, usage = run_simulation(exe, rendered, cancel)
+            except OSError as e:
+                returncode, output, usage = None, str(e), None
+            status['returncode'] = returncode
+            if cancel is not None and cancel.is_set():
+                status['status'] = 'cancelled'
+                break
+            if usage is not None:
+                try:
+                    record_job(input_file, rendered, attempt + 1, returncode, usage, expected_outputs(rendered))
+                except OSError as e:
+                    print('Could not record the resource usage of {}: {}'.format(input_file, e))
+            if returncode == 0 and is_done(rendered):
+                status['status'] = 'done'
+                status.pop('error', None)
+                if cache is not None:
+                    cache.store(rendered)
+                break
+            status['error'] = output if returncode != 0 else 'incomplete output files'
+    status['end'] = time.time()
+    status['elapsed'] = status['end'] - status['start']
+    return status
+
+
+class Manifest:
+    """
+    Status of all jobs of a run, stored as json file in the run directory. The file is replaced atomically after
+    every update, so it is consistent even if the runner is killed.
+    """
+
+    def __init__(self, run_dir):
+        self.path = os.path.join(run_dir, MANIFEST)
+        self.run_dir = run_dir
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.jobs = json.load(f)
+
+    def update(self, statuses):
+        """
+        :param statuses: dictionary with the status of every updated job, keyed by input file
+        """
+        with self.lock:
+            for input_file, status in statuses.items():
+                self.jobs[os.path.relpath(input_file, self.run_dir)] = status
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.jobs, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def main(run_dir, exe, workers, retries, cache_dir=None, cache_size=None):
+    jobs = find_jobs(run_dir)
+    manifest = Manifest(run_dir)
+    cache = None
+    if cache_dir is not None:
+        cache = SimulationCache(cache_dir, max_bytes=None if cache_size is None else int(cache_size * 1e9))
+
+    todo = []
+    skipped = {}
+    for input_file in jobs:
+        if not is_done(input_file):
+            todo.append(input_file)
+        elif manifest.jobs.get(os.path.relpath(input_file, run_dir), {}).get('status') != 'done':
+            # outputs of simulations that were not run by this script
+            skipped[input_file] = {'status': 'done', 'attempts': 0, 'skipped': True}
+    manifest.update(skipped)
+
+    print('Simulations found:', len(jobs))
+    print('Simulations to run:', len(todo))
+    print('Workers:', workers)
+    if cache is not None:
+        print('Simulation cache:', cache.root)
+
+    start = time.time()
+    failed = 0
+    cached = 0
+    # the threads only wait for the simulator processes
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, exe, input_file, retries, cache): input_file for input_file in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            input_file = futures[future]
+            status = future.result()
+            manifest.update({input_file: status})
+            failed += status['status'] != 'done'
+            cached += status.get('cached', False)
+            print('[{}/{}] {} {} ({:.1f} s, {} attempts)'.format(n, len(todo), 'cached' if status.get('cached') else
+                                                                 status['status'], input_file, status['elapsed'],
+                                                                 status['attempts']))
+
+    print('Finished {} simulations in {:.1f} s, {} from the cache, {} failed'.format(len(todo), time.time() - start,
+                                                                                      cached, failed))
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Run TEM-Simulator for all input files written by gen_temsim_input_files.py, '
+                                                 'or rendered from its job manifest (--manifest). Frames with complete '
+                                                 'output files are skipped, so an interrupted run can be resumed.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py')
+    parser.add_argument('--exe', type=str, default=os.environ.get('TEM_SIMULATOR', 'TEM-simulator'),
+                        help='Path to the TEM-Simulator executable. Default is $TEM_SIMULATOR or TEM-simulator')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of simulations running at the same time. Default is limited by cores and memory (see --mem)')
+    parser.add_argument('--mem', type=float, default=4,
+                        help='Expected memory usage of one simulation in GB, used for the default number of workers. Default = 4')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Number of retries for failed simulations. Default = 2')
+    parser.add_argument('--cache', type=str, default=os.environ.get('TEM_SIMULATOR_CACHE'),
+                        help='Directory of the simulation cache. Simulations with the same input (apart from the output '
+                             'paths) as a cached simulation are not run again. Default is $TEM_SIMULATOR_CACHE or no cache')
+    parser.add_argument('--cache_size', type=float, default=None,
+                        help='Maximum size of the simulation cache in GB. Least recently used results are removed. '
+                             'Default = no limit')
+
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers is not None else default_workers(args.mem)
+    sys.exit(1 if main(args.run_dir, args.exe, workers, args.retries, args.cache, args.cache_size) else 0)
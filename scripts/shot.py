@@ -1,9 +1,11 @@
-import mrcfile
 from scipy import misc
 from skimage import exposure
-import numpy as np
 import math
 
+import instrument
+from instrument import span
+from mrc_io import read_region
+
 ##### Create screenshots of area
 
 def save_image(image_ary, fname, equalize_hist=True):
@@ -12,12 +14,13 @@ def save_image(image_ary, fname, equalize_hist=True):
     misc.imsave(fname, image_ary)
 
 def main(input_mrc, output, x, y, boxsize, scale_bar, equalize_hist=False):
-    img = mrcfile.open(input_mrc, permissive=True).data
-    area = img[round(y - boxsize / 2):round(y + boxsize / 2),
-           round(x - boxsize / 2):round(x + boxsize / 2)]
-    ary = np.copy(area)
+    # only the rows of the box are read from disk
+    with span('read_region', path=input_mrc, boxsize=boxsize):
+        ary = read_region(input_mrc, round(y - boxsize / 2), round(y + boxsize / 2),
+                          round(x - boxsize / 2), round(x + boxsize / 2))
     if equalize_hist == True:
-        ary = exposure.equalize_hist(ary)
+        with span('equalize_hist'):
+            ary = exposure.equalize_hist(ary)
 
     if scale_bar is not None:
         x = scale_bar
@@ -27,7 +30,8 @@ def main(input_mrc, output, x, y, boxsize, scale_bar, equalize_hist=False):
         d = math.ceil(boxsize/50)
         ary[-d-y:-d, -d-x:-d] = 0
 
-    misc.imsave(output, ary)
+    with span('write_image', path=output):
+        misc.imsave(output, ary)
 
 if __name__ == '__main__':
     import argparse
@@ -46,8 +50,12 @@ if __name__ == '__main__':
     parser.add_argument('--equalize_hist',  action='store_true', default=False,
                         help='equalize histogram for higher contrast')
     parser.add_argument('--scalebar', type=int, help='Scale bar in pixel at the bottom right corner')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Write the time, peak memory and bytes read/written of every stage as json lines to this '
+                             'file (see instrument.py). Default is $TEMSIM_TRACE or no trace')
 
     args = parser.parse_args()
+    instrument.enable(args.trace)
 
     main(args.input_file, args.output_file, args.x, args.y, args.boxsize, args.scalebar, args.equalize_hist)
 
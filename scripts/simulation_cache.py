@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+from map_store import file_hash
+
+# parameters with paths to files read by the simulator, the key contains the hash of their content
+INPUT_FILES = {'map_file_re_in', 'map_file_im_in', 'coord_file_in', 'error_file_in', 'defocus_file_in',
+               'tilt_file_in', 'image_file_in'}
+# parameters with paths to files written by the simulator, they do not change the result
+OUTPUT_FILES = {'image_file_out', 'log_file', 'map_file_re_out', 'map_file_im_out', 'coord_file_out',
+                'error_file_out', 'defocus_file_out', 'tilt_file_out'}
+PARAMETER = re.compile(r'^\s*(\w+)\s*=\s*(.*?)\s*$')
+
+
+class SimulationCache:
+    """
+    Content addressed cache of simulation results.
+
+    Simulations are keyed by the hash of the normalized input file: whitespace is normalized, output paths are
+    removed and the paths of the maps, coordinate and error files are replaced by the hash of their content. Input files
+    that only differ in their output paths give the same key, e.g. reruns of a run with the same seed. The output files
+    (`image_file_out`) of a simulation are copied to the directory `<key>` of the cache, as read-only files, and copied
+    to the output paths of later simulations with the same key. Copies, not hard links, because the later steps modify
+    the outputs in place (e.g. `mrcfile.new(overwrite=True)` truncates the existing file). The least recently used
+    results are removed when the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self._hashes = {}  # (path, size, mtime) -> hash of an input file
+
+    def _file_hash(self, path):
+        st = os.stat(path)
+        stat_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        if stat_key not in self._hashes:
+            self._hashes[stat_key] = file_hash(path)
+        return self._hashes[stat_key]
+
+    def normalize(self, input_file):
+        """
+        Normalized content of a TEM-Simulator input file, see `SimulationCache`.
+        :return: normalized input file and list of the output files (`image_file_out`)
+        """
+        lines = []
+        outputs = []
+        with open(input_file) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                match = PARAMETER.match(line)
+                if match is None:
+                    # section headers
+                    lines.append(' '.join(line.split()))
+                    continue
+                name, value = match.groups()
+                if name in OUTPUT_FILES:
+                    if name == 'image_file_out':
+                        outputs.append(value)
+                        # the number and order of the output images matters
+                        lines.append('{} = <{}>'.format(name, len(outputs) - 1))
+                    continue
+                if name in INPUT_FILES and value != 'none':
+                    value = 'sha256:' + self._file_hash(value)
+                lines.append('{} = {}'.format(name, value))
+        return '\n'.join(lines), outputs
+
+    def key(self, input_file):
+        """
+        Key of the result of a simulation.
+        :return: key and list of the output files of the simulation
+        """
+        normalized, outputs = self.normalize(input_file)
+        return hashlib.sha256(normalized.encode()).hexdigest(), outputs
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def fetch(self, input_file):
+        """
+        Place the cached outputs of a simulation at its output paths.
+        :return: True if the result was found in the cache
+        """
+        try:
+            key, outputs = self.key(input_file)
+        except FileNotFoundError:
+            # the simulator will fail with the missing input file
+            return False
+        entry = self.path(key)
+        cached = [os.path.join(entry, '{:02d}.mrc'.format(n)) for n in range(len(outputs))]
+        if not outputs or not all(os.path.isfile(c) for c in cached):
+            return False
+        try:
+            for source, output in zip(cached, outputs):
+                _copy(source, output)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            return False
+        # mark the result as recently used
+        os.utime(entry)
+        return True
+
+    def store(self, input_file):
+        """
+        Add the outputs of a finished simulation to the cache.
+        """
+        key, outputs = self.key(input_file)
+        entry = self.path(key)
+        if not outputs or os.path.isdir(entry):
+            return
+        tmp = '{}.{}.tmp'.format(entry, uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            for n, output in enumerate(outputs):
+                cached = os.path.join(tmp, '{:02d}.mrc'.format(n))
+                _copy(output, cached)
+                os.chmod(cached, 0o444)
+            # only one process succeeds in storing a result
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+            return
+        self._evict(keep=entry)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            total += size
+            if entry.path != keep:
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def _copy(source, destination):
+    # the destination appears complete or not at all, the permissions of the source are not copied
+    tmp = '{}.{}.tmp'.format(destination, uuid.uuid4().hex)
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
@@ -0,0 +1,393 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+CHUNKSIZE = 500000
+
+
+class StarBlock:
+    """
+    Location and header of a data block in a star file.
+    """
+
+    def __init__(self, name):
+        self.name = name  # name without the `data_` prefix
+        self.loop = False
+        self.columns = []  # column names without the `#N` suffix
+        self.values = {}  # key value pairs of blocks without loop
+        self.data_start = None  # byte offset of the first data row
+        self.data_end = None  # byte offset of the end of the block
+
+
+def star_blocks(path):
+    """
+    Scan a star file for its data blocks. Only the headers are parsed, data rows are skipped.
+    :param path: path to star file
+    :return: list of StarBlock
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            # find the beginning of all blocks
+            starts = [0] if mm[:5] == b'data_' else []
+            pos = mm.find(b'\ndata_')
+            while pos != -1:
+                starts.append(pos + 1)
+                pos = mm.find(b'\ndata_', pos + 1)
+
+            blocks = []
+            for n, start in enumerate(starts):
+                end = starts[n + 1] if n + 1 < len(starts) else size
+                blocks.append(_parse_header(mm, start, end))
+    return blocks
+
+
+def _parse_header(mm, start, end):
+    block = None
+    pos = start
+    while pos < end:
+        line_end = mm.find(b'\n', pos, end)
+        line_end = end if line_end == -1 else line_end + 1
+        line = mm[pos:line_end].decode().strip()
+        if block is None:
+            block = StarBlock(line.split()[0][len('data_'):])
+        elif line == '' or line.startswith('#'):
+            pass
+        elif line.startswith('loop_'):
+            block.loop = True
+        elif line.startswith('_'):
+            fields = line.split(None, 1)
+            if block.loop:
+                # `#N` suffixes of the column names are dropped
+                block.columns.append(fields[0])
+            else:
+                block.values[fields[0]] = fields[1].strip() if len(fields) > 1 else ''
+        elif block.loop:
+            block.data_start = pos
+            break
+        pos = line_end
+    block.data_end = end
+    return block
+
+
+def _select_block(blocks, block, path):
+    if block is not None:
+        for b in blocks:
+            if b.name == block:
+                return b
+        raise KeyError('Block "data_{}" not found in {}'.format(block, path))
+    # default to the particles block of relion 3.1 files, otherwise use the last table
+    for b in blocks:
+        if b.name == 'particles' and b.loop:
+            return b
+    loops = [b for b in blocks if b.loop]
+    if loops:
+        return loops[-1]
+    if blocks:
+        return blocks[-1]
+    raise ValueError('No data block found in {}'.format(path))
+
+
+def _shrink(chunk, compact):
+    """
+    Use compact dtypes: strings become categorical, integers int32 if possible and floats float32 if `compact` is set.
+    """
+    for col in chunk.columns:
+        values = chunk[col]
+        if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            chunk[col] = values.astype('category')
+        elif values.dtype.kind == 'i':
+            if len(values) and np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+                chunk[col] = values.astype(np.int32)
+        elif values.dtype.kind == 'f' and compact:
+            chunk[col] = values.astype(np.float32)
+    return chunk
+
+
+def _concat(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for col in chunks[0].columns:
+        parts = [c[col] for c in chunks]
+        if all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+            columns[col] = pd.Series(union_categoricals(parts))
+        else:
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def iter_star(path, block=None, columns=None, compact=False, chunksize=CHUNKSIZE):
+    """
+    Read the table of a star file in chunks.
+    :param path: path to star file
+    :param block: name of the data block without `data_` (e.g. 'optics'). By default the `data_particles` block
+                  or the last table of the file is read
+    :param columns: list of columns to read, default is all columns
+    :param compact: use float32 for floating point columns
+    :param chunksize: number of rows per chunk
+    :return: generator of DataFrames
+    """
+    b = _select_block(star_blocks(path), block, path)
+
+    if not b.loop:
+        df = pd.DataFrame({k: [v] for k, v in b.values.items()})
+        for col in df.columns:
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except ValueError:
+                pass
+        yield _shrink(df if columns is None else df[columns].copy(), compact)
+        return
+
+    if columns is not None:
+        missing = [c for c in columns if c not in b.columns]
+        if missing:
+            raise KeyError('Columns {} not found in block "data_{}" of {}'.format(missing, b.name, path))
+    if b.data_start is None:
+        yield pd.DataFrame(columns=b.columns if columns is None else columns)
+        return
+
+    with open(path, 'rb') as f:
+        if b.data_end == os.fstat(f.fileno()).st_size:
+            f.seek(b.data_start)
+            source = f
+        else:
+            f.seek(b.data_start)
+            source = io.BytesIO(f.read(b.data_end - b.data_start))
+        reader = pd.read_csv(source, sep=r'\s+', header=None, names=b.columns, usecols=columns, comment='#',
+                             chunksize=chunksize)
+        for chunk in reader:
+            if columns is not None:
+                chunk = chunk[columns]
+            yield _shrink(chunk, compact)
+
+
+def read_star(path, block=None, columns=None, compact=False, chunksize=CHUNKSIZE, cache=None):
+    """
+    Read a table of a star file into a DataFrame. Supports files with multiple data blocks (e.g. `data_optics` and
+    `data_particles` of relion 3.1). The file is read in chunks of `chunksize` rows, strings are stored as
+    categorical and integers as int32 to reduce the memory usage.
+    A valid sidecar cache (see `write_sidecar`) is always used instead of parsing the file.
+    :param path: path to star file
+    :param block: name of the data block without `data_` (e.g. 'optics'). By default the `data_particles` block
+                  or the last table of the file is read
+    :param columns: list of columns to read, default is all columns
+    :param compact: use float32 for floating point columns
+    :param chunksize: number of rows per chunk
+    :param cache: create the sidecar cache if it does not exist or is outdated.
+                  Default is True if the environment variable STAR_CACHE is set to 1
+    :return: DataFrame
+    """
+    if cache is None:
+        cache = os.environ.get('STAR_CACHE', '0') not in ('', '0')
+
+    df = read_sidecar(path, block, columns, compact)
+    if df is not None:
+        return df
+    if cache:
+        try:
+            write_sidecar(path, chunksize)
+        except OSError:
+            pass  # e.g. read-only directory, fall back to parsing the star file
+        else:
+            df = read_sidecar(path, block, columns, compact)
+            if df is not None:
+                return df
+
+    chunks = list(iter_star(path, block, columns, compact, chunksize))
+    return _concat(chunks).reset_index(drop=True)
+
+
+def read_star_blocks(path, compact=False, cache=None):
+    """
+    Read all data blocks of a star file.
+    :return: dictionary with a DataFrame for every block name
+    """
+    return {b.name: read_star(path, block=b.name, compact=compact, cache=cache) for b in star_blocks(path)}
+
+
+##############################################################################################################
+# Sidecar cache
+#
+# The parsed tables of a star file are stored next to it in the directory `<star file>.cache`, with one .npy file
+# per column (memory-mappable) and a `meta.json` file. Strings are stored as categorical codes, the categories are
+# part of the meta data. The cache is valid as long as size, modification time and a hash of the beginning and
+# the end of the star file did not change.
+
+SIDECAR_VERSION = 2
+
+
+def sidecar_path(path):
+    return path + '.cache'
+
+
+def _source_signature(path, nbytes=1 << 16):
+    st = os.stat(path)
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        sha.update(f.read(nbytes))
+        if st.st_size > nbytes:
+            f.seek(max(nbytes, st.st_size - nbytes))
+            sha.update(f.read())
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha.hexdigest()}
+
+
+def write_sidecar(path, chunksize=CHUNKSIZE):
+    """
+    Parse all blocks of a star file and store them in the sidecar cache.
+    :param path: path to star file
+    """
+    signature = _source_signature(path)
+    blocks = star_blocks(path)
+    meta = {'version': SIDECAR_VERSION, 'source': signature, 'blocks': []}
+
+    target = sidecar_path(path)
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        for b in blocks:
+            df = _concat(list(iter_star(path, b.name, chunksize=chunksize))).reset_index(drop=True)
+            block_dir = os.path.join(tmp, 'data_' + b.name)
+            os.makedirs(block_dir)
+            block_meta = {'name': b.name, 'loop': b.loop, 'rows': len(df), 'columns': []}
+            for n, col in enumerate(df.columns):
+                values = df[col]
+                column = {'name': col, 'file': '{}.npy'.format(n)}
+                # numbers and booleans are stored as they are, like parsed from the star file
+                if not pd.api.types.is_numeric_dtype(values.dtype):
+                    values = values.astype('category')
+                    column['categories'] = [str(c) for c in values.cat.categories]
+                    array = values.cat.codes.to_numpy()
+                else:
+                    array = values.to_numpy()
+                np.save(os.path.join(block_dir, column['file']), array)
+                block_meta['columns'].append(column)
+            meta['blocks'].append(block_meta)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(tmp, target)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def read_sidecar(path, block=None, columns=None, compact=False):
+    """
+    Read a table from the sidecar cache of a star file. Columns are memory-mapped.
+    :return: DataFrame or None if there is no valid cache
+    """
+    meta_file = os.path.join(sidecar_path(path), 'meta.json')
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get('version') != SIDECAR_VERSION or meta['source'] != _source_signature(path):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    blocks = []
+    for block_meta in meta['blocks']:
+        b = StarBlock(block_meta['name'])
+        b.loop = block_meta['loop']
+        b.columns = [c['name'] for c in block_meta['columns']]
+        b.meta = block_meta
+        blocks.append(b)
+    b = _select_block(blocks, block, path)
+
+    available = {c['name']: c for c in b.meta['columns']}
+    if columns is not None:
+        missing = [c for c in columns if c not in available]
+        if missing:
+            raise KeyError('Columns {} not found in block "data_{}" of {}'.format(missing, b.name, path))
+    data = {}
+    for name in (b.columns if columns is None else columns):
+        column = available[name]
+        array = np.load(os.path.join(sidecar_path(path), 'data_' + b.name, column['file']), mmap_mode='r')
+        if 'categories' in column:
+            data[name] = pd.Categorical.from_codes(array, column['categories'])
+        elif compact and array.dtype.kind == 'f':
+            data[name] = array.astype(np.float32)
+        else:
+            data[name] = array
+    return pd.DataFrame(data, index=pd.RangeIndex(b.meta['rows']))
+
+
+class StarWriter:
+    """
+    Write a table to a star file incrementally. The header is written once with the first batch of rows, following
+    batches are appended directly to the file, so only one batch has to be in memory at a time.
+    Only columns starting with `_rln` are written. Use it as context manager:
+
+        with StarWriter('particles.star') as writer:
+            for micrograph_df in ...:
+                writer.write(micrograph_df)
+    """
+
+    def __init__(self, out_star, block='', columns=None, mode='w'):
+        """
+        :param out_star: path to output star file
+        :param block: name of the data block without `data_`
+        :param columns: columns to write, by default the `_rln` columns of the first batch
+        :param mode: 'w' to create a new file, 'a' to add the block to an existing file
+        """
+        self.file = open(out_star, mode)
+        self.block = block
+        self.columns = None if columns is None else [c for c in columns if c.startswith('_rln')]
+        self.rows = 0
+        self._header_written = False
+
+    def _write_header(self):
+        if self.file.tell() > 0:
+            self.file.write('\n')
+        self.file.write('data_{}\nloop_\n'.format(self.block))
+        for col in self.columns:
+            self.file.write(col + '\n')
+        self._header_written = True
+
+    def write(self, df):
+        """
+        Append rows to the star file.
+        :param df: DataFrame with (at least) the columns of the star file
+        """
+        if self.columns is None:
+            self.columns = [c for c in df.columns if c.startswith('_rln')]
+        if not self._header_written:
+            self._write_header()
+        df[self.columns].to_csv(self.file, header=False, index=False, sep='\t')
+        self.rows += len(df)
+
+    def close(self):
+        if not self.file.closed:
+            if not self._header_written:
+                self.columns = self.columns or []
+                self._write_header()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_star(df, out_star):
+    """
+    Write a DataFrame to a star file. Only columns starting with `_rln` are written.
+    :param df: DataFrame, or dictionary of DataFrames to write multiple data blocks (e.g. {'optics': ..., 'particles': ...})
+    :param out_star: path to output star file
+    """
+    blocks = df if isinstance(df, dict) else {'': df}
+    for n, (name, block_df) in enumerate(blocks.items()):
+        with StarWriter(out_star, block=name, mode='a' if n else 'w') as writer:
+            writer.write(block_df)
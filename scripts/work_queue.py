@@ -0,0 +1,247 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from multiprocessing import Process
+
+from run_simulations import find_jobs, is_done, run_job
+
+QUEUE_DIR = '.queue'
+
+
+class WorkQueue:
+    """
+    Work queue on a shared file system, for running the simulations of a run on several nodes.
+
+    Every frame of the run is a job. A worker claims a job by creating the claim file `<job>.claim` in the queue
+    directory, which only succeeds for one worker (O_CREAT | O_EXCL). While the job runs, the worker updates the
+    modification time of the claim file (heartbeat). Claims without heartbeat for longer than the lease time are
+    considered abandoned and can be claimed again. Every claim has a random token, a worker only renews, finishes
+    and releases claims with its own token. Finished jobs are marked with `<job>.done` or `<job>.failed`.
+    """
+
+    def __init__(self, run_dir, lease=600):
+        self.run_dir = run_dir
+        self.lease = lease
+        self.dir = os.path.join(run_dir, QUEUE_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.tokens = {}  # input file -> token of the claim of this worker
+
+    def job_id(self, input_file):
+        return os.path.relpath(input_file, self.run_dir).replace(os.sep, '__')
+
+    def _path(self, input_file, suffix):
+        return os.path.join(self.dir, self.job_id(input_file) + suffix)
+
+    def is_finished(self, input_file):
+        return os.path.isfile(self._path(input_file, '.done')) or os.path.isfile(self._path(input_file, '.failed'))
+
+    def claim_expired(self, input_file):
+        """
+        :return: True if the job is claimed but the lease expired, None if the job is not claimed
+        """
+        try:
+            return time.time() - os.stat(self._path(input_file, '.claim')).st_mtime > self.lease
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _token(claim):
+        # token of a claim file, None if it does not exist or is not written yet
+        try:
+            with open(claim) as f:
+                return json.load(f).get('token')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def owns(self, input_file):
+        """
+        :return: True if the job is claimed by this worker
+        """
+        token = self.tokens.get(input_file)
+        if token is None:
+            return False
+        claim = self._path(input_file, '.claim')
+        for _ in range(3):
+            current = self._token(claim)
+            if current is not None:
+                return current == token
+            # the claim may be moved away for a moment by a worker that checks if it expired, see `claim`
+            time.sleep(0.1)
+        return False
+
+    def claim(self, input_file, worker):
+        """
+        Try to claim a job. Abandoned claims are taken over.
+        :return: True if the job was claimed by this worker
+        """
+        claim = self._path(input_file, '.claim')
+        if self.claim_expired(input_file):
+            token = self._token(claim)
+            # only one worker succeeds in moving the abandoned claim away
+            expired = '{}.expired.{}'.format(claim, uuid.uuid4().hex)
+            try:
+                os.rename(claim, expired)
+            except FileNotFoundError:
+                return False
+            # another worker may have taken over the claim between the check and the rename, then the moved claim
+            # is its new claim and is put back
+            if time.time() - os.stat(expired).st_mtime <= self.lease or self._token(expired) != token:
+                try:
+                    os.link(expired, claim)
+                except FileExistsError:
+                    pass
+                os.remove(expired)
+                return False
+            os.remove(expired)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': worker, 'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time(),
+                       'token': token}, f)
+        self.tokens[input_file] = token
+        return True
+
+    def heartbeat(self, input_file):
+        """
+        Renew the lease of a claimed job.
+        :return: False if the claim was lost
+        """
+        if not self.owns(input_file):
+            return False
+        try:
+            os.utime(self._path(input_file, '.claim'))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def finish(self, input_file, status):
+        """
+        Mark a claimed job as finished and release the claim.
+        :return: False if the claim was lost, the job is then left to the worker that took it over
+        """
+        if not self.owns(input_file):
+            self.tokens.pop(input_file, None)
+            return False
+        marker = self._path(input_file, '.done' if status['status'] == 'done' else '.failed')
+        tmp = '{}.{}.tmp'.format(marker, uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp, marker)
+        try:
+            os.remove(self._path(input_file, '.claim'))
+        except FileNotFoundError:
+            pass
+        del self.tokens[input_file]
+        return True
+
+
+def _run_with_heartbeat(queue, input_file, exe, retries):
+    stop = threading.Event()
+    # the simulation is stopped when the claim is lost, the job is run by the worker that took it over
+    cancel = threading.Event()
+
+    def beat():
+        while not stop.wait(queue.lease / 4):
+            if not queue.heartbeat(input_file):
+                print('Lost the claim of {}'.format(input_file))
+                cancel.set()
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        return run_job(exe, input_file, retries, cancel=cancel)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def worker_loop(run_dir, exe, lease=600, retries=2, poll=10, worker=None):
+    """
+    Claim and run jobs until all jobs of the run are finished.
+    :param run_dir: output directory of `gen_temsim_input_files.py`
+    :param exe: path to the TEM-Simulator executable
+    :param lease: time in seconds after which claims without heartbeat are considered abandoned
+    :param retries: number of retries for failed simulations
+    :param poll: time in seconds to wait for jobs that are claimed by other workers
+    :return: number of jobs run by this worker
+    """
+    worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+    queue = WorkQueue(run_dir, lease)
+    jobs = find_jobs(run_dir)
+    # different workers go through the jobs in different order, to reduce the number of collisions
+    random.Random(worker).shuffle(jobs)
+    n_run = 0
+
+    while True:
+        pending = False
+        for input_file in jobs:
+            if queue.is_finished(input_file):
+                continue
+            if not queue.claim(input_file, worker):
+                pending = True
+                continue
+            if is_done(input_file):
+                queue.finish(input_file, {'status': 'done', 'attempts': 0, 'skipped': True, 'worker': worker})
+                continue
+            status = _run_with_heartbeat(queue, input_file, exe, retries)
+            status['worker'] = worker
+            if status['status'] == 'cancelled' or not queue.finish(input_file, status):
+                queue.tokens.pop(input_file, None)
+                print('{}: lost the claim of {}'.format(worker, input_file))
+                continue
+            n_run += 1
+            print('{}: {} {} ({:.1f} s)'.format(worker, status['status'], input_file, status['elapsed']))
+        if not pending:
+            return n_run
+        # wait for jobs of other workers to finish or their leases to expire
+        time.sleep(poll)
+        jobs = [j for j in jobs if not queue.is_finished(j)]
+
+
+def main(run_dir, exe, workers, lease, retries, poll):
+    start = time.time()
+    processes = [Process(target=worker_loop, args=(run_dir, exe, lease, retries, poll)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    queue = WorkQueue(run_dir, lease)
+    jobs = find_jobs(run_dir)
+    done = sum(os.path.isfile(queue._path(j, '.done')) for j in jobs)
+    failed = sum(os.path.isfile(queue._path(j, '.failed')) for j in jobs)
+    print('Finished after {:.1f} s: {} of {} jobs done, {} failed'.format(time.time() - start, done, len(jobs), failed))
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Worker for a work queue on a shared file system. Start it on any number of '
+                                                 'nodes to distribute the simulations of a run. Abandoned jobs of '
+                                                 'workers that died are taken over after the lease time.')
+    parser.add_argument('run_dir', type=str,
+                        help='Output directory of gen_temsim_input_files.py')
+    parser.add_argument('--exe', type=str, default=os.environ.get('TEM_SIMULATOR', 'TEM-simulator'),
+                        help='Path to the TEM-Simulator executable. Default is $TEM_SIMULATOR or TEM-simulator')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes on this node. Default = 1')
+    parser.add_argument('--lease', type=float, default=600,
+                        help='Time in seconds after which jobs without heartbeat are taken over by other workers. Default = 600')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Number of retries for failed simulations. Default = 2')
+    parser.add_argument('--poll', type=float, default=10,
+                        help='Time in seconds between checks for jobs of other workers. Default = 10')
+
+    args = parser.parse_args()
+
+    sys.exit(1 if main(args.run_dir, args.exe, args.workers, args.lease, args.retries, args.poll) else 0)
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+import add_noise
+
+
+def make_run(run_dir, micrographs=3, frames=2):
+    for m in range(micrographs):
+        directory = os.path.join(run_dir, 'micrograph_{}'.format(m))
+        os.makedirs(directory)
+        for n in range(frames):
+            with mrcfile.new(os.path.join(directory, 'frame_{:02d}_no_noise.mrc'.format(n))) as mrc:
+                mrc.set_data(np.full((16, 16), 10, dtype=np.float32))
+    return [os.path.join(run_dir, 'micrograph_{}'.format(m)) for m in range(micrographs)]
+
+
+def read(directory, frame, name='with_noise'):
+    with mrcfile.open(os.path.join(directory, 'frame_{:02d}_{}.mrc'.format(frame, name))) as mrc:
+        return mrc.data.copy()
+
+
+def test_noise_does_not_depend_on_the_selected_directories(tmp_path):
+    dirs = make_run(str(tmp_path))
+    add_noise.main(dirs, 'with_noise', seed=1)
+    full = [[read(d, n) for n in range(2)] for d in dirs]
+    # all frames and micrographs get different noise
+    assert len({f.tobytes() for frames in full for f in frames}) == 6
+
+    # single micrograph directories, in another order and with several workers
+    add_noise.main(dirs[::-1], 'reversed', seed=1, workers=2)
+    add_noise.main(dirs[1:2], 'single', seed=1)
+    for d, frames in zip(dirs, full):
+        for n, frame in enumerate(frames):
+            assert np.array_equal(read(d, n, 'reversed'), frame)
+    assert np.array_equal(read(dirs[1], 0, 'single'), full[1][0])
+
+
+def test_detect_keeps_the_mean():
+    rng = np.random.default_rng(0)
+    image = np.full((256, 256), 20.0)
+    assert abs(add_noise.detect(image, rng).mean() - 20) < 0.1
+    assert abs(add_noise.detect(image, rng, dqe=0.5).mean() - 20) < 0.2
+    assert add_noise.detect(image, rng, dqe=0.5).var() > add_noise.detect(image, rng).var()
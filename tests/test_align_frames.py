@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('mrcfile')
+
+from align_frames import align, alignment_error, phase_ramp, read_drift
+
+
+def drifting_frames(true_drift, shape=(256, 256), noise=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    # image with structure at all scales, band limited to avoid aliasing of the sub-pixel shifts
+    ft = np.fft.rfft2(rng.standard_normal(shape))
+    k = np.hypot(*np.meshgrid(np.fft.fftfreq(shape[0]), np.fft.rfftfreq(shape[1]), indexing='ij'))
+    ft *= np.exp(-(k / 0.15) ** 2)
+    image = np.fft.irfft2(ft, s=shape)
+    image /= image.std()
+    return [np.fft.irfft2(np.fft.rfft2(image) * phase_ramp(shape, shift, np.complex128), s=shape) +
+            noise * rng.standard_normal(shape) for shift in true_drift]
+
+
+def test_align_recovers_synthetic_drift():
+    t = np.arange(8)
+    true_drift = np.stack([6 * (1 - np.exp(-t / 2)) + 0.3 * t, -4 * (1 - np.exp(-t / 3))], axis=1)
+    frames = drifting_frames(true_drift)
+    drift = align(frames, (256, 256), 1.0, binning=1, coarse_binning=4, max_shift=20, bfactor=50)
+    error, rms = alignment_error(drift, true_drift)
+    assert rms < 0.1
+    assert np.allclose(drift.mean(axis=0), 0)
+    # the result does not depend on the number of workers
+    assert np.allclose(align(frames, (256, 256), 1.0, binning=1, coarse_binning=4, max_shift=20, bfactor=50,
+                             workers=3), drift)
+
+
+def test_alignment_error_ignores_the_absolute_position(tmp_path):
+    true_drift = np.array([[0.0, 0.0], [1.0, 2.0], [3.0, 2.5]])
+    error, rms = alignment_error(true_drift + [5, -7], true_drift)
+    assert np.allclose(error, 0) and rms == pytest.approx(0)
+    error, rms = alignment_error(true_drift + [[0, 0], [0, 0], [3, 4]], true_drift, reference=0)
+    assert rms == pytest.approx(np.sqrt(25 / 3))
+
+    # drift.txt is in nm
+    np.savetxt(str(tmp_path / 'drift.txt'), true_drift)
+    assert np.allclose(read_drift(str(tmp_path / 'drift.txt'), 2.0), true_drift * 5)
@@ -0,0 +1,62 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+from add_noise import detect, frame_rng
+from derive_frames import derive_micrograph
+from gen_temsim_input_files import KEYFRAMES_FILE
+
+
+def write(path, image):
+    with mrcfile.new(str(path), overwrite=True) as mrc:
+        mrc.set_data(image.astype(np.float32))
+
+
+def read(path):
+    with mrcfile.open(str(path)) as mrc:
+        return mrc.data.copy()
+
+
+@pytest.fixture
+def micrograph_dir(tmp_path):
+    directory = tmp_path / 'micrograph'
+    os.makedirs(str(directory))
+    with open(str(directory / KEYFRAMES_FILE), 'w') as f:
+        json.dump({'n_frames': 3, 'doses': [0, 10, 20], 'keyframes': [0], 'pixel_size': 1.0, 'drift': False,
+                   'exact': True}, f)
+    rng = np.random.default_rng(0)
+    write(directory / 'keyframe_00_no_noise.mrc', rng.random((32, 32)) + 10)
+    # exact frames 0 and 1 were simulated, frame 2 is missing
+    for n in (0, 1):
+        write(directory / 'frame_{:02d}_no_noise.mrc'.format(n), rng.random((32, 32)) + 10)
+    return str(directory)
+
+
+def test_noise_is_added_to_the_exact_frames(micrograph_dir):
+    exact = [read(os.path.join(micrograph_dir, 'frame_{:02d}_no_noise.mrc'.format(n))) for n in (0, 1)]
+    results = derive_micrograph(micrograph_dir, root_seed=1)
+
+    assert [r['missing'] for r in results] == [False, False, True]
+    assert np.isnan(results[2]['rel_error'])
+    for n in (0, 1):
+        no_noise = read(os.path.join(micrograph_dir, 'frame_{:02d}_no_noise.mrc'.format(n)))
+        assert np.array_equal(no_noise, exact[n])
+        with_noise = read(os.path.join(micrograph_dir, 'frame_{:02d}_with_noise.mrc'.format(n)))
+        assert np.array_equal(with_noise, detect(exact[n], frame_rng(1, micrograph_dir, n)))
+
+    # the missing exact frame is replaced by the derived frame, both outputs come from it
+    derived = read(os.path.join(micrograph_dir, 'frame_02_no_noise.mrc'))
+    with_noise = read(os.path.join(micrograph_dir, 'frame_02_with_noise.mrc'))
+    assert np.array_equal(with_noise, detect(derived, frame_rng(1, micrograph_dir, 2)))
+
+
+def test_frame_at_the_dose_of_the_keyframe_is_the_keyframe(micrograph_dir):
+    os.remove(os.path.join(micrograph_dir, 'frame_00_no_noise.mrc'))
+    derive_micrograph(micrograph_dir, root_seed=1, noise=False)
+    keyframe = read(os.path.join(micrograph_dir, 'keyframe_00_no_noise.mrc'))
+    assert np.allclose(read(os.path.join(micrograph_dir, 'frame_00_no_noise.mrc')), keyframe, atol=1e-4)
+    assert not os.path.isfile(os.path.join(micrograph_dir, 'frame_00_with_noise.mrc'))
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('mrcfile')
+
+import functions
+from create_filtered_maps import dose_schedule, rfft_frequencies
+from dose_weighted_sum import DoseWeights
+
+
+def test_weights_are_the_normalized_damage_filter():
+    shape, pixel_size = (32, 48), 1.5
+    doses = dose_schedule(40, 8)
+    weights = DoseWeights(shape, pixel_size, doses)
+    k = rfft_frequencies(shape) / pixel_size
+    with np.errstate(divide='ignore'):
+        filters = np.array([functions.damage_filter(k, N) for N in doses])
+    expected = filters * np.sqrt(len(doses) / np.sum(filters ** 2, axis=0))
+    for n in range(len(doses)):
+        np.testing.assert_allclose(weights(n), expected[n], rtol=1e-5)
+
+
+def test_weights_are_normalized():
+    doses = dose_schedule(40, 8)
+    weights = DoseWeights((32, 32), 1.0, doses)
+    squared = sum(weights(n).astype(np.float64) ** 2 for n in range(len(doses)))
+    np.testing.assert_allclose(squared, len(doses), rtol=1e-5)
+    # the zero frequency is not attenuated
+    assert all(weights(n)[0, 0] == 1 for n in range(len(doses)))
+    # later frames are weighted down at high frequencies
+    assert weights(0)[0, 16] > weights(len(doses) - 1)[0, 16]
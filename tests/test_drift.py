@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from drift import DRIFT_MODELS, drift_parameters, generate_drift, parse_drift_params
+from gen_temsim_input_files import drift_rng
+
+
+def test_parse_drift_params():
+    assert parse_drift_params(['max_speed=2', 'jitter=0.1'], 'linear') == {'max_speed': 2.0, 'jitter': 0.1}
+    assert parse_drift_params(None) == {}
+    with pytest.raises(ValueError, match='max_drift_dist'):
+        parse_drift_params(['tua=3'], 'exponential')
+    with pytest.raises(ValueError, match='NAME=VALUE'):
+        parse_drift_params(['max_speed'], 'linear')
+    with pytest.raises(ValueError, match='unknown drift model'):
+        parse_drift_params([], 'brownian')
+
+
+@pytest.mark.parametrize('model', sorted(DRIFT_MODELS))
+def test_trajectories_start_at_the_origin(model):
+    assert 'rng' not in drift_parameters(model)
+    positions = generate_drift(model, 4, 6, np.random.default_rng(0))
+    assert positions.shape == (4, 6, 2)
+    assert np.all(positions[:, 0] == 0)
+    with pytest.raises(ValueError, match='unknown parameter'):
+        generate_drift(model, 1, 6, np.random.default_rng(0), tua=3)
+
+
+def test_drift_of_a_micrograph_does_not_depend_on_the_number_of_micrographs():
+    def drift(n_micrographs):
+        return [generate_drift('exponential', 1, 6, drift_rng(7, i))[0] for i in range(n_micrographs)]
+    few, many = drift(2), drift(5)
+    for a, b in zip(few, many):
+        assert np.array_equal(a, b)
+    assert not np.array_equal(many[0], many[1])
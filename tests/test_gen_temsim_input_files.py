@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gen_temsim_input_files
+from gen_temsim_input_files import SEED_BITS, _permute_seed, frame_seed, validation_seed
+from star import write_star
+
+
+def test_permute_seed_is_a_bijection():
+    # contiguous inputs and the largest inputs map to distinct seeds in range
+    k = np.concatenate([np.arange(1 << 20), np.arange((1 << SEED_BITS) - (1 << 20), 1 << SEED_BITS)]).astype(np.int64)
+    seeds = _permute_seed(k)
+    assert len(np.unique(seeds)) == len(k)
+    assert seeds.min() >= 0 and seeds.max() < 1 << SEED_BITS
+    assert [_permute_seed(int(i)) for i in k[:100]] == seeds[:100].tolist()
+
+
+def test_seeds_of_all_frames_are_distinct():
+    n_frames = 7
+    seeds = [frame_seed(3, m, n_frames, n) for m in range(50) for n in range(n_frames)]
+    seeds += [validation_seed(3, m, n_frames, n) for m in range(50) for n in range(n_frames)]
+    assert len(set(seeds)) == len(seeds)
+    assert frame_seed(3, 2, n_frames, 1) == frame_seed(3, 2, n_frames, 1)
+    assert frame_seed(3, 2, n_frames, 1) != frame_seed(4, 2, n_frames, 1)
+
+
+def write_particles(path, micrographs=5):
+    rows = []
+    for m in range(micrographs):
+        for p in range(3):
+            rows.append({'_rlnCoordinateX': 1000.0 + 100 * p, '_rlnCoordinateY': 1500.0 + 50 * m,
+                         '_rlnAnglePsi': 10.0 * p, '_rlnAngleTilt': 20.0 * m, '_rlnAngleRot': 5.0 * (m + p),
+                         '_rlnMicrographName': 'micrographs/mic_{}.mrc'.format(m),
+                         '_rlnDefocusU': 15000.0 + 1000 * m, '_rlnDefocusV': 14000.0 + 1000 * m,
+                         '_rlnMagnification': 10000.0, '_rlnDetectorPixelSize': 5.0})
+    write_star(pd.DataFrame(rows), str(path))
+
+
+def generate(tmp_path, name, workers, max_micrographs=-1):
+    out = str(tmp_path / name)
+    gen_temsim_input_files.main(out, str(tmp_path / 'particles.star'), 4, True, 20, 1.0, None,
+                                str(tmp_path / 'fmaps'), max_micrographs, None, seed=11, workers=workers)
+    files = {}
+    for root, _, names in os.walk(out):
+        for file_name in names:
+            with open(os.path.join(root, file_name)) as f:
+                files[os.path.relpath(os.path.join(root, file_name), out)] = f.read().replace(out, '<run>')
+    return files
+
+
+def test_output_does_not_depend_on_the_number_of_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda prompt='': 'y')
+    write_particles(tmp_path / 'particles.star')
+    os.makedirs(str(tmp_path / 'fmaps'))
+    for dose in gen_temsim_input_files.dose_schedule(20, 4):
+        open(str(tmp_path / 'fmaps' / 'filt_{:5.3f}.mrc'.format(dose)), 'w').close()
+
+    serial = generate(tmp_path, 'serial', 1)
+    assert 'mic_4/input_frame_03.txt' in serial
+    assert serial == generate(tmp_path, 'parallel', 3)
+    # the micrographs of a smaller run are the same as in the full run
+    subset = generate(tmp_path, 'subset', 2, max_micrographs=2)
+    assert not any(f.startswith('mic_2') for f in subset)
+    for name, content in subset.items():
+        if name.startswith('mic_'):
+            assert content == serial[name]
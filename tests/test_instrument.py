@@ -0,0 +1,76 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import instrument
+from instrument import span
+
+
+@pytest.fixture
+def trace(tmp_path, monkeypatch):
+    path = str(tmp_path / 'trace.jsonl')
+    monkeypatch.delenv(instrument.ENV, raising=False)
+    monkeypatch.setattr(instrument, '_tracer', None)
+    instrument.enable(path)
+    return path
+
+
+def read_spans(path):
+    with open(path) as f:
+        return {record['span']: record for record in map(json.loads, f)}
+
+
+def _thread():
+    with span('thread'):
+        pass
+
+
+def _child(path):
+    with span('child'):
+        with span('grandchild'):
+            pass
+
+
+def test_spans_are_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(instrument, '_tracer', None)
+    assert not instrument.enabled()
+    with span('stage') as s:
+        s.add(size=1)
+    assert span('other') is s
+
+
+def test_spans_are_nested_across_threads_and_processes(trace):
+    with span('outer') as outer:
+        with span('inner', size=3):
+            thread = threading.Thread(target=_thread)
+            thread.start()
+            thread.join()
+            process = multiprocessing.get_context('fork').Process(target=_child, args=(trace,))
+            process.start()
+            process.join()
+            assert process.exitcode == 0
+        outer.add(items=2)
+        with pytest.raises(KeyError):
+            with span('failed'):
+                raise KeyError
+    spans = read_spans(trace)
+    assert set(spans) == {'outer', 'inner', 'thread', 'child', 'grandchild', 'failed'}
+
+    assert spans['outer']['parent'] is None and spans['outer']['depth'] == 0 and spans['outer']['items'] == 2
+    assert spans['inner']['parent'] == spans['outer']['id'] and spans['inner']['size'] == 3
+    # spans of other threads are children of the outermost span of the process
+    assert spans['thread']['parent'] == spans['outer']['id'] and spans['thread']['depth'] == 1
+    # the forked process does not refer to the spans it inherited from its parent
+    assert spans['child']['pid'] == process.pid != spans['outer']['pid']
+    assert spans['child']['parent'] is None and spans['child']['depth'] == 0
+    assert spans['grandchild']['parent'] == spans['child']['id'] and spans['grandchild']['depth'] == 1
+    assert spans['outer']['wall'] >= spans['inner']['wall']
+    assert spans['failed']['error'] == 'KeyError' and spans['failed']['parent'] == spans['outer']['id']
+
+    # worker processes started with a new interpreter write to the same trace
+    assert os.environ[instrument.ENV] == trace
+    table = instrument.summary(trace)
+    assert table.loc['grandchild', 'count'] == 1 and table.loc['outer', 'depth'] == 0
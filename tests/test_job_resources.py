@@ -0,0 +1,76 @@
+import json
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+import job_resources
+from job_resources import RESOURCES_FILE, fit_cost_model, read_resources
+
+# simulator that allocates memory and burns cpu time proportional to the number of particles
+STUB_SIMULATOR = '''#!{python}
+import re, sys
+import numpy as np, mrcfile
+text = open(sys.argv[1]).read()
+if 'fail' in text:
+    sys.exit(3)
+particles = int(open(re.search(r'coord_file_in\\s*=\\s*(\\S+)', text).group(1)).readline().split()[0])
+data = np.ones(particles * 250000)
+for _ in range(5):
+    data = np.sqrt(data + 1)
+for out in re.findall(r'image_file_out\\s*=\\s*(\\S+)', text):
+    with mrcfile.new(out, overwrite=True) as mrc:
+        mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+'''
+
+
+def make_job(micrograph_dir, frame, particles, fail=False):
+    coordinates = os.path.join(micrograph_dir, 'coordinates.txt')
+    with open(coordinates, 'w') as f:
+        f.write('{} 6\n'.format(particles))
+    input_file = os.path.join(micrograph_dir, 'input_frame_{:02d}.txt'.format(frame))
+    with open(input_file, 'w') as f:
+        f.write('=== particleset ===\ncoord_file_in = {}\n=== detector ===\ndet_pix_x = 32\ndet_pix_y = 16\n'
+                'image_file_out = {}\n{}'.format(coordinates,
+                                                 os.path.join(micrograph_dir, 'frame_{:02d}.mrc'.format(frame)),
+                                                 '# fail\n' if fail else ''))
+    return input_file
+
+
+def test_resources_of_stub_simulations(tmp_path):
+    exe = str(tmp_path / 'stub_simulator.py')
+    with open(exe, 'w') as f:
+        f.write(STUB_SIMULATOR.format(python=sys.executable))
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+    run_dir = tmp_path / 'run'
+    jobs = []
+    for m, particles in enumerate((10, 20, 40)):
+        micrograph_dir = str(run_dir / 'micrograph_{}'.format(m))
+        os.makedirs(micrograph_dir)
+        jobs.append(make_job(micrograph_dir, 0, particles))
+    jobs.append(make_job(str(run_dir / 'micrograph_0'), 1, 10, fail=True))
+    # the jobs are launched from a fresh interpreter, the peak memory of a child includes the memory of its parent
+    runner = 'import json, sys\nfrom run_simulations import run_job\n' \
+             'print(json.dumps([run_job(sys.argv[1], job, retries=1)["status"] for job in sys.argv[2:]]))'
+    statuses = subprocess.run([sys.executable, '-c', runner, exe] + jobs, check=True, stdout=subprocess.PIPE,
+                              cwd=os.path.dirname(job_resources.__file__)).stdout
+    assert json.loads(statuses) == ['done', 'done', 'done', 'failed']
+
+    with open(str(run_dir / 'micrograph_0' / RESOURCES_FILE)) as f:
+        assert len(f.readlines()) == 3
+    resources = read_resources(str(run_dir))
+    assert len(resources) == 5
+    assert sorted(resources.groupby('micrograph').size()) == [1, 1, 3]
+    assert (resources['returncode'] != 0).sum() == 2
+    done = resources[resources['returncode'] == 0].sort_values('particles')
+    assert list(done['particles']) == [10, 20, 40]
+    assert (done['pixels'] == 512).all()
+    assert (done['output_bytes'] > 0).all()
+    # peak memory grows with the number of particles (8 bytes per element of the stub, 60 MB for 30 particles)
+    assert done['max_rss'].iloc[-1] - done['max_rss'].iloc[0] > 40e6
+    model = fit_cost_model(done, 'max_rss', ['particles'])
+    assert model['jobs'] == 3 and model['particles'] > 0
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+from map_store import FilteredMapStore
+
+
+@pytest.fixture
+def map_in(tmp_path):
+    path = str(tmp_path / 'map.mrc')
+    with mrcfile.new(path) as mrc:
+        mrc.set_data(np.random.default_rng(0).random((16, 16, 16)).astype(np.float32))
+        mrc.voxel_size = 1.0
+    return path
+
+
+def write_job(run_dir, map_path):
+    # input file of a simulation that reads the map, done once its output exists
+    os.makedirs(os.path.join(run_dir, 'micrograph'), exist_ok=True)
+    output = os.path.join(run_dir, 'micrograph', 'frame_00_no_noise.mrc')
+    with open(os.path.join(run_dir, 'micrograph', 'input_frame_00.txt'), 'w') as f:
+        f.write('map_file_re_in = {}\nimage_file_out = {}\n'.format(map_path, output))
+    return output
+
+
+def test_maps_of_the_run_are_not_evicted(tmp_path, map_in):
+    os.makedirs(str(tmp_path / 'run'))
+    store = FilteredMapStore(str(tmp_path / 'store'), max_bytes=1, run_dir=str(tmp_path / 'run'))
+    paths = [store.get(map_in, 1.0, 1.0, dose) for dose in (1.0, 2.0, 3.0)]
+    assert all(os.path.isfile(p) for p in paths)
+    output = write_job(str(tmp_path / 'run'), paths[0])
+
+    # another run (e.g. another process) that shares the store does not remove the maps of the first run
+    other = FilteredMapStore(str(tmp_path / 'store'), max_bytes=1, run_dir=str(tmp_path / 'other'))
+    other.get(map_in, 1.0, 1.0, 4.0)
+    assert all(os.path.isfile(p) for p in paths)
+
+    # once the simulations of the first run are done, its maps can be removed
+    with mrcfile.new(output) as mrc:
+        mrc.set_data(np.zeros((4, 4), dtype=np.float32))
+    other.get(map_in, 1.0, 1.0, 5.0)
+    assert not any(os.path.isfile(p) for p in paths)
+
+
+def test_maps_of_deleted_runs_are_released(tmp_path, map_in):
+    os.makedirs(str(tmp_path / 'run'))
+    store = FilteredMapStore(str(tmp_path / 'store'), max_bytes=1, run_dir=str(tmp_path / 'run'))
+    path = store.get(map_in, 1.0, 1.0, 1.0)
+    write_job(str(tmp_path / 'run'), path)
+    shutil.rmtree(str(tmp_path / 'run'))
+    FilteredMapStore(str(tmp_path / 'store'), max_bytes=1).get(map_in, 1.0, 1.0, 2.0)
+    assert not os.path.isfile(path)
+    assert os.listdir(str(tmp_path / 'store' / 'pins')) == []
+
+
+def test_evicted_map_is_generated_again(tmp_path, map_in):
+    store = FilteredMapStore(str(tmp_path / 'store'))
+    path = store.get(map_in, 1.0, 1.0, 1.0)
+    os.remove(path)
+    assert store.get(map_in, 1.0, 1.0, 1.0) == path
+    assert os.path.isfile(path)
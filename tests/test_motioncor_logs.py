@@ -0,0 +1,79 @@
+import os
+import re
+
+import numpy as np
+import pytest
+
+from motioncor_logs import (drift_accuracy, match_micrographs, micrograph_name, parse_motioncor_log,
+                            read_motioncor_logs, read_simulated_drift)
+
+LOG = """MotionCor2 version 1.4.0
+Frame (  1) shift:    -1.2345      2.3456
+...... Frame (  1) shift:    -1.2345      2.3456
+...... Frame (  2) shift:     0.5000     -0.0100
+...... Frame ( 10) shift:     +3.25        .75
+Total shift: 12.5 13.5
+"""
+
+
+def original_parser(text):
+    # line based parser of functions.read_motioncor_log before the shared parser
+    lines = [re.findall(r'[-+]?\d*\.\d+', i) for i in text.splitlines(True) if i.startswith('...... Frame ')]
+    return [[float(i[0]), float(i[1])] for i in lines]
+
+
+def test_parse_motioncor_log():
+    shifts = parse_motioncor_log(LOG)
+    assert shifts.tolist() == [[-1.2345, 2.3456], [0.5, -0.01], [3.25, 0.75]]
+    assert shifts.tolist() == original_parser(LOG)
+    assert parse_motioncor_log('no shifts').shape == (0, 2)
+
+
+def test_micrograph_names():
+    assert micrograph_name('/logs/mic_001_stack0-Patch-Full.log') == 'mic_001_stack'
+    assert micrograph_name('mic_001-Full.log') == 'mic_001'
+    matches = match_micrographs(['20S_001_Mar28_14.59.32_stack', '20S_001_Mar28', 'other_stack'],
+                                ['20S_001', '20S_001_Mar28_14.59.32', 'Mar28'])
+    assert matches == {'20S_001_Mar28_14.59.32_stack': '20S_001_Mar28_14.59.32', '20S_001_Mar28': '20S_001',
+                       'other_stack': None}
+
+
+def write_log(path, shifts):
+    with open(path, 'w') as f:
+        for n, (x, y) in enumerate(shifts, 1):
+            f.write('...... Frame ({:3d}) shift: {:10.4f} {:10.4f}\n'.format(n, x, y))
+    return path
+
+
+def test_drift_accuracy(tmp_path):
+    # drift.txt in nm, 2 A pixels
+    true = {'mic_a': np.array([[0.0, 0.0], [0.4, 0.2], [1.0, 0.6], [1.4, 1.0]]),
+            'mic_b': np.array([[0.0, 0.0], [-0.2, 0.4], [-0.6, 0.8]])}
+    for name, drift in true.items():
+        os.makedirs(str(tmp_path / name))
+        np.savetxt(str(tmp_path / name / 'drift.txt'), drift)
+    drift = read_simulated_drift(str(tmp_path), 2.0)
+    assert len(drift) == 7
+
+    logs = [write_log(str(tmp_path / 'mic_a_stack0-Patch-Full.log'), true['mic_a'] * 5 + [3, -1]),
+            write_log(str(tmp_path / 'mic_b_stack0-Patch-Full.log'), -true['mic_b'] * 5),
+            write_log(str(tmp_path / 'unrelated0-Patch-Full.log'), [[1.0, 1.0]])]
+    shifts = read_motioncor_logs(logs)
+    assert shifts.groupby('micrograph', observed=True).size().to_dict() == {'mic_a_stack': 4, 'mic_b_stack': 3,
+                                                                          'unrelated': 1}
+
+    frames, per_micrograph = drift_accuracy(shifts, drift)
+    per_micrograph = per_micrograph.set_index('micrograph')
+    # an offset of the whole trajectory is not an error, a trajectory with the wrong sign is
+    assert per_micrograph.loc['mic_a', 'rmsd'] == pytest.approx(0, abs=1e-4)
+    assert per_micrograph.loc['mic_b', 'rmsd'] > 1
+    assert list(per_micrograph.index) == ['mic_a', 'mic_b']
+
+    # with the inverted sign the errors of mic_b vanish, relative to the middle or the first frame
+    inverted, _ = drift_accuracy(shifts, drift, invert=True)
+    b = inverted[inverted['micrograph'] == 'mic_b'].sort_values('frame')
+    assert np.allclose(b['error'], 0, atol=1e-4)
+    frames, _ = drift_accuracy(shifts, drift, reference=0)
+    b = frames[frames['micrograph'] == 'mic_b'].sort_values('frame')
+    expected = np.hypot(*(-2 * (true['mic_b'] - true['mic_b'][0]) * 5).T)
+    assert np.allclose(b['error'], expected, atol=1e-4)
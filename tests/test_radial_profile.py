@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+from radial_profile import PS, ProfileStore, get_origin_of_patches, patch_view, radial_average, rfft_radial_average
+
+
+def write_image(path, image):
+    with mrcfile.new(str(path)) as mrc:
+        mrc.set_data(image.astype(np.float32))
+    return str(path)
+
+
+def test_power_spectrum_is_normalized_by_the_mean(tmp_path):
+    image = np.random.default_rng(0).random((96, 128)) + 5
+    path = write_image(tmp_path / 'image.mrc', image)
+    crop = image[:96, :96]
+    assert np.allclose(PS(path), np.abs(np.fft.rfft2(crop)) ** 2 / crop.mean() ** 2, rtol=1e-3, atol=0.05)
+    # a single patch that covers the cropped image gives the same spectrum
+    patch = image[:, 16:112]
+    assert np.allclose(PS(path, (96, 96)), np.abs(np.fft.rfft2(patch)) ** 2 / patch.mean() ** 2, rtol=1e-3, atol=0.05)
+
+
+def test_image_smaller_than_patch(tmp_path):
+    path = write_image(tmp_path / 'image.mrc', np.ones((64, 64)))
+    with pytest.raises(ValueError, match='smaller than the patch size'):
+        PS(path, (128, 128))
+
+
+def naive_radial_average(x):
+    center = np.array([n // 2 for n in x.shape])
+    radius = np.round(np.sqrt(np.sum((np.indices(x.shape).T - center) ** 2, axis=-1).T)).astype(int)
+    return np.array([x[radius == r].mean() for r in range(radius.max() + 1)])
+
+
+@pytest.mark.parametrize('shape', [(32, 32), (31, 33), (16, 20, 24)])
+def test_radial_average_matches_the_per_pixel_average(shape):
+    x = np.random.default_rng(1).random(shape)
+    assert np.allclose(radial_average(x), naive_radial_average(x))
+
+
+@pytest.mark.parametrize('shape', [(32, 32), (30, 41), (27, 16)])
+def test_half_spectrum_average_matches_the_full_spectrum(shape):
+    image = np.random.default_rng(2).random(shape)
+    full = radial_average(np.fft.fftshift(np.abs(np.fft.fft2(image)) ** 2))
+    half = rfft_radial_average(np.abs(np.fft.rfft2(image)) ** 2, shape)
+    assert len(half) == len(full)
+    assert np.allclose(half, full)
+
+
+@pytest.mark.parametrize('overlap', [0, 0.25, 0.5])
+def test_patch_view_matches_the_patch_origins(overlap):
+    image = np.arange(100 * 130, dtype=np.float32).reshape(100, 130)
+    view = patch_view(image, (32, 40), overlap)
+    origins = get_origin_of_patches(image.shape, (32, 40), overlap)
+    patches = [image[x:x + 32, y:y + 40] for x, y in origins]
+    assert view.shape[:2] == (len(set(x for x, _ in origins)), len(set(y for _, y in origins)))
+    assert np.array_equal(view.reshape(-1, 32, 40), patches)
+    assert not view.flags.writeable
+    assert np.shares_memory(view, image)
+
+
+def test_overlapping_patches_count_pixels_once_per_patch(tmp_path):
+    image = np.random.default_rng(3).random((64, 96)) + 5
+    path = write_image(tmp_path / 'image.mrc', image)
+    patches = patch_view(image, (32, 32), 0.5).reshape(-1, 32, 32)
+    assert len(patches) == 3 * 5
+    expected = sum(np.abs(np.fft.rfft2(p)) ** 2 for p in patches) / patches.mean() ** 2
+    assert np.allclose(PS(path, (32, 32), 0.5), expected, rtol=1e-3, atol=0.05)
+
+
+def test_profile_store_invalidates_changed_images(tmp_path):
+    path = write_image(tmp_path / 'image.mrc', np.ones((32, 32)))
+    store = ProfileStore(str(tmp_path / 'profiles.db'))
+    x, y = np.arange(5), np.linspace(0, 1, 5)
+    store.put_many({path: (x, y)}, 16, 0.5)
+    assert np.array_equal(store.get(path, 16, 0.5)[1], y.astype(np.float32))
+    # other parameters of the power spectrum are separate entries
+    assert store.get(path, 16) is None
+    assert store.get(path, 32, 0.5) is None
+
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert store.get(path, 16, 0.5) is None
+    store.put_many({path: (x, y)}, 16, 0.5)
+    os.remove(path)
+    write_image(path, np.ones((48, 48)))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert store.get(path, 16, 0.5) is None
+    store.close()
+
+    # entries are kept in the database file
+    store = ProfileStore(str(tmp_path / 'profiles.db'))
+    store.put_many({path: (x, y)}, 16, 0.5)
+    store.close()
+    assert ProfileStore(str(tmp_path / 'profiles.db')).get(path, 16, 0.5) is not None
@@ -0,0 +1,109 @@
+import json
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+from run_simulations import MANIFEST, find_jobs, is_done, main
+
+# simulator that fails the first time it is run for an input file and writes small mrc files afterwards
+STUB_SIMULATOR = '''#!{python}
+import os, re, sys
+import numpy as np, mrcfile
+input_file = sys.argv[1]
+with open(os.path.join(os.path.dirname(input_file), 'runs.log'), 'a') as f:
+    f.write(os.path.basename(input_file) + '\\n')
+if not os.path.isfile(input_file + '.failed_once'):
+    open(input_file + '.failed_once', 'w').close()
+    print('stub failure')
+    sys.exit(3)
+for out in re.findall(r'image_file_out\\s*=\\s*(\\S+)', open(input_file).read()):
+    with mrcfile.new(out, overwrite=True) as mrc:
+        mrc.set_data(np.ones((16, 16), dtype=np.float32))
+'''
+
+
+@pytest.fixture
+def exe(tmp_path):
+    path = str(tmp_path / 'stub_simulator.py')
+    with open(path, 'w') as f:
+        f.write(STUB_SIMULATOR.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    directory = tmp_path / 'run' / 'micrograph'
+    os.makedirs(str(directory))
+    for n in range(3):
+        with open(str(directory / 'input_frame_{:02d}.txt'.format(n)), 'w') as f:
+            f.write('=== detector ===\nimage_file_out = {}\nimage_file_out = {}\n'.format(
+                directory / 'frame_{:02d}_no_noise.mrc'.format(n), directory / 'frame_{:02d}_with_noise.mrc'.format(n)))
+    return str(tmp_path / 'run')
+
+
+def runs(run_dir):
+    with open(os.path.join(run_dir, 'micrograph', 'runs.log')) as f:
+        return sorted(line.strip() for line in f)
+
+
+def read_manifest(run_dir):
+    with open(os.path.join(run_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def write_outputs(input_file):
+    for output in ('no_noise', 'with_noise'):
+        with mrcfile.new(input_file.replace('input_frame', 'frame').replace('.txt', '_{}.mrc'.format(output))) as mrc:
+            mrc.set_data(np.ones((16, 16), dtype=np.float32))
+
+
+def test_retry_skip_and_resume(run_dir, exe):
+    jobs = find_jobs(run_dir)
+    assert [os.path.basename(j) for j in jobs] == ['input_frame_{:02d}.txt'.format(n) for n in range(3)]
+    # outputs that exist before the run are not simulated again
+    write_outputs(jobs[0])
+    assert is_done(jobs[0]) and not is_done(jobs[1])
+
+    assert main(run_dir, exe, workers=2, retries=1) == 0
+    assert runs(run_dir) == ['input_frame_01.txt'] * 2 + ['input_frame_02.txt'] * 2
+    manifest = read_manifest(run_dir)
+    assert manifest[os.path.join('micrograph', 'input_frame_00.txt')] == {'status': 'done', 'attempts': 0,
+                                                                         'skipped': True}
+    for n in (1, 2):
+        status = manifest[os.path.join('micrograph', 'input_frame_{:02d}.txt'.format(n))]
+        assert status['status'] == 'done' and status['attempts'] == 2 and 'error' not in status
+    assert not [f for f in os.listdir(run_dir) if f.endswith('.tmp')]
+
+    # resume: nothing is run again, the manifest is kept
+    assert main(run_dir, exe, workers=2, retries=1) == 0
+    assert len(runs(run_dir)) == 4
+    assert read_manifest(run_dir) == manifest
+
+
+def test_incomplete_outputs_are_simulated_again(run_dir, exe):
+    jobs = find_jobs(run_dir)
+    for j in jobs:
+        write_outputs(j)
+    output = jobs[1].replace('input_frame', 'frame').replace('.txt', '_with_noise.mrc')
+    with open(output, 'r+b') as f:
+        f.truncate(os.path.getsize(output) - 100)
+    assert not is_done(jobs[1])
+
+    assert main(run_dir, exe, workers=1, retries=1) == 0
+    assert runs(run_dir) == ['input_frame_01.txt'] * 2
+    assert is_done(jobs[1])
+
+
+def test_failed_simulations(run_dir, exe):
+    assert main(run_dir, exe, workers=3, retries=0) == 3
+    manifest = read_manifest(run_dir)
+    assert len(manifest) == 3
+    for status in manifest.values():
+        assert status['status'] == 'failed' and status['attempts'] == 1
+        assert status['returncode'] == 3 and 'stub failure' in status['error']
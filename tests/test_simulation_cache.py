@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pytest
+
+mrcfile = pytest.importorskip('mrcfile')
+
+from simulation_cache import SimulationCache
+
+
+def write_input(directory, name):
+    output = os.path.join(directory, '{}_with_noise.mrc'.format(name))
+    input_file = os.path.join(directory, 'input_{}.txt'.format(name))
+    with open(input_file, 'w') as f:
+        f.write('=== simulation ===\nrand_seed = 1\nimage_file_out = {}\n'.format(output))
+    return input_file, output
+
+
+def test_outputs_modified_in_place_do_not_change_the_cache(tmp_path):
+    cache = SimulationCache(str(tmp_path / 'cache'))
+    input_file, output = write_input(str(tmp_path), 'a')
+    with mrcfile.new(output) as mrc:
+        mrc.set_data(np.ones((8, 8), dtype=np.float32))
+    cache.store(input_file)
+
+    other_input, other_output = write_input(str(tmp_path), 'b')
+    assert cache.fetch(other_input)
+    # later steps overwrite the outputs, e.g. add_noise.py
+    for path in (output, other_output):
+        with mrcfile.new(path, overwrite=True) as mrc:
+            mrc.set_data(np.zeros((8, 8), dtype=np.float32))
+
+    assert cache.fetch(other_input)
+    with mrcfile.open(other_output) as mrc:
+        assert np.all(mrc.data == 1)
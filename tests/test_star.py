@@ -0,0 +1,77 @@
+import os
+
+import pandas as pd
+import pytest
+
+import star
+
+STAR = """
+data_general
+
+_rlnImageSize 64
+_rlnName test
+
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnVoltage #2
+1 300.0
+
+data_particles
+
+loop_
+_rlnMicrographName #1
+_rlnCoordinateX #2
+_rlnClassNumber #3
+_rlnIsFlipped #4
+mic1.mrc 10.5 1 True
+mic2.mrc 20.25 2 False
+mic1.mrc 30.0 3 True
+"""
+
+
+def write_file(path, text=STAR):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_sidecar_gives_the_parsed_tables(tmp_path, compact):
+    path = write_file(tmp_path / 'particles.star')
+    parsed = {b: star.read_star(path, block=b, compact=compact, cache=False) for b in ['general', 'optics', 'particles']}
+    assert parsed['particles']['_rlnIsFlipped'].dtype == bool
+
+    star.write_sidecar(path)
+    for block, df in parsed.items():
+        cached = star.read_sidecar(path, block, compact=compact)
+        pd.testing.assert_frame_equal(cached, df)
+    columns = ['_rlnIsFlipped', '_rlnMicrographName']
+    pd.testing.assert_frame_equal(star.read_sidecar(path, columns=columns), parsed['particles'][columns])
+    # booleans can be used as mask like the parsed column
+    assert len(parsed['particles'][star.read_star(path)['_rlnIsFlipped']]) == 2
+
+
+def test_outdated_sidecar_is_not_used(tmp_path):
+    path = write_file(tmp_path / 'particles.star')
+    assert star.read_star(path, cache=True)['_rlnCoordinateX'][0] == 10.5
+    assert os.path.isdir(star.sidecar_path(path))
+
+    # same size and modification time, different content
+    st = os.stat(path)
+    write_file(path, STAR.replace('10.5', '11.5'))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert star.read_sidecar(path) is None
+    assert star.read_star(path, cache=False)['_rlnCoordinateX'][0] == 11.5
+
+    # only the modification time changed
+    star.write_sidecar(path)
+    assert star.read_sidecar(path) is not None
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert star.read_sidecar(path) is None
+
+    # the cache is written again if it is outdated
+    write_file(path, STAR + 'mic3.mrc 40.0 4 False\n')
+    assert len(star.read_star(path, cache=True)) == 4
+    assert len(star.read_sidecar(path)) == 4
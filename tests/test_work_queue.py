@@ -0,0 +1,141 @@
+import json
+import multiprocessing
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from work_queue import WorkQueue, _run_with_heartbeat, main
+
+# simulator that writes its outputs after a short time and logs every run
+STUB_SIMULATOR = '''#!{python}
+import os, re, sys, time
+import numpy as np, mrcfile
+text = open(sys.argv[1]).read()
+with open(os.path.join(os.path.dirname(sys.argv[1]), 'runs.log'), 'a') as f:
+    f.write(os.path.basename(sys.argv[1]) + '\\n')
+time.sleep(0.05)
+for out in re.findall(r'image_file_out\\s*=\\s*(\\S+)', text):
+    with mrcfile.new(out, overwrite=True) as mrc:
+        mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+'''
+
+
+def make_run(run_dir, micrographs=2, frames=5):
+    for m in range(micrographs):
+        directory = os.path.join(run_dir, 'micrograph_{}'.format(m))
+        os.makedirs(directory)
+        for n in range(frames):
+            with open(os.path.join(directory, 'input_frame_{:02d}.txt'.format(n)), 'w') as f:
+                f.write('=== simulation ===\nimage_file_out = {}\n'.format(
+                    os.path.join(directory, 'frame_{:02d}_with_noise.mrc'.format(n))))
+    return sorted(os.path.join(run_dir, 'micrograph_{}'.format(m), 'input_frame_{:02d}.txt'.format(n))
+                  for m in range(micrographs) for n in range(frames))
+
+
+def expire(queue, input_file):
+    claim = queue._path(input_file, '.claim')
+    old = time.time() - 2 * queue.lease
+    os.utime(claim, (old, old))
+
+
+def test_takeover_race(tmp_path):
+    input_file = make_run(str(tmp_path), 1, 1)[0]
+    stalled, first, second = (WorkQueue(str(tmp_path), lease=60) for _ in range(3))
+    assert stalled.claim(input_file, 'stalled')
+    expire(stalled, input_file)
+
+    # `second` sees the expired claim, but `first` takes it over before `second` moves it away
+    def expired_then_taken_over(f):
+        assert first.claim(f, 'first')
+        return True
+    second.claim_expired = expired_then_taken_over
+
+    assert not second.claim(input_file, 'second')
+    assert first.owns(input_file) and not second.owns(input_file)
+    assert first.heartbeat(input_file)
+    # the stalled worker lost its claim and must not mark the job
+    assert not stalled.heartbeat(input_file)
+    assert not stalled.finish(input_file, {'status': 'failed'})
+    assert not stalled.is_finished(input_file)
+    assert first.finish(input_file, {'status': 'done'})
+    assert first.is_finished(input_file)
+
+
+def test_lost_claim_stops_job(tmp_path):
+    exe = str(tmp_path / 'sleep.sh')
+    with open(exe, 'w') as f:
+        f.write('#!/bin/sh\nexec sleep 60\n')
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+    input_file = make_run(str(tmp_path), 1, 1)[0]
+    queue = WorkQueue(str(tmp_path), lease=0.4)
+    assert queue.claim(input_file, 'worker')
+    # another worker takes the job over while it runs
+    os.remove(queue._path(input_file, '.claim'))
+    assert WorkQueue(str(tmp_path), lease=0.4).claim(input_file, 'other')
+
+    start = time.time()
+    status = _run_with_heartbeat(queue, input_file, exe, retries=2)
+    assert status['status'] == 'cancelled'
+    assert status['attempts'] == 1
+    assert time.time() - start < 10
+    assert not queue.finish(input_file, status)
+
+
+def _claim_all(run_dir, jobs, barrier, results, worker):
+    queue = WorkQueue(run_dir, lease=60)
+    barrier.wait()
+    results.put((worker, [j for j in jobs if queue.claim(j, worker)]))
+
+
+def test_concurrent_takeover(tmp_path):
+    # several processes take over the same abandoned claims at the same time, every job goes to exactly one of them
+    run_dir = str(tmp_path)
+    jobs = make_run(run_dir, 10, 20)
+    queue = WorkQueue(run_dir, lease=60)
+    for j in jobs:
+        assert queue.claim(j, 'dead')
+        expire(queue, j)
+
+    workers = 8
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_claim_all, args=(run_dir, jobs, barrier, results, w))
+                 for w in range(workers)]
+    for p in processes:
+        p.start()
+    claimed = dict(results.get(timeout=60) for _ in processes)
+    for p in processes:
+        p.join()
+
+    owners = {}
+    for worker, won in claimed.items():
+        for j in won:
+            owners.setdefault(j, []).append(worker)
+    assert sorted(owners) == jobs
+    assert all(len(o) == 1 for o in owners.values())
+    for j, (worker, ) in owners.items():
+        with open(queue._path(j, '.claim')) as f:
+            assert json.load(f)['worker'] == worker
+
+
+def test_workers_run_every_job_once(tmp_path):
+    pytest.importorskip('mrcfile')
+    exe = str(tmp_path / 'stub_simulator.py')
+    with open(exe, 'w') as f:
+        f.write(STUB_SIMULATOR.format(python=sys.executable))
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+    run_dir = str(tmp_path / 'run')
+    jobs = make_run(run_dir)
+
+    assert main(run_dir, exe, workers=4, lease=5, retries=0, poll=0.1) == 0
+
+    queue = WorkQueue(run_dir)
+    assert all(os.path.isfile(queue._path(j, '.done')) for j in jobs)
+    runs = []
+    for m in {os.path.dirname(j) for j in jobs}:
+        with open(os.path.join(m, 'runs.log')) as f:
+            runs += [os.path.join(m, line.strip()) for line in f]
+    assert sorted(runs) == jobs